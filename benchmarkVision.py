@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+#######################################
+# Benchmark of the vision hot path over recorded greenhouse frames
+# USAGE:
+# python3 benchmarkVision.py /home/pi/Filakov/frames --scales 1 .5 .25 --output bench.json
+# Timer jitter of the control process with the camera loop as a thread and in the vision process:
+# python3 benchmarkVision.py /home/pi/Filakov/frames --jitter 30
+#######################################
+
+import argparse
+import datetime
+import json
+import platform
+import resource
+import subprocess
+import threading
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from colorDetection import DETECTORS, createDetectors, compositeView, listImages
+from colorTable import buildTable
+from frameGrabber import FrameGrabber
+from runSystem import extractColor, middleSquare, cameraLoop
+from signalBus import Signals
+from tracing import JitterProbe
+from visionWorker import VisionWorker
+
+def referencePipeline(frame):
+    """ Per-frame work of cameraLoop before the detection kernel """
+    red, green, blue = [(DETECTORS[c]['bounds']) for c in ('red', 'green', 'blue')]
+
+    redMask = extractColor(frame, red)
+    middleSquare(redMask, 15, 100000, 0.5, 0.5)
+    medBlur = cv2.medianBlur(frame, 5)
+    greenMask = extractColor(medBlur, green)
+    middleSquare(greenMask, 100, 30, 0.5, 0.5)
+    blueMask = extractColor(frame, blue)
+    middleSquare(blueMask, 70, 70, 0.5, 0.4)
+
+    row1 = np.hstack([frame, redMask])
+    row2 = np.hstack([greenMask, blueMask])
+    return np.vstack([row1, row2])
+
+def stages(frames):
+    """ Returns the benchmarked stages as (name, function of a frame) """
+
+    red = DETECTORS['red']['bounds']
+    redMask = extractColor(frames[0], red)
+    detectors = createDetectors()
+
+    def kernel(frame):
+        for d in detectors:
+            d.Detect(frame)
+
+    table = buildTable([d.name for d in detectors])
+    tableDetectors = createDetectors()
+
+    def lookup(frame):
+        table.DetectAll(frame, tableDetectors)
+
+    def display(frame):
+        kernel(frame)
+        return compositeView(frame, detectors)
+
+    # Detection stream of the frame grabber one pyramid level down
+    halfDetectors = createDetectors(scale = .5)
+
+    def downscaled(frame):
+        small = cv2.resize(frame, (0, 0), fx = .5, fy = .5, interpolation = cv2.INTER_AREA)
+        for d in halfDetectors:
+            d.Detect(small)
+
+    return [('extractColor', lambda f: extractColor(f, red)),
+            ('middleSquare', lambda f: middleSquare(redMask, 15, 100000, 0.5, 0.5)),
+            ('medianBlur', lambda f: cv2.medianBlur(f, 5)),
+            ('composite', lambda f: np.vstack([np.hstack([f, f]), np.hstack([f, f])]))] + \
+           [('detector_' + d.name, d.Detect) for d in detectors] + \
+           [('pipeline_reference', referencePipeline),
+            ('pipeline_headless', kernel),
+            ('pipeline_downscaled', downscaled),
+            ('pipeline_table', lookup),
+            ('pipeline_display', display)]
+
+class ReplayCamera:
+    def __init__(self, frames, fps = 30):
+        """ Video capture looping over the frames at fps, picklable for the vision process """
+        self.frames = frames
+        self.fps = fps
+        self.i = 0
+        self.last = 0
+        self.opened = True
+
+    def isOpened(self):
+        return self.opened
+
+    def release(self):
+        self.opened = False
+
+    def read(self):
+        wait = self.last + 1 / self.fps - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        self.last = time.perf_counter()
+        self.i += 1
+        return True, self.frames[self.i % len(self.frames)]
+
+def measureJitter(frames, secs, fps):
+    """ Returns the JitterProbe of a thread of the control process per mode
+    of the camera loop, with all detectors running """
+
+    results = {}
+    for mode in ('thread', 'process'):
+        signals = Signals({ 'red': False, 'green': False, 'blue': False, 'stop': False, 'finish': False })
+        if mode == 'thread':
+            grabber = FrameGrabber(ReplayCamera(frames, fps))
+            grabber.Start()
+            T_cam = threading.Thread(target = cameraLoop, args = (grabber, signals, 1, None))
+        else:
+            grabber = VisionWorker(ReplayCamera(frames, fps))
+            if not grabber.Start():
+                continue
+            T_cam = threading.Thread(target = grabber.Serve, args = (signals, ))
+        T_cam.start()
+
+        probe = JitterProbe()
+        with signals.Detecting('red', 'green', 'blue'):
+            probe.Start()
+            time.sleep(secs)
+            probe.Stop()
+        signals['finish'] = True
+        T_cam.join()
+        grabber.Stop()
+        results[mode] = probe
+    return results
+
+def measure(function, frames, repeat):
+    """ Returns the latencies in ms and the peak of traced memory in KiB.
+    Tracing slows down every allocation, so the latencies are timed in one pass
+    and the memory is traced in a separate one. """
+
+    # Warm-up allocates the buffers of the detectors
+    function(frames[0])
+
+    times = []
+    for r in range(repeat):
+        for f in frames:
+            start = time.perf_counter()
+            function(f)
+            times.append(1000 * (time.perf_counter() - start))
+
+    tracemalloc.start()
+    for f in frames:
+        function(f)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return times, peak / 1024
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr = subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def run():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('directory', help = 'directory with recorded frames')
+    ap.add_argument('--scales', type = float, nargs = '+', default = [1, .5, .25], help = 'resolutions relative to the recorded frames')
+    ap.add_argument('--repeat', type = int, default = 3, help = 'passes over the frames per stage')
+    ap.add_argument('--output', default = 'bench_vision.json', help = 'file for machine-readable results')
+    ap.add_argument('--jitter', type = float, default = 0, help = 'secs of the timer jitter measurement per mode (0 - none)')
+    ap.add_argument('--fps', type = float, default = 30, help = 'frame rate of the replayed frames for --jitter')
+    args = ap.parse_args()
+
+    originals = [cv2.imread(p) for p in listImages(args.directory)]
+    originals = [f for f in originals if f is not None]
+    if not originals:
+        print('No frames found in', args.directory)
+        return
+
+    results = []
+    for scale in args.scales:
+        frames = [f if scale == 1 else cv2.resize(f, (0, 0), fx = scale, fy = scale, interpolation = cv2.INTER_AREA)
+                  for f in originals]
+        rows, cols = frames[0].shape[:2]
+
+        for name, function in stages(frames):
+            times, peak = measure(function, frames, args.repeat)
+            res = { 'stage'     : name,
+                    'scale'     : scale,
+                    'width'     : cols,
+                    'height'    : rows,
+                    'calls'     : len(times),
+                    'fps'       : 1000 * len(times) / sum(times),
+                    'p50_ms'    : float(np.percentile(times, 50)),
+                    'p99_ms'    : float(np.percentile(times, 99)),
+                    'peak_kib'  : peak }
+            results.append(res)
+            print('%-20s %5dx%-5d %8.1f fps  p50 %7.2f ms  p99 %7.2f ms  peak %9.1f KiB' %
+                  (name, cols, rows, res['fps'], res['p50_ms'], res['p99_ms'], peak))
+
+    jitter = {}
+    if args.jitter:
+        for mode, probe in measureJitter(originals, args.jitter, args.fps).items():
+            jitter[mode] = { 'wakeups': probe.Count(),
+                             'p50_ms' : 1000 * probe.Percentile(.5),
+                             'p99_ms' : 1000 * probe.Percentile(.99),
+                             'max_ms' : 1000 * probe.maxLate }
+            print('jitter (%-7s)  %6d wakeups  p50 %7.2f ms  p99 %7.2f ms  max %7.2f ms' %
+                  (mode, probe.Count(), jitter[mode]['p50_ms'], jitter[mode]['p99_ms'], jitter[mode]['max_ms']))
+
+    report = { 'date'       : str(datetime.datetime.now()),
+               'commit'     : gitCommit(),
+               'machine'    : platform.machine(),
+               'platform'   : platform.platform(),
+               'python'     : platform.python_version(),
+               'opencv'     : cv2.__version__,
+               'numpy'      : np.__version__,
+               'threads'    : cv2.getNumThreads(),
+               'frames'     : len(originals),
+               'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               'results'    : results,
+               'jitter'     : jitter }
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent = 2)
+    print('Results written to', args.output)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+#######################################
+# Incremental upload of a run folder to the cloud
+# USAGE (resuming an interrupted upload):
+# python3 cloudUpload.py /home/pi/Filakov/2020-05-01_05-30-00/
+#######################################
+
+import argparse
+import hashlib
+import json
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+from logWriter import logger
+
+MANIFEST = 'upload_manifest.json'
+
+class DropboxBackend:
+    def __init__(self, script = '/home/pi/Dropbox-Uploader/dropbox_uploader.sh'):
+        """ Uploads files with Dropbox-Uploader """
+        self.script = script
+
+    def Upload(self, path, remote):
+        return subprocess.call([self.script, '-q', 'upload', path, remote]) == 0
+
+class LocalBackend:
+    def __init__(self, directory):
+        """ Copies files to a local directory, a stand-in for the cloud """
+        self.directory = directory
+
+    def Upload(self, path, remote):
+        dest = os.path.join(self.directory, remote)
+        os.makedirs(os.path.dirname(dest), exist_ok = True)
+        shutil.copyfile(path, dest + '.part')
+        os.replace(dest + '.part', dest)
+        return True
+
+def fileHash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class Uploader:
+    def __init__(self, folder, backend, workers = 2, retries = 3):
+        """ Uploads files of a run folder as soon as they are enqueued.
+        The manifest in the folder keeps the content hash of every uploaded
+        file, so a retry or a restart skips the files which did not change. """
+
+        self.folder = folder
+        self.remoteDir = os.path.basename(os.path.normpath(folder))
+        self.backend = backend
+        self.retries = retries
+        self.manifestPath = os.path.join(folder, MANIFEST)
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.active = set()
+
+        try:
+            with open(self.manifestPath, encoding = 'utf-8') as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+        self.workers = [threading.Thread(target = self.uploadLoop, daemon = True) for i in range(workers)]
+        for w in self.workers:
+            w.start()
+
+    def Enqueue(self, path):
+        self.queue.put(path)
+
+    def Sync(self):
+        """ Enqueues all files of the folder, the unchanged uploaded ones are skipped """
+        for name in sorted(os.listdir(self.folder)):
+            path = os.path.join(self.folder, name)
+            if name != MANIFEST and not name.endswith('.tmp') and os.path.isfile(path):
+                self.Enqueue(path)
+
+    def Drain(self):
+        """ Waits until all enqueued files are handled """
+        self.queue.join()
+
+    def Close(self):
+        self.Drain()
+        for w in self.workers:
+            self.queue.put(None)
+        for w in self.workers:
+            w.join()
+
+    def Pending(self):
+        """ Returns the names of the files which are not uploaded """
+        with self.lock:
+            return [name for name, entry in self.manifest.items() if entry['state'] != 'done']
+
+    def saveManifest(self):
+        tmp = self.manifestPath + '.tmp'
+        with open(tmp, 'w', encoding = 'utf-8') as f:
+            json.dump(self.manifest, f, indent = 1)
+        os.replace(tmp, self.manifestPath)
+
+    def setState(self, name, digest, state):
+        with self.lock:
+            self.manifest[name] = { 'sha1': digest, 'state': state }
+            self.saveManifest()
+
+    def upload(self, path):
+        name = os.path.basename(path)
+        digest = fileHash(path)
+
+        with self.lock:
+            entry = self.manifest.get(name)
+            if entry is not None and entry['sha1'] == digest and \
+               (entry['state'] == 'done' or (name, digest) in self.active):
+                return
+            self.active.add((name, digest))
+
+        try:
+            self.uploadFile(path, name, digest)
+        finally:
+            with self.lock:
+                self.active.discard((name, digest))
+
+    def uploadFile(self, path, name, digest):
+        self.setState(name, digest, 'pending')
+        for attempt in range(self.retries):
+            try:
+                if self.backend.Upload(path, self.remoteDir + '/' + name):
+                    self.setState(name, digest, 'done')
+                    return
+            except Exception as e:
+                logger.Log('Uploading ' + name + ' failed: ' + str(e))
+            if attempt + 1 < self.retries:
+                time.sleep(2 ** attempt)
+
+        self.setState(name, digest, 'failed')
+        logger.Log('Uploading ' + name + ' failed after ' + str(self.retries) + ' attempts.')
+
+    def uploadLoop(self):
+        while True:
+            path = self.queue.get()
+            try:
+                if path is None:
+                    return
+                self.upload(path)
+            except OSError as e:
+                logger.Log('Uploading ' + str(path) + ' failed: ' + str(e))
+            finally:
+                self.queue.task_done()
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument('folder', help = 'run folder to upload')
+    ap.add_argument('--local', help = 'copy to this directory instead of Dropbox')
+    args = ap.parse_args()
+
+    backend = LocalBackend(args.local) if args.local else DropboxBackend()
+    uploader = Uploader(args.folder, backend)
+    uploader.Sync()
+    uploader.Close()
+
+    pending = uploader.Pending()
+    print('Not uploaded:', ', '.join(pending) if pending else 'none')
+    logger.Flush()
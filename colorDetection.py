@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+import cv2
+import numpy as np
+import json
+import os
+
+# Detector definitions used by runSystem.cameraLoop
+#   bounds    - color boundaries ([B_low, G_low, R_low], [B_high, G_high, R_high])
+#   square    - middle square (strideH, strideV, centerH, centerV) as in middleSquare
+#   blur      - aperture of the median blur applied before thresholding (0 - no blur)
+#   threshold - fraction of the middle square needed to raise the signal
+DETECTORS = { 'red'  : { 'bounds'    : ([0, 0, 120], [60, 120, 255]),
+                         'square'    : (15, 100000, 0.5, 0.5),
+                         'blur'      : 0,
+                         'threshold' : .01 },
+              'green': { 'bounds'    : ([0, 50, 0], [30, 255, 140]),
+                         'square'    : (100, 30, 0.5, 0.5),
+                         'blur'      : 5,
+                         'threshold' : .03 },
+              'blue' : { 'bounds'    : ([95, 65, 70], [170, 110, 95]),
+                         'square'    : (70, 70, 0.5, 0.4),
+                         'blur'      : 0,
+                         'threshold' : .025 } }
+# Bounds and thresholds written by tuneThresholds.py, replacing the ones above
+TUNED_DETECTORS = '/home/pi/Filakov/detectors.json'
+
+# Utils
+# https://www.rapidtables.com/web/color/RGB_Color.html
+# https://www.ginifab.com/feeds/pms/pms_color_in_image.php
+
+class ColorDetector:
+    def __init__(self, name, bounds, square, blur = 0, threshold = 0, scale = 1):
+        """ Detects a BGR color in the middle square of a frame.
+        Only the middle square is blurred and thresholded. Bounds are converted
+        once and the buffers are reallocated only when the frame size changes.
+        scale - size of the frames relative to the camera resolution the square
+        and the blur are defined for (e.g. .5 for a pyramid level) """
+
+        self.name = name
+        self.lower = np.array(bounds[0], dtype = "uint8")
+        self.upper = np.array(bounds[1], dtype = "uint8")
+        self.square = square
+        self.scale = scale
+        # The aperture of the median blur must stay odd
+        self.blur = max(3, int(blur * scale) | 1) if blur else 0
+        self.threshold = threshold
+        self.fraction = 0
+        self.shape = None
+
+    def Prepare(self, shape):
+        """ Computes the middle square for the given frame shape in the same way
+        as middleSquare and allocates the output buffers """
+
+        rows, cols = shape[:2]
+        strideH, strideV, centerH, centerV = self.square
+        strideH, strideV = round(strideH * self.scale), round(strideV * self.scale)
+        centerV = round(rows * centerV)
+        centerH = round(cols * centerH)
+
+        strideV = min([rows - centerV, centerV, strideV])
+        strideH = min([cols - centerH, centerH, strideH])
+
+        top, bottom = centerV - strideV, centerV + strideV
+        left, right = centerH - strideH, centerH + strideH
+        self.roi = (top, bottom, left, right)
+        self.area = 4 * strideV * strideH
+
+        # The median blur needs a margin of ksize / 2 pixels around the square,
+        # so that its pixels are equal to the ones of a full frame blur
+        margin = self.blur // 2
+        padTop, padBottom = max(top - margin, 0), min(bottom + margin, rows)
+        padLeft, padRight = max(left - margin, 0), min(right + margin, cols)
+        self.padded = (padTop, padBottom, padLeft, padRight)
+        self.inner = (top - padTop, bottom - padTop, left - padLeft, right - padLeft)
+
+        if self.blur:
+            self.blurred = np.empty((padBottom - padTop, padRight - padLeft, 3), dtype = "uint8")
+        self.mask = np.empty((bottom - top, right - left), dtype = "uint8")
+        self.output = np.empty((bottom - top, right - left, 3), dtype = "uint8")
+        self.flat = self.output.reshape(-1)
+        self.shape = shape
+
+    def Square(self, frame):
+        """ Returns the pixels of the middle square, blurred if the detector blurs.
+        The blurred pixels are overwritten by the next call. """
+
+        if frame.shape != self.shape:
+            self.Prepare(frame.shape)
+
+        if self.blur:
+            (t, b, l, r) = self.padded
+            cv2.medianBlur(frame[t:b, l:r], self.blur, self.blurred)
+            (t, b, l, r) = self.inner
+            return self.blurred[t:b, l:r]
+
+        (t, b, l, r) = self.roi
+        return frame[t:b, l:r]
+
+    def Detect(self, frame):
+        """ Returns the fraction of the masked pixels in the middle square,
+        equal to middleSquare(extractColor(frame, bounds), *square) """
+
+        roi = self.Square(frame)
+        cv2.inRange(roi, self.lower, self.upper, self.mask)
+        # Masked bitwise_and leaves the unmasked pixels of a given output untouched
+        self.output.fill(0)
+        cv2.bitwise_and(roi, roi, self.output, self.mask)
+
+        # (1 / 3) because the pixels are counted in all 3 channels
+        self.fraction = (1 / 3) * cv2.countNonZero(self.flat) / self.area
+        return self.fraction
+
+    def Count(self, classes, bit, roi):
+        """ Returns the fraction of the middle square as Detect counts it, for the
+        pixels having the class bit set in classes, the class bitmasks of the square's pixels roi """
+
+        np.bitwise_and(classes, bit, out = self.mask)
+        self.output.fill(0)
+        cv2.bitwise_and(roi, roi, self.output, self.mask)
+
+        # (1 / 3) because the pixels are counted in all 3 channels
+        self.fraction = (1 / 3) * cv2.countNonZero(self.flat) / self.area
+        return self.fraction
+
+    def Detected(self):
+        """ Returns whether the last fraction is above the threshold """
+        return self.fraction > self.threshold
+
+    def Locate(self, frame, stride = None):
+        """ Returns the horizontal offset in pixels of the color from the center
+        of the middle square, or None if the color is not found.
+        The rows of the middle square are searched up to stride pixels to each
+        side (the whole width by default). Of several objects, the one nearest
+        to the center with at least as many pixels as the threshold needs wins. """
+
+        if frame.shape != self.shape:
+            self.Prepare(frame.shape)
+
+        rows, cols = frame.shape[:2]
+        center = (self.roi[2] + self.roi[3]) // 2
+        stride = cols if stride is None else stride
+        (t, b) = self.roi[:2]
+        l, r = max(center - stride, 0), min(center + stride, cols)
+
+        if self.blur:
+            margin = self.blur // 2
+            pt, pb = max(t - margin, 0), min(b + margin, rows)
+            pl, pr = max(l - margin, 0), min(r + margin, cols)
+            band = cv2.medianBlur(frame[pt:pb, pl:pr], self.blur)[t - pt : b - pt, l - pl : r - pl]
+        else:
+            band = frame[t:b, l:r]
+
+        mask = cv2.inRange(band, self.lower, self.upper)
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(mask)
+
+        minPixels = max(self.threshold * self.area, 1)
+        offsets = [l + centroids[i][0] - center for i in range(1, count) if stats[i, cv2.CC_STAT_AREA] >= minPixels]
+        if not offsets:
+            return None
+        return min(offsets, key = abs)
+
+    def Draw(self, image):
+        """ Draws the masked middle square, its rectangle and the percentage
+        of masked pixels on the image, the same way middleSquare does """
+
+        (t, b, l, r) = self.roi
+        image[t:b, l:r] = self.output
+        cv2.rectangle(image, (l, t), (r - 1, b - 1), (150,150,30))
+        cv2.putText(image, 'Mask: %.2f %%' % (100 * self.fraction), (15, image.shape[0] - 15), 1, 1, (255, 255, 255))
+
+def loadDefinitions(path = TUNED_DETECTORS):
+    """ Returns the detector definitions with the bounds and thresholds tuned
+    by tuneThresholds.py, the defaults (DETECTORS) without the file """
+
+    definitions = { name: dict(d) for name, d in DETECTORS.items() }
+    try:
+        with open(path, encoding = 'utf-8') as f:
+            tuned = json.load(f)
+    except (OSError, ValueError):
+        return definitions
+
+    for name, t in tuned.items():
+        if name in definitions:
+            definitions[name]['bounds'] = tuple(t['bounds'])
+            definitions[name]['threshold'] = t['threshold']
+    return definitions
+
+def createDetectors(names = ('red', 'green', 'blue'), definitions = None, scale = 1):
+    """ Returns a list of detectors for the given names working on frames scaled by scale.
+    The definitions are the tuned ones (loadDefinitions) by default. """
+
+    if definitions is None:
+        definitions = loadDefinitions()
+    return [ColorDetector(name, scale = scale, **definitions[name]) for name in names]
+
+def compositeView(frame, detectors):
+    """ Returns the frame stacked with the masked middle squares of the detectors
+    in a grid with two panels per row """
+
+    panels = [frame.copy()]
+    for d in detectors:
+        panel = np.zeros_like(frame)
+        d.Draw(panel)
+        panels.append(panel)
+
+    if len(panels) % 2:
+        panels.append(np.zeros_like(frame))
+
+    return np.vstack([np.hstack(panels[i : i + 2]) for i in range(0, len(panels), 2)])
+
+def listImages(directory):
+    """ Returns the sorted paths of all images in the directory """
+    ext = ('.png', '.jpg', '.jpeg', '.bmp', '.webp')
+    return sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.lower().endswith(ext))
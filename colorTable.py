@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+#######################################
+# Lookup table classifying BGR colors into all detector classes at once
+# USAGE (building the table from labeled samples):
+# python3 colorTable.py --samples /home/pi/Filakov/samples
+#######################################
+
+import argparse
+import hashlib
+import json
+import os
+import cv2
+import numpy as np
+from colorDetection import DETECTORS, listImages, loadDefinitions
+
+# Bits kept per channel: 6 bits give a table of 64^3 cells (256 KiB)
+BITS = 6
+TABLE_CACHE = '/home/pi/Filakov/colortables/'
+
+class ColorTable:
+    def __init__(self, names, table):
+        """ Quantized BGR lookup table of class bitmasks: bit i of table[b, g, r]
+        is set when the color belongs to the class names[i]. One lookup per
+        pixel gives the masks of all classes. """
+
+        self.names = list(names)
+        self.bits = int(round(np.log2(table.shape[0])))
+        self.table = np.ascontiguousarray(table, dtype = np.uint8).reshape(-1)
+
+    def Bit(self, name):
+        return 1 << self.names.index(name)
+
+    def Classify(self, image):
+        """ Returns the class bitmasks of the pixels of the BGR image """
+        q = image >> (8 - self.bits)
+        index = q[..., 0].astype(np.uint32) << (2 * self.bits)
+        index |= q[..., 1].astype(np.uint32) << self.bits
+        index |= q[..., 2]
+        return np.take(self.table, index)
+
+    def DetectAll(self, frame, detectors):
+        """ Sets the fractions of the detectors from the table. Detectors with
+        the same square and blur share one classification of it. """
+
+        classified = {}
+        for d in detectors:
+            roi = d.Square(frame)
+            key = (d.roi, d.blur)
+            if key not in classified:
+                classified[key] = self.Classify(roi)
+            d.Count(classified[key], self.Bit(d.name), roi)
+
+def boxCells(bounds, bits):
+    """ Returns the (n, n, n) boolean grid of the cells whose center is inside the BGR box """
+    size = 1 << (8 - bits)
+    centers = np.arange(1 << bits) * size + (size - 1) / 2
+    inside = [(centers >= lo) & (centers <= hi) for lo, hi in zip(*bounds)]
+    return inside[0][:, None, None] & inside[1][None, :, None] & inside[2][None, None, :]
+
+def sampleCells(pixels, bits, minCount = 1, grow = 1):
+    """ Returns the grid of the cells holding at least minCount of the BGR pixels,
+    grown by grow cells to each side to cover the colors between the samples """
+
+    n = 1 << bits
+    q = (np.asarray(pixels, dtype = np.int32).reshape(-1, 3) >> (8 - bits))
+    counts = np.bincount((q[:, 0] << (2 * bits)) + (q[:, 1] << bits) + q[:, 2], minlength = n ** 3)
+    cells = (counts >= minCount).reshape(n, n, n)
+
+    for axis in range(3):
+        grown = cells.copy()
+        for shift in range(1, grow + 1):
+            for sgn in (1, -1):
+                moved = np.roll(cells, sgn * shift, axis)
+                # No wrapping around the edge of the color space
+                edge = [slice(None)] * 3
+                edge[axis] = slice(0, shift) if sgn > 0 else slice(n - shift, n)
+                moved[tuple(edge)] = False
+                grown |= moved
+        cells = grown
+    return cells
+
+def buildTable(names, definitions = None, bits = BITS, samples = None):
+    """ Returns the table of the classes: the boxes of their definitions (the
+    tuned ones by default) joined with the cells of their labeled sample pixels (name -> pixels) """
+
+    if definitions is None:
+        definitions = loadDefinitions()
+    n = 1 << bits
+    table = np.zeros((n, n, n), dtype = np.uint8)
+    for i, name in enumerate(names):
+        cells = boxCells(definitions[name]['bounds'], bits)
+        if samples and name in samples:
+            cells |= sampleCells(samples[name], bits)
+        table[cells] |= 1 << i
+    return ColorTable(names, table)
+
+def loadSamples(directory):
+    """ Reads the labeled samples: images named <class>_*.png on a black
+    background, every other pixel is a sample of the class """
+
+    samples = {}
+    for path in listImages(directory):
+        name = os.path.basename(path).split('_')[0]
+        image = cv2.imread(path)
+        if image is not None:
+            pixels = image[image.any(axis = 2)]
+            samples[name] = np.vstack([samples[name], pixels]) if name in samples else pixels
+    return samples
+
+def tableKey(names, definitions, bits, samples):
+    h = hashlib.sha1()
+    h.update(json.dumps({ 'names' : list(names),
+                          'bounds': [definitions[name]['bounds'] for name in names],
+                          'bits'  : bits }, sort_keys = True).encode())
+    for name in sorted(samples or {}):
+        h.update(name.encode())
+        h.update(np.ascontiguousarray(samples[name], dtype = np.uint8).tobytes())
+    return h.hexdigest()[:16]
+
+def loadTable(names, definitions = None, bits = BITS, samples = None, cache = TABLE_CACHE):
+    """ Returns the table of the classes, built once and cached on disk
+    under the hash of everything it is built from """
+
+    if definitions is None:
+        definitions = loadDefinitions()
+    path = os.path.join(cache, 'table_' + tableKey(names, definitions, bits, samples) + '.npy')
+    try:
+        return ColorTable(names, np.load(path))
+    except (OSError, ValueError):
+        pass
+
+    table = buildTable(names, definitions, bits, samples)
+    try:
+        os.makedirs(cache, exist_ok = True)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, table.table.reshape((1 << bits,) * 3))
+        os.replace(tmp, path)
+    except OSError:
+        pass
+    return table
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--samples', help = 'directory with labeled sample images')
+    ap.add_argument('--bits', type = int, default = BITS)
+    args = ap.parse_args()
+
+    names = list(DETECTORS)
+    samples = loadSamples(args.samples) if args.samples else None
+    table = loadTable(names, bits = args.bits, samples = samples)
+    for name in names:
+        print('%-6s %7d cells' % (name, np.count_nonzero(table.table & table.Bit(name))))
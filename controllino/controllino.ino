@@ -4,6 +4,13 @@
 
 // Horizontalni, vertikalni, kamera, platno
 // Za svaki motor se konfigurira (način rada, pull pin, direction pin)
+// NAPOMENA: Svi motori dijele direction pin 6, a od istovremenog kretanja (MoveTogether)
+// motori koraju naizmjence, često u suprotnim smjerovima. AccelStepper prije svakog koraka
+// postavlja DIR pa STEP (digitalWrite na AVR-u traje ~4 us), a driver DIR očitava na rastućem
+// bridu STEP-a. To je ispravno samo ako je vrijeme postavljanja DIR-a drivera (setup) kraće od
+// ~4 us, a zadržavanja (hold) kraće od širine impulsa (setMinPulseWidth, zadano 1 us).
+// Prije istovremenog pokretanja provjeriti specifikaciju drivera i na uređaju izmjeriti da
+// vodoravni motor i kamera u suprotnim smjerovima ne gube korake (Home$ prije i poslije).
 AccelStepper Steppers[4] = {
   AccelStepper(1, 5, 6),
   AccelStepper(1, 7, 6),
@@ -11,12 +18,18 @@ AccelStepper Steppers[4] = {
   AccelStepper(1, 8, 6)
 };
 
-long ind = 0;                                   // Indeks aktivnog motora
+long ind = 0;                                   // Indeks motora posljednje naredbe
 long Acc[4]   = {800, 1600, 900, 1000};         // Akceleracije motora
 long MaxSp[4] = {1200, 800, 300, 1000};         // Maksimalne brzine motora
 long lowerCameraSpeed = 10;                     // Sporija brzina za kameru
+long travelSpeed = 3000;                        // Brža brzina vodoravnog motora do poznatih biljaka
 // NAPOMENA: Promjene brzine i akceleracije unijeti u controls.py 
 
+// Broj primljenih naredbi (M, S) i kretanje prema cilju za svaki motor
+// Kad motor dođe do cilja javlja se "Done$<motor>$<pozicija>$<broj naredbi>"
+long commands[4] = {0, 0, 0, 0};
+bool moving[4]   = {false, false, false, false};
+
 // Konfiguracija svjetla
 int lightsPin = 19;
 bool lightsOn = false;
@@ -62,9 +75,14 @@ void loop() {
                 int d1 = S.indexOf('$');
                 long stepSize = S.substring(d1 + 1).toInt();
                 Steppers[ind].move(stepSize);  
+                commands[ind]++;
+                moving[ind] = true;
             }    
-            else if (com == 'S')
+            else if (com == 'S') {
                 Steppers[ind].stop();
+                commands[ind]++;
+                moving[ind] = true;
+            }
             else if (com == 'H'){
                 Serial.print("Home$");
                 Serial.println(Steppers[ind].currentPosition());
@@ -76,6 +94,9 @@ void loop() {
         else if (S[0] == 'C'){
             Steppers[2].setMaxSpeed(S[1] == '1' ? MaxSp[2] : lowerCameraSpeed);  
         }
+        else if (S[0] == 'T'){
+            Steppers[0].setMaxSpeed(S[1] == '1' ? travelSpeed : MaxSp[0]);
+        }
     }
 
     unsigned long long now = millis();
@@ -86,8 +107,29 @@ void loop() {
     }
     
     digitalWrite(lightsPin, lightsOn ? HIGH : LOW);
-    Steppers[ind].run();
 
-   if(abs(Steppers[ind].distanceToGo()) < .1)
-      Steppers[ind].disableOutputs();
+    // Svi motori se pokreću istovremeno
+    bool anyRunning = false;
+    for (int i = 0; i < 4; i++)
+    {
+        Steppers[i].run();
+
+        if (moving[i] && Steppers[i].distanceToGo() == 0)
+        {
+            moving[i] = false;
+            Serial.print("Done$");
+            Serial.print(i);
+            Serial.print("$");
+            Serial.print(Steppers[i].currentPosition());
+            Serial.print("$");
+            Serial.println(commands[i]);
+        }
+
+        if (Steppers[i].distanceToGo() != 0)
+            anyRunning = true;
+    }
+
+    // Motori dijele enable pin pa se isključuju tek kad svi stanu
+    if (!anyRunning)
+        Steppers[ind].disableOutputs();
 }
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+#######################################
+# Virtual Controllino on a pseudo-terminal, speaking the protocol of
+# controllino/controllino.ino. Positions are in motor steps.
+# USAGE:
+# python3 controllinoSimulator.py --scale 20 --runs 3
+#######################################
+
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+import tty
+import cv2
+import numpy as np
+
+# Configuration of controllino/controllino.ino
+ACCELS = [800, 1600, 900, 1000]
+MAX_SPEEDS = [1200, 800, 300, 1000]
+LOWER_CAMERA_SPEED = 10
+TRAVEL_SPEED = 3000
+METAL_INTERVAL = .5
+CAMERA_STEPS_PER_DEG = 1600 / 360
+
+# Metal sensor layout: ranges of positions (in steps) per motor where the sensor is HIGH
+# Horizontal: end of the rail at -600 cm and the main path at +2 cm
+# Vertical: top at +5 cm and bottom at -120 cm
+DEFAULT_METAL = { 0: [(-10 ** 9, -600 * 2500), (2 * 2500, 10 ** 9)],
+                  1: [(round(5 * 371.5), 10 ** 9), (-10 ** 9, round(-120 * 371.5))] }
+
+# Plants: (side, horizontal position, vertical position of the plant top) in steps
+# Side 180 is seen with the camera rotated by 180 deg, side 0 without rotation
+DEFAULT_PLANTS = [(side, -x * 2500, round(-h * 371.5)) for side in (180, 0)
+                  for (x, h) in [(60, 75), (160, 80), (260, 70), (380, 85), (500, 78)]]
+
+class SimStepper:
+    def __init__(self, accel, maxSpeed):
+        """ Trapezoidal speed profile of an AccelStepper """
+        self.accel = accel
+        self.maxSpeed = maxSpeed
+        self.position = 0.0
+        self.target = 0
+        self.speed = 0.0
+
+    def currentPosition(self):
+        return round(self.position)
+
+    def distanceToGo(self):
+        return self.target - self.currentPosition()
+
+    def move(self, steps):
+        self.target = self.currentPosition() + steps
+
+    def stop(self):
+        if self.speed != 0:
+            stepsToStop = int(self.speed * self.speed / (2 * self.accel)) + 1
+            self.move(stepsToStop if self.speed > 0 else -stepsToStop)
+
+    def run(self, dt):
+        """ Advances the motor by dt secs """
+
+        dist = self.target - self.position
+        if self.speed == 0 and abs(dist) < .5:
+            return
+
+        direction = 1 if dist > 0 else -1
+        stopping = self.speed * self.speed / (2 * self.accel)
+
+        if self.speed * direction < 0 or stopping >= abs(dist):
+            # Decelerating
+            slower = abs(self.speed) - self.accel * dt
+            self.speed = max(slower, 0) * (1 if self.speed > 0 else -1)
+            if self.speed == 0:
+                self.speed = direction * self.accel * dt
+        else:
+            self.speed = direction * min(abs(self.speed) + self.accel * dt, self.maxSpeed)
+
+        self.position += self.speed * dt
+
+        # Reaching the target within one step
+        if (self.target - self.position) * direction <= .5 and abs(self.speed) <= self.accel * dt * 2 + 1:
+            self.position = float(self.target)
+            self.speed = 0.0
+
+class VirtualControllino:
+    def __init__(self, timeScale = 1, metal = DEFAULT_METAL, tick = .002):
+        """ Opens a pseudo-terminal and runs the firmware model in simulated time,
+        which passes timeScale times faster than real time """
+
+        self.timeScale = timeScale
+        self.metal = metal
+        self.tick = tick
+        self.steppers = [SimStepper(ACCELS[i], MAX_SPEEDS[i]) for i in range(4)]
+        self.commands = [0, 0, 0, 0]
+        self.moving = [False, False, False, False]
+        self.lightsOn = False
+        self.lastMetalWrite = -METAL_INTERVAL
+        self.simTime = 0.0
+        self.metalCnt = 0
+        # Positions shared with a SimulatedCamera in the vision process
+        self.positions = multiprocessing.get_context('spawn').RawArray('d', 4)
+
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.slave = slave
+        self.port = os.ttyname(slave)
+
+        self.lock = threading.Lock()
+        self.running = False
+        self.T_serial = threading.Thread(target = self.serialLoop, daemon = True)
+        self.T_motors = threading.Thread(target = self.motorLoop, daemon = True)
+
+    def Start(self):
+        self.running = True
+        self.T_serial.start()
+        self.T_motors.start()
+
+    def Close(self):
+        self.running = False
+        self.T_motors.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def Now(self):
+        """ Simulated time in secs """
+        return self.simTime
+
+    def Position(self, motor):
+        return self.steppers[motor].position
+
+    def write(self, msg):
+        os.write(self.master, bytes(msg + '\r\n', encoding = "utf8"))
+
+    def serialLoop(self):
+        buf = b''
+        while self.running:
+            try:
+                buf += os.read(self.master, 64)
+            except OSError:
+                return
+
+            while b'#' in buf:
+                cmd, buf = buf.split(b'#', 1)
+                with self.lock:
+                    self.handle(cmd.decode(errors = 'replace').strip('\0'))
+
+    def handle(self, S):
+        if not S:
+            return
+
+        if S[0] == 'M' and len(S) >= 3:
+            ind = int(S[1])
+            com = S[2]
+            stepper = self.steppers[ind]
+
+            if com == 'M':
+                d1 = S.find('$')
+                stepper.move(int(S[d1 + 1:]) if d1 >= 0 else 0)
+                self.commands[ind] += 1
+                self.moving[ind] = True
+            elif com == 'S':
+                stepper.stop()
+                self.commands[ind] += 1
+                self.moving[ind] = True
+            elif com == 'H':
+                self.write('Home$' + str(stepper.currentPosition()))
+        elif S[0] == 'L':
+            self.lightsOn = S[1:2] == '1'
+        elif S[0] == 'C':
+            self.steppers[2].maxSpeed = MAX_SPEEDS[2] if S[1:2] == '1' else LOWER_CAMERA_SPEED
+        elif S[0] == 'T':
+            self.steppers[0].maxSpeed = TRAVEL_SPEED if S[1:2] == '1' else MAX_SPEEDS[0]
+
+    def metalPin(self):
+        for motor, ranges in self.metal.items():
+            pos = self.steppers[motor].position
+            if any(lo <= pos <= hi for (lo, hi) in ranges):
+                return True
+        return False
+
+    def motorLoop(self):
+        last = time.perf_counter()
+        while self.running:
+            time.sleep(self.tick)
+            now = time.perf_counter()
+            elapsed = (now - last) * self.timeScale
+            last = now
+
+            with self.lock:
+                # Integrating with steps of at most 2 ms of simulated time
+                n = max(1, int(elapsed / .002))
+                dt = elapsed / n
+                for i in range(n):
+                    for s in self.steppers:
+                        s.run(dt)
+                self.simTime += elapsed
+                self.positions[:] = [s.position for s in self.steppers]
+
+                for i, s in enumerate(self.steppers):
+                    if self.moving[i] and s.distanceToGo() == 0:
+                        self.moving[i] = False
+                        self.write('Done$%d$%d$%d' % (i, s.currentPosition(), self.commands[i]))
+
+                if self.simTime - self.lastMetalWrite >= METAL_INTERVAL and self.metalPin():
+                    self.write('Metal$')
+                    self.lastMetalWrite = self.simTime
+                    self.metalCnt += 1
+
+class SimulatedCamera:
+    def __init__(self, sim, plants = DEFAULT_PLANTS, size = (480, 640), fps = 30, pixelsPerCm = 20):
+        """ Video capture rendering the red wires and green plants of the layout
+        seen from the current positions of the simulated motors. It keeps only
+        the shared positions of sim, so it can be handed to the vision process. """
+
+        self.positions = sim.positions
+        self.timeScale = sim.timeScale
+        self.plants = plants
+        self.size = size
+        self.fps = fps
+        self.pixelsPerCm = pixelsPerCm
+        self.opened = True
+        self.last = 0
+
+    def isOpened(self):
+        return self.opened
+
+    def release(self):
+        self.opened = False
+
+    def read(self):
+        # Frames arrive at fps frames per simulated second
+        wait = self.last + 1 / (self.fps * self.timeScale) - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        self.last = time.perf_counter()
+
+        rows, cols = self.size
+        frame = np.zeros((rows, cols, 3), dtype = "uint8")
+        x = self.positions[0] / 2500
+        y = self.positions[1] / 371.5
+        angle = self.positions[2] / CAMERA_STEPS_PER_DEG
+
+        for (side, px, py) in self.plants:
+            if abs(angle - side) > 30:
+                continue
+
+            # The camera turned by 180 degrees sees a horizontal move mirrored
+            mirror = 1 if side == 180 else -1
+            col = round(cols / 2 + mirror * (px / 2500 - x) * self.pixelsPerCm)
+            top = round(rows / 2 + (y - py / 371.5) * self.pixelsPerCm)
+            if -200 < col < cols + 200:
+                # Plant below its top and the red wire above it
+                cv2.rectangle(frame, (col - 120, max(top, 0)), (col + 120, rows), (30, 160, 40), -1)
+                cv2.rectangle(frame, (col - 6, 0), (col + 6, rows), (20, 20, 200), -1)
+
+        return True, frame
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--scale', type = float, default = 20, help = 'simulated secs per real sec')
+    ap.add_argument('--runs', type = int, default = 1)
+    ap.add_argument('--path', default = '/tmp/igrower-sim/', help = 'folder for the pictures')
+    args = ap.parse_args()
+
+    import runSystem
+
+    sim = VirtualControllino(args.scale)
+    sim.Start()
+    print('Virtual Controllino on', sim.port)
+
+    runSystem.TIME_SCALE = args.scale
+    for i in range(args.runs):
+        start, simStart = time.time(), sim.Now()
+        runSystem.run(port = sim.port, camera = SimulatedCamera(sim), path = args.path, report = False)
+        real, simulated = time.time() - start, sim.Now() - simStart
+        print('Run %d: %.1f secs real, %.1f secs simulated (%.1fx)' % (i + 1, real, simulated, simulated / real))
+
+    sim.Close()
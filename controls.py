@@ -2,19 +2,117 @@
 
 import serial
 import time
-import datetime
+import threading
+import queue
+from tracing import traced
+from logWriter import logger
 
 DEBUG_OUTPUT = 1
-output_file = None
 
 def debug_print(msg):
     if DEBUG_OUTPUT:
-        print('(' + str(datetime.datetime.now())[:-7:]+ ')', msg, flush = True, file = output_file)
+        logger.Log(msg)
+
+class Motion:
+    def __init__(self, controls, motor, number, estimate):
+        """ Handle of a motor command, completed when the firmware reports
+        'Done$<motor>$<position>$<count>' for the motor with a count of received
+        commands not lower than the number of this command """
+        self.controls = controls
+        self.motor = motor
+        self.number = number
+        self.estimate = estimate
+        self.start = time.time()
+        self.position = None
+        self.done = threading.Event()
+
+    def Complete(self, position):
+        self.position = position
+        self.done.set()
+
+    def IsDone(self):
+        return self.done.is_set()
+
+    def Timeout(self, margin = 5):
+        """ Secs left until the estimated duration of the command plus margin """
+        return max(self.start + self.estimate + margin - time.time(), 0)
+
+    @traced('Motion.Wait')
+    def Wait(self, timeout = None):
+        """ Waits until the motor reaches its target, at most timeout secs.
+        An old firmware does not report it, so in that case it sleeps until
+        the estimated end or timeout (returning earlier if a report arrives).
+        Returns whether the completion was reported """
+
+        if self.controls.acknowledges:
+            return self.done.wait(self.Timeout() if timeout is None else timeout)
+
+        self.done.wait(self.Timeout(0) if timeout is None else timeout)
+        return self.done.is_set()
+
+class MotionGroup:
+    def __init__(self, controls, motions):
+        """ Handle of commands started on several motors at once """
+        self.controls = controls
+        self.motions = motions
+
+    def IsDone(self):
+        return all(m.IsDone() for m in self.motions)
+
+    def AnyDone(self):
+        return any(m.IsDone() for m in self.motions)
+
+    def Timeout(self, margin = 5):
+        """ Upper bound of the duration of the slowest command in secs """
+        return max(m.Timeout(margin) for m in self.motions)
+
+    def Wait(self, timeout = None):
+        """ Waits until all motors reach their targets, at most timeout secs.
+        Returns whether all completions were reported """
+
+        if timeout is None:
+            return all([m.Wait() for m in self.motions])
+
+        deadline = time.time() + timeout
+        return all([m.Wait(max(deadline - time.time(), 0)) for m in self.motions])
+
+    def WaitAny(self, timeout = None):
+        """ Waits until any of the motors reaches its target, at most timeout secs.
+        Without completion reports it waits for the shortest estimated time.
+        Returns the first finished Motion or None """
+
+        if timeout is None:
+            timeout = min(m.Timeout(5 if self.controls.acknowledges else 0) for m in self.motions)
+
+        with self.controls.doneCond:
+            self.controls.doneCond.wait_for(self.AnyDone, timeout)
+
+        for m in self.motions:
+            if m.IsDone():
+                return m
+        return None
 
 class Controls:
-    def __init__(self, port, out_file = None):
-        """ Opening the serial port """
+    def __init__(self, port):
+        """ Opening the serial port and starting the reader thread.
+        The reader thread is the only consumer of the serial port. It passes
+        'Metal$' messages to the subscribed callbacks as soon as they arrive
+        and routes 'Home$' replies to AskPosition and 'Done$' to the motions. """
         self.started = False
+        self.running = False
+        # Reentrant, so that a signal handler can stop the motors while the main thread writes
+        self.writeLock = threading.RLock()
+        self.askLock = threading.Lock()
+        self.homeReplies = queue.Queue()
+        self.subscribers = {}
+        self.metalSeen = False
+        # Motions waiting for 'Done$' and the number of sent motor commands per motor.
+        # The firmware reports completion if any 'Done$' was received
+        self.motions = {}
+        self.commands = [0, 0, 0, 0]
+        self.motionLock = threading.Lock()
+        self.doneCond = threading.Condition()
+        self.acknowledges = False
         try:
             self.ser = serial.Serial(port, timeout=.1)
             self.started = True
@@ -29,52 +127,128 @@ class Controls:
         self.speeds = [1200, 800, 300, 1700]
         self.higherCameraSpeed = 300
         self.lowerCameraSpeed = 10
+        # Horizontal speed while searching and for driving to a known position
+        self.searchSpeed = 1200
+        self.travelSpeed = 3000
         # Time needed to accelerate and decelerate to maximum speed
         self.delay = [2 * self.speeds[i] / self.accels[i] for i in range(4)]
         
         # Current position of the motor from the last query
         self.lastReadHome = ""
 
-        # Debug output file
-        global output_file
-        output_file = out_file
-             
+        if self.started:
+            self.running = True
+            self.T_read = threading.Thread(target = self.readLoop, daemon = True)
+            self.T_read.start()
+
+    def readLoop(self):
+        """ Reads the serial port line by line and dispatches the messages """
+
+        buf = b''
+        while self.running:
+            try:
+                buf += self.ser.readline()
+            except Exception as e:
+                if self.running:
+                    debug_print(str(e))
+                    time.sleep(.1)
+                continue
+
+            # Timeout of the serial port can split a line
+            if not buf.endswith(b'\n'):
+                continue
+
+            line = buf.decode(errors = 'replace').strip()
+            buf = b''
+            if line:
+                self.dispatch(line)
+
+    def dispatch(self, line):
+        """ Handles a message of form 'Name$arg1$arg2...' """
+
+        # 'Metal$' has no arguments, the trailing separator is dropped
+        fields = line.rstrip('$').split('$')
+        name, args = fields[0], fields[1:]
+
+        if name == 'Metal':
+            self.metalSeen = True
+        elif name == 'Home':
+            self.homeReplies.put(args[0])
+        elif name == 'Done':
+            self.acknowledges = True
+            motor = int(args[0])
+            count = int(args[2]) if len(args) > 2 else self.commands[motor]
+            with self.motionLock:
+                pending = self.motions.get(motor, [])
+                done = [m for m in pending if m.number <= count]
+                self.motions[motor] = [m for m in pending if m.number > count]
+            for m in done:
+                m.Complete(int(args[1]))
+            with self.doneCond:
+                self.doneCond.notify_all()
+
+        for callback in self.subscribers.get(name, []):
+            # A failing subscriber must not stop the reader thread
+            try:
+                callback(*args)
+            except Exception as e:
+                debug_print('Handling of ' + line + ' failed: ' + str(e))
+
+        if name == 'Metal':
+            debug_print('* Metal is detected *')
+
+    def Subscribe(self, name, callback):
+        """ Calls callback(*args) from the reader thread for every message 'name$args' """
+        self.subscribers.setdefault(name, []).append(callback)
+
     def ReadValues(self):
-        """ Reads all the values sent through Serial and returns
-        True - in case metal pin was activated
+        """ Returns
+        True - in case metal pin was activated since the last call
         False - otherwise """
-        
-        lines = self.ser.readlines()
-        lines = list(map(bytes.decode, lines))
-        isMetal = False
-        
-        for l in lines:
-            d = l.find('$')
-            if l[:d:] == 'Metal':
-                isMetal = True
-                debug_print('* Metal is detected *')
-            elif l[:d:] == 'Home':
-                self.lastReadHome = l[d + 1::]
-                
+
+        isMetal = self.metalSeen
+        self.metalSeen = False
         return isMetal
-                
+
+    def write(self, send):
+        with self.writeLock:
+            self.ser.write(bytes(send, encoding="utf8"))
+
     def Close(self):
-        """ Closing the serial port """
+        """ Stopping the reader thread and closing the serial port """
+        self.running = False
+        if self.started:
+            self.T_read.join()
         self.ser.close()
-    
+
+    def AskSteps(self, motor):
+        """ Returns current position of the motor in steps """
+        send = 'M' + str(motor) + 'H' + '\0#'
+
+        with self.askLock:
+            # Dropping replies which nobody waited for
+            while not self.homeReplies.empty():
+                self.homeReplies.get_nowait()
+
+            self.write(send)
+
+            # Waiting for the response from Arduino
+            try:
+                self.lastReadHome = self.homeReplies.get(timeout = 2)
+            except queue.Empty:
+                debug_print('No response for the position of motor ' + str(motor) + '.')
+
+        return int(self.lastReadHome)
+
+    @traced('Controls.AskPosition')
     def AskPosition(self, motor):
         """ Returns current position of the motor in its unit (cm or deg) """
-        send = 'M' + str(motor) + 'H' + '\0#'
-        self.ser.write(bytes(send, encoding="utf8"))
-        
-        # Waiting for the response from Arduino
-        time.sleep(1)
-        self.ReadValues()
-        home = int(self.lastReadHome) / self.units[motor]
+        home = self.AskSteps(motor) / self.units[motor]
         debug_print('Current position for motor' + str(motor) + ' is ' + str(home))
         
         return home
     
+    @traced('Controls.Move')
     def Move(self, motor, command, step = 0, wait = False):
         """ Sends a command to a motor
         Possible values for motor:
@@ -87,27 +261,53 @@ class Controls:
             'S' - Stop
             'H' - Home
         step - number of centimeters (degrees in case of camera) to move
-        wait - True / False for waiting until the command finishes """
+        wait - True / False for waiting until the command finishes
+        Returns the Motion handle of the command """
         
         step = round(step * self.units[motor])
         send = 'M' + str(motor) + command + ('$' + str(step) if step != 0 else '') + '\0#'
-        self.ser.write(bytes(send, encoding="utf8"))
+        sleep_time = abs(step) / self.speeds[motor] + self.delay[motor]
+
+        # The home command is sent by AskSteps, which waits for the response
+        if command != 'H':
+            with self.motionLock:
+                self.commands[motor] += 1
+                motion = Motion(self, motor, self.commands[motor], sleep_time)
+                self.motions.setdefault(motor, []).append(motion)
+                self.write(send)
         debug_print('COMMAND: ' + str(send))
         
         if command == 'H':
-            # Waiting for the response from Arduino
-            time.sleep(1)
-            self.ReadValues()
-            home = int(self.lastReadHome) / self.units[motor]
+            home = self.AskSteps(motor) / self.units[motor]
             debug_print('Current position:' + str(home))
-            self.Move(motor, 'M', -1 * home, wait = True)
+            return self.Move(motor, 'M', -1 * home, wait = wait)
             
-        sleep_time = abs(step) / self.speeds[motor] + self.delay[motor]
         if wait == True:
             debug_print('Waiting: ' + str(sleep_time))
-            time.sleep(sleep_time)
+            if not motion.Wait() and self.acknowledges:
+                debug_print('Motor ' + str(motor) + ' did not report reaching its target.')
             
-        return sleep_time
+        return motion
+
+    def MoveTogether(self, commands, wait = False):
+        """ Starts commands (motor, command, step) on several motors at once,
+        the firmware runs all motors simultaneously. The motors share one direction
+        pin, see the note in controllino.ino before relying on opposite directions.
+        wait - True / False for waiting until all the commands finish
+        Returns the MotionGroup handle of the commands """
+
+        group = MotionGroup(self, [self.Move(motor, command, step) for (motor, command, step) in commands])
+        if wait == True:
+            group.Wait()
+
+        return group
+
+    def StopAll(self):
+        """ Sends the stop command to every motor, without waiting for anything,
+        so it can be called from a signal handler """
+
+        for motor in range(4):
+            self.write('M' + str(motor) + 'S' + '\0#')
 
     def Lights(self, val):
         """ Sends command 'L0' or 'L1' for toggling the lights.
@@ -115,7 +315,7 @@ class Controls:
             0 - OFF
             1 - ON """
         
-        self.ser.write(bytes('L' + str(val) + '\0#', encoding="utf8"))
+        self.write('L' + str(val) + '\0#')
         
     def CameraSpeed(self, val):
         """ Sends command 'C0' or 'C1' for changing the camera speed.
@@ -123,9 +323,19 @@ class Controls:
             0 - Lower speed
             1 - Higher speed """
         
-        self.ser.write(bytes('C' + str(val) + '\0#', encoding="utf8"))
+        self.write('C' + str(val) + '\0#')
         self.speeds[2] = self.higherCameraSpeed if val else self.lowerCameraSpeed
 
+    def TravelSpeed(self, val):
+        """ Sends command 'T0' or 'T1' for changing the horizontal speed.
+        Possible values for val:
+            0 - Search speed
+            1 - Travel speed """
+
+        self.write('T' + str(val) + '\0#')
+        self.speeds[0] = self.travelSpeed if val else self.searchSpeed
+        self.delay[0] = 2 * self.speeds[0] / self.accels[0]
+
 if __name__ == "__main__":
     C = Controls("/dev/ttyACM0")
     print(C.started)
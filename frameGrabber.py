@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import cv2
+
+# The scene is stable when between STABLE_FRAMES consecutive thumbnails the mean
+# brightness changes less than BRIGHTNESS_TOLERANCE gray levels and less than
+# MOTION_TOLERANCE of the pixels change by more than MOTION_LEVEL gray levels
+STABLE_FRAMES = 3
+BRIGHTNESS_TOLERANCE = 1
+MOTION_LEVEL = 8
+MOTION_TOLERANCE = .002
+THUMBNAIL_SIZE = (160, 120)
+# Frames read at most for a full resolution still (device mode) before the
+# detection frame is taken instead, e.g. when the camera refuses the full size
+STILL_READS = 10
+
+def thumbnail(frame):
+    """ Returns the small gray image compared between consecutive frames """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, THUMBNAIL_SIZE, interpolation = cv2.INTER_AREA)
+
+def steady(thumb, previous):
+    """ Returns whether nothing moved and the exposure did not change between the thumbnails """
+    if abs(float(thumb.mean()) - float(previous.mean())) > BRIGHTNESS_TOLERANCE:
+        return False
+    moved = cv2.countNonZero(cv2.threshold(cv2.absdiff(thumb, previous), MOTION_LEVEL, 255, cv2.THRESH_BINARY)[1])
+    return moved <= MOTION_TOLERANCE * thumb.size
+
+def sharpness(frame):
+    """ Returns the variance of the Laplacian of the frame, higher is sharper """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    mean, std = cv2.meanStdDev(cv2.Laplacian(gray, cv2.CV_16S))
+    return float(std[0][0]) ** 2
+
+class FrameGrabber:
+    def __init__(self, cam, levels = 0, detectSize = None):
+        """ The only reader of the video capture cam.
+        A thread grabs frames continuously and publishes two streams, each frame
+        with its sequence number and timestamp:
+          detection frames (Latest, WaitNewer) - downscaled for the detectors
+          stills (WaitAfter) - full resolution for the pictures
+        levels - pyramid levels of the detection frames, each one halves the size
+        detectSize - (width, height) of the device mode: the camera streams at this
+        low resolution and switches to its full resolution only for a still
+        Frames are shared without copying, so consumers must not modify them. """
+
+        self.cam = cam
+        self.levels = levels
+        self.detectSize = detectSize
+        self.fullSize = None
+        self.cond = threading.Condition()
+        self.frame = None
+        self.seq = 0
+        self.stamp = 0
+        self.still = None
+        self.stillSeq = 0
+        self.stillStamp = 0
+        # Times after which stills are awaited (device mode)
+        self.stillWanted = []
+        self.failures = 0
+        # Stills which fell back to the detection size
+        self.stillFallbacks = 0
+        self.running = False
+        self.T_grab = threading.Thread(target = self.grabLoop, daemon = True)
+
+    def Start(self):
+        if self.detectSize is not None:
+            self.fullSize = (int(self.cam.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cam.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+            self.setSize(self.detectSize)
+        self.running = True
+        self.T_grab.start()
+
+    def Stop(self):
+        """ Stops grabbing and releases the video capture """
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.T_grab.is_alive():
+            self.T_grab.join()
+        self.cam.release()
+
+    def isOpened(self):
+        return self.running and self.cam.isOpened()
+
+    def Scale(self):
+        """ Returns the size of the detection frames relative to the stills """
+        if self.detectSize is not None:
+            return self.detectSize[0] / self.fullSize[0]
+        return .5 ** self.levels
+
+    def setSize(self, size):
+        self.cam.set(cv2.CAP_PROP_FRAME_WIDTH, size[0])
+        self.cam.set(cv2.CAP_PROP_FRAME_HEIGHT, size[1])
+
+    def read(self):
+        # Timestamp of a frame is the moment its read started, so a frame
+        # stamped after T was certainly exposed after T
+        stamp = time.time()
+        ret, frame = self.cam.read()
+        if not ret:
+            self.failures += 1
+            time.sleep(.1)
+            return None, stamp
+        return frame, stamp
+
+    def grabStill(self):
+        """ Switches the camera to full resolution for one frame. Without a full
+        resolution frame within STILL_READS reads the last frame read is the still. """
+        self.setSize(self.fullSize)
+        frame = fallback = None
+        try:
+            for i in range(STILL_READS):
+                if not (self.running and self.cam.isOpened()):
+                    break
+                frame, stamp = self.read()
+                if frame is None:
+                    continue
+                if frame.shape[1] == self.fullSize[0]:
+                    break
+                # Frames still queued in the driver have the low resolution
+                fallback, fallbackStamp = frame, stamp
+                frame = None
+        finally:
+            self.setSize(self.detectSize)
+
+        if frame is None and fallback is not None:
+            frame, stamp = fallback, fallbackStamp
+            self.stillFallbacks += 1
+
+        if frame is not None:
+            with self.cond:
+                self.still = frame
+                self.stillSeq += 1
+                self.stillStamp = stamp
+                self.cond.notify_all()
+
+    def grabLoop(self):
+        while self.running and self.cam.isOpened():
+            if self.detectSize is not None and time.time() >= min(self.stillWanted, default = float('inf')):
+                self.grabStill()
+                continue
+
+            frame, stamp = self.read()
+            if frame is None:
+                continue
+
+            # Area interpolation is a few times cheaper than repeated pyrDown
+            small = frame
+            if self.levels:
+                small = cv2.resize(frame, (0, 0), fx = self.Scale(), fy = self.Scale(), interpolation = cv2.INTER_AREA)
+
+            with self.cond:
+                self.frame = small
+                self.seq += 1
+                self.stamp = stamp
+                if self.detectSize is None:
+                    self.still = frame
+                    self.stillSeq = self.seq
+                    self.stillStamp = stamp
+                self.cond.notify_all()
+
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    def Latest(self):
+        """ Returns (seq, stamp, frame) of the newest detection frame """
+        with self.cond:
+            return self.seq, self.stamp, self.frame
+
+    def WaitNewer(self, seq, timeout = None):
+        """ Waits for a detection frame newer than the sequence number seq.
+        Returns (seq, stamp, frame), frame is None on timeout or when stopped """
+
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > seq or not self.running, timeout)
+            if self.seq > seq:
+                return self.seq, self.stamp, self.frame
+            return seq, 0, None
+
+    def WaitAfter(self, t, timeout = None):
+        """ Waits for the first full resolution still captured after the time t.
+        Returns (seq, stamp, frame), frame is None on timeout or when stopped """
+
+        with self.cond:
+            self.stillWanted.append(t)
+            try:
+                self.cond.wait_for(lambda: self.stillStamp >= t or not self.running, timeout)
+            finally:
+                self.stillWanted.remove(t)
+            if self.stillStamp >= t:
+                return self.stillSeq, self.stillStamp, self.still
+            return self.stillSeq, 0, None
+
+    def WaitStable(self, t, timeout = None, burst = 1):
+        """ Waits until the scene captured after the time t is stable and returns the
+        first still of the stable scene. If it is not stable within timeout secs,
+        the sharpest of burst consecutive stills is returned instead.
+        Returns (seq, stamp, frame, info), frame is None when stopped. info has the
+        secs waited, the detection frames checked, whether the scene was stable,
+        the sharpness of the still and the number of stills compared. """
+
+        start = time.time()
+        deadline = None if timeout is None else start + timeout
+        seq = self.Latest()[0]
+        previous = None
+        quiet = 0
+        checked = 0
+        stable = None
+        while self.running and (deadline is None or time.time() < deadline):
+            seq, stamp, frame = self.WaitNewer(seq, None if deadline is None else max(deadline - time.time(), 0))
+            if frame is None or stamp < t:
+                continue
+            thumb = thumbnail(frame)
+            checked += 1
+            if previous is not None and steady(thumb, previous):
+                quiet += 1
+            else:
+                quiet = 0
+            previous = thumb
+            if quiet >= STABLE_FRAMES:
+                stable = stamp
+                break
+
+        best = None
+        stills = 0
+        after = t if stable is None else stable
+        for i in range(1 if stable is not None else burst):
+            stillSeq, stillStamp, still = self.WaitAfter(after, timeout)
+            if still is None:
+                break
+            stills += 1
+            score = sharpness(still)
+            if best is None or score > best[0]:
+                best = (score, stillSeq, stillStamp, still)
+            # The next still of the burst is a newer one
+            after = stillStamp + 1e-6
+
+        info = { 'secs'     : time.time() - start,
+                 'frames'   : checked,
+                 'stable'   : stable is not None,
+                 'sharpness': None if best is None else best[0],
+                 'stills'   : stills }
+        if best is None:
+            return seq, 0, None, info
+        return best[1], best[2], best[3], info
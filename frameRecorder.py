@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+#######################################
+# Recording of the detection frames in rolling memory-mapped segments, and their replay
+# USAGE (running the detectors over a recording, e.g. of a bad detection):
+# python3 frameRecorder.py /home/pi/Filakov/2024-05-01_06-12-00/frames --speed max
+#######################################
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import time
+import numpy as np
+
+# Frames per segment file and the disk space of all segments of a run
+SEGMENT_FRAMES = 256
+RECORD_BUDGET = 1024 ** 3
+# Frames are recorded at most RECORD_FPS times per second
+RECORD_FPS = 10
+# Signals kept with every frame as bits, in this order. The detectors running on
+# the frame (active) and the ones that detected their color are kept the same way.
+RECORD_SIGNALS = ('red', 'green', 'blue', 'stop', 'metal', 'maxTime', 'finish')
+
+# Replays at the original speed shorten the pauses between the recorded frames
+# (e.g. while no detector ran) to REPLAY_MAX_GAP secs
+REPLAY_MAX_GAP = .5
+
+INDEX_DTYPE = np.dtype([('seq', '<i8'), ('stamp', '<f8'), ('state', '<u4'), ('active', '<u4'), ('detected', '<u4')])
+
+def signalState(signals, names = RECORD_SIGNALS):
+    """ Returns the bits of the raised signals """
+    return sum(1 << i for i, name in enumerate(names) if name in signals and signals[name] is True)
+
+def nameBits(selected, names = RECORD_SIGNALS):
+    """ Returns the bits of the names, e.g. of the active detectors """
+    return sum(1 << i for i, name in enumerate(names) if name in selected)
+
+def stateNames(state, names = RECORD_SIGNALS):
+    return [name for i, name in enumerate(names) if state & (1 << i)]
+
+class FrameRecorder:
+    def __init__(self, directory, segmentFrames = SEGMENT_FRAMES, budget = RECORD_BUDGET, fps = RECORD_FPS):
+        """ Appends frames to preallocated segment files mapped into memory, so a
+        frame costs one copy into the page cache and the kernel writes it back.
+        Every segment has an index of (seq, stamp, signal state, active detectors,
+        detectors that detected their color).
+        The oldest segments are deleted to keep all of them within budget bytes. """
+
+        self.directory = directory
+        self.segmentFrames = segmentFrames
+        self.budget = budget
+        self.interval = 1 / fps if fps else 0
+        self.shape = None
+        self.segment = -1
+        self.frames = None
+        self.index = None
+        self.pos = 0
+        self.last = 0
+        self.recorded = 0
+        self.skipped = 0
+        self.secs = 0
+
+    def Record(self, frame, seq, stamp, state = 0, active = 0, detected = 0):
+        """ Appends the frame unless it is due only after 1 / fps secs. The frames
+        with a detection are always appended. Returns whether it was recorded. """
+
+        if stamp - self.last < self.interval and not detected:
+            return False
+        start = time.perf_counter()
+
+        if self.shape is None:
+            self.start(frame.shape)
+        elif frame.shape != self.shape:
+            self.skipped += 1
+            return False
+        if self.frames is None or self.pos == self.segmentFrames:
+            self.openSegment()
+
+        self.frames[self.pos] = frame
+        # The index entry is written after the frame, a nonzero stamp marks a complete one
+        self.index[self.pos] = (seq, 0, state, active, detected)
+        self.index['stamp'][self.pos] = stamp
+        self.pos += 1
+        self.last = stamp
+        self.recorded += 1
+        self.secs += time.perf_counter() - start
+        return True
+
+    def start(self, shape):
+        self.shape = tuple(shape)
+        segmentBytes = self.segmentFrames * int(np.prod(shape))
+        self.maxSegments = max(int(self.budget // segmentBytes), 2)
+        os.makedirs(self.directory, exist_ok = True)
+        with open(os.path.join(self.directory, 'recording.json'), 'w', encoding = 'utf-8') as f:
+            json.dump({ 'shape'   : self.shape,
+                        'dtype'   : 'uint8',
+                        'frames'  : self.segmentFrames,
+                        'signals' : RECORD_SIGNALS }, f)
+
+    def openSegment(self):
+        self.closeSegment()
+        self.segment += 1
+        base = os.path.join(self.directory, 'segment_%06d' % self.segment)
+        self.frames = np.memmap(base + '.frames', dtype = np.uint8, mode = 'w+', shape = (self.segmentFrames,) + self.shape)
+        self.index = np.memmap(base + '.index', dtype = INDEX_DTYPE, mode = 'w+', shape = (self.segmentFrames,))
+        self.pos = 0
+
+        # Rolling: the oldest segments are removed
+        old = self.segment - self.maxSegments
+        if old >= 0:
+            for ext in ('.frames', '.index'):
+                try:
+                    os.remove(os.path.join(self.directory, 'segment_%06d' % old + ext))
+                except OSError:
+                    pass
+
+    def closeSegment(self):
+        if self.frames is not None:
+            self.index.flush()
+            del self.frames, self.index
+            self.frames = self.index = None
+
+    def Close(self):
+        self.closeSegment()
+
+    def Summary(self):
+        """ Returns the statistics of the recording as a list of lines """
+        if not self.recorded:
+            return []
+        size = sum(os.path.getsize(p) for p in glob.glob(os.path.join(self.directory, 'segment_*')))
+        return ['Recording: %d frames, %.2f ms per frame, %d segments of %d frames, %.0f MB on disk%s' %
+                (self.recorded, 1000 * self.secs / self.recorded, min(self.segment + 1, self.maxSegments),
+                 self.segmentFrames, size / 1024 ** 2, ', %d frames of another size skipped' % self.skipped if self.skipped else '')]
+
+def pruneRecordings(root, keep):
+    """ Deletes all but the newest keep recordings (directories) in root """
+    if not os.path.isdir(root):
+        return
+    runs = sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+    for d in runs[:max(len(runs) - keep, 0)]:
+        shutil.rmtree(os.path.join(root, d), ignore_errors = True)
+
+def readRecording(directory):
+    """ Returns the metadata and the list of (segment base path, index) in the order of recording """
+    with open(os.path.join(directory, 'recording.json'), encoding = 'utf-8') as f:
+        meta = json.load(f)
+    segments = []
+    for path in sorted(glob.glob(os.path.join(directory, 'segment_*.index'))):
+        index = np.fromfile(path, dtype = INDEX_DTYPE)
+        segments.append((path[:-len('.index')], index))
+    return meta, segments
+
+class ReplayCapture:
+    def __init__(self, directory, speed = 'original', loop = False, maxGap = REPLAY_MAX_GAP):
+        """ Video capture reading a recording of FrameRecorder, for run(camera = ...).
+        speed - 'original' keeps the intervals of the recorded stamps up to maxGap secs,
+        'max' reads the frames as fast as they are asked for. Frames are read-only views of the
+        mapped segments, nothing is copied. Picklable until the first read, so it
+        can be handed to the vision process. """
+
+        self.directory = directory
+        self.speed = speed
+        self.loop = loop
+        self.maxGap = maxGap
+        self.opened = os.path.exists(os.path.join(directory, 'recording.json'))
+        self.entries = None
+        self.pos = 0
+        # Index entry of the last frame read
+        self.entry = None
+
+    def open(self):
+        meta, segments = readRecording(self.directory)
+        shape = tuple(meta['shape'])
+        self.entries = []
+        for base, index in segments:
+            frames = np.memmap(base + '.frames', dtype = np.uint8, mode = 'r', shape = (len(index),) + shape)
+            for i in np.flatnonzero(index['stamp'] > 0):
+                self.entries.append((index[i], frames, i))
+        self.entries.sort(key = lambda e: e[0]['seq'])
+        self.due = None
+
+    def isOpened(self):
+        return self.opened
+
+    def release(self):
+        self.opened = False
+        self.entries = None
+
+    def get(self, prop):
+        return 0
+
+    def set(self, prop, value):
+        return False
+
+    def read(self):
+        if self.entries is None:
+            self.open()
+        if self.pos == len(self.entries):
+            if not self.loop or not self.entries:
+                self.opened = False
+                return False, None
+            self.pos = 0
+            self.due = None
+
+        previous = self.entry
+        self.entry, frames, i = self.entries[self.pos]
+        self.pos += 1
+        if self.speed == 'original':
+            now = time.perf_counter()
+            if self.due is None or previous is None:
+                self.due = now
+            else:
+                self.due += min(max(self.entry['stamp'] - previous['stamp'], 0), self.maxGap)
+            if self.due > now:
+                time.sleep(self.due - now)
+        return True, frames[i]
+
+def replayDetections(directory, speed = 'max'):
+    """ Runs the current detectors over the recorded frames on which they ran.
+    Returns the decisions differing from the recorded ones as
+    (seq, name, recorded, now, fraction) and the number of frames. """
+
+    from colorDetection import createDetectors
+
+    meta = readRecording(directory)[0]
+    names = meta['signals']
+    detectors = createDetectors([n for n in ('red', 'green', 'blue') if n in names])
+    cam = ReplayCapture(directory, speed)
+    differences = []
+    frames = 0
+    while True:
+        ret, frame = cam.read()
+        if not ret:
+            break
+        frames += 1
+        active = stateNames(cam.entry['active'], names)
+        detected = stateNames(cam.entry['detected'], names)
+        for d in detectors:
+            if d.name not in active:
+                continue
+            d.Detect(frame)
+            if d.Detected() != (d.name in detected):
+                differences.append((int(cam.entry['seq']), d.name, d.name in detected, d.Detected(), d.fraction))
+    return differences, frames
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument('directory', help = 'directory of the recording')
+    ap.add_argument('--speed', choices = ('original', 'max'), default = 'max')
+    args = ap.parse_args()
+
+    start = time.time()
+    differences, frames = replayDetections(args.directory, args.speed)
+    elapsed = time.time() - start
+    print('Frames: %d in %.1f secs (%.0f fps)' % (frames, elapsed, frames / max(elapsed, 1e-6)))
+    for seq, name, recorded, now, fraction in differences:
+        print('frame %6d  %-5s recorded %-5s now %-5s fraction %.4f' % (seq, name, recorded, now, fraction))
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import os
+import queue
+import threading
+import cv2
+from logWriter import logger
+
+def encoderParams(fmt, level, quality):
+    """ Returns the extension and the encoder parameters of the output format """
+    if fmt == 'png':
+        return '.png', [cv2.IMWRITE_PNG_COMPRESSION, level]
+    elif fmt == 'jpg':
+        return '.jpg', [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif fmt == 'webp':
+        # Quality above 100 selects lossless WebP
+        return '.webp', [cv2.IMWRITE_WEBP_QUALITY, 101]
+    raise ValueError('Unknown image format: ' + str(fmt))
+
+class ImageWriter:
+    def __init__(self, fmt = 'png', level = 3, quality = 95, workers = 2, maxQueue = 4, onWritten = None):
+        """ Pool of threads encoding and writing pictures in the background.
+        fmt - 'png' (compression level 0-9), 'jpg' (quality 0-100) or 'webp' (lossless)
+        Submit blocks while maxQueue pictures are waiting. Files are written
+        to a temporary name and renamed, so a file never appears half written.
+        onWritten(path) is called from the worker for every written file. """
+
+        self.ext, self.params = encoderParams(fmt, level, quality)
+        self.onWritten = onWritten
+        self.queue = queue.Queue(maxQueue)
+        self.failed = 0
+        self.workers = [threading.Thread(target = self.writeLoop, daemon = True) for i in range(workers)]
+        for w in self.workers:
+            w.start()
+
+    def Submit(self, frame, path):
+        """ Queues the frame to be saved as path + extension and returns the full path.
+        The frame must not be modified afterwards. """
+
+        path += self.ext
+        self.queue.put((frame, path))
+        return path
+
+    def Drain(self):
+        """ Waits until all queued pictures are written """
+        self.queue.join()
+
+    def Close(self):
+        self.Drain()
+        for w in self.workers:
+            self.queue.put(None)
+        for w in self.workers:
+            w.join()
+
+    def writeLoop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+
+            frame, path = item
+            try:
+                ret, buf = cv2.imencode(self.ext, frame, self.params)
+                if not ret:
+                    raise IOError('Encoding failed')
+
+                tmp = path + '.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(buf)
+                os.replace(tmp, path)
+                logger.Log('The picture ' + os.path.basename(path) + ' is saved.')
+
+                if self.onWritten is not None:
+                    self.onWritten(path)
+            except Exception as e:
+                self.failed += 1
+                logger.Log('The picture ' + os.path.basename(path) + ' was not saved: ' + str(e))
+            finally:
+                self.queue.task_done()
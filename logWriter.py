@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import datetime
+import queue
+import sys
+import threading
+
+class LogWriter:
+    def __init__(self, maxQueue = 10000, interval = 1):
+        """ Queue-based log shared by all modules.
+        Callers only enqueue the message with its time. A background thread
+        writes the messages in batches and flushes every interval secs, when the
+        log is closed and at exit. Messages are dropped (and counted) when the
+        queue is full. """
+
+        self.queue = queue.Queue(maxQueue)
+        self.interval = interval
+        self.dropped = 0
+        self.reported = 0
+        self.file = None
+        self.lock = threading.Lock()
+        self.flushNow = threading.Event()
+        self.T_write = None
+
+    def Open(self, path):
+        """ Writes the following messages to path instead of standard output """
+        self.Flush()
+        with self.lock:
+            self.file = open(path, 'w', encoding = 'utf-8')
+
+    def Close(self):
+        """ Writes all queued messages and closes the file """
+        self.Flush()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def Log(self, msg):
+        if self.T_write is None:
+            self.start()
+        try:
+            self.queue.put_nowait((datetime.datetime.now(), str(msg)))
+        except queue.Full:
+            self.dropped += 1
+
+    def Flush(self):
+        """ Waits until all queued messages are written """
+        if self.T_write is not None:
+            self.flushNow.set()
+            self.queue.join()
+
+    def start(self):
+        with self.lock:
+            if self.T_write is None:
+                self.T_write = threading.Thread(target = self.writeLoop, daemon = True)
+                self.T_write.start()
+                atexit.register(self.Flush)
+
+    def writeLoop(self):
+        while True:
+            # Collecting messages until the interval passes or a flush is requested
+            batch = [self.queue.get()]
+            self.flushNow.wait(self.interval)
+            self.flushNow.clear()
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            taken = len(batch)
+
+            if self.dropped != self.reported:
+                batch.append((datetime.datetime.now(), str(self.dropped - self.reported) + ' log messages were dropped.'))
+                self.reported = self.dropped
+
+            lines = ''.join('(' + t.strftime('%Y-%m-%d %H:%M:%S') + ') ' + msg + '\n' for t, msg in batch)
+            with self.lock:
+                out = self.file if self.file is not None else sys.stdout
+                out.write(lines)
+                out.flush()
+
+            for i in range(taken):
+                self.queue.task_done()
+
+logger = LogWriter()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+#######################################
+# Persistent outbox for the notification mails
+# USAGE (delivering the spooled messages):
+# python3 mailOutbox.py
+#######################################
+
+import email
+import email.utils
+import itertools
+import os
+import smtplib
+import threading
+import time
+from sendMail import compose_mail, open_session
+from logWriter import logger
+
+SPOOL = '/home/pi/Filakov/outbox/'
+COMPRESS_OVER = 64 * 1024
+
+class Outbox:
+    def __init__(self, spool = SPOOL, server = 'localhost', port = 587, username = '', password = '', use_tls = True):
+        """ Messages are written to the spool directory and delivered later.
+        A delivery sends all spooled messages over one authenticated SMTP
+        session and removes every message as soon as it is accepted, so the
+        messages survive a failed delivery, a crash or a reboot. """
+
+        self.spool = spool
+        self.server = (server, port, username, password, use_tls)
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        os.makedirs(spool, exist_ok = True)
+
+    def Enqueue(self, send_from, send_to, subject, message, files = []):
+        """ Composes the message and writes it to the spool, returns its path """
+
+        msg = compose_mail(send_from, send_to, subject, message, files, COMPRESS_OVER)
+        name = '%.6f_%d_%d.eml' % (time.time(), os.getpid(), next(self.counter))
+        path = os.path.join(self.spool, name)
+
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(msg.as_bytes())
+        os.replace(tmp, path)
+        return path
+
+    def Pending(self):
+        """ Returns the paths of the spooled messages, the oldest first """
+        names = sorted(n for n in os.listdir(self.spool) if n.endswith('.eml'))
+        return [os.path.join(self.spool, n) for n in names]
+
+    def Deliver(self):
+        """ Sends the spooled messages in one session and returns their count.
+        Errors of the connection are raised, the unsent messages stay spooled. """
+
+        with self.lock:
+            pending = self.Pending()
+            if not pending:
+                return 0
+
+            sent = 0
+            smtp = open_session(*self.server)
+            try:
+                for path in pending:
+                    with open(path, 'rb') as f:
+                        raw = f.read()
+                    msg = email.message_from_bytes(raw)
+                    send_to = [addr for name, addr in email.utils.getaddresses(msg.get_all('To', []))]
+
+                    try:
+                        smtp.sendmail(msg['From'], send_to, raw)
+                    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError) as e:
+                        # The server will never accept this message
+                        logger.Log('Mail ' + os.path.basename(path) + ' was rejected: ' + str(e))
+                        os.replace(path, path + '.rejected')
+                        continue
+
+                    os.remove(path)
+                    sent += 1
+            finally:
+                try:
+                    smtp.quit()
+                except smtplib.SMTPException:
+                    smtp.close()
+            return sent
+
+    def DeliverWithRetry(self, attempts = 6, backoff = 30):
+        """ Delivers until the spool is empty, waiting backoff, 2*backoff, ...
+        secs after every failure. Returns True when all messages are sent. """
+
+        for attempt in range(attempts):
+            try:
+                sent = self.Deliver()
+                if sent:
+                    logger.Log(str(sent) + ' mail(s) sent.')
+                return True
+            except (OSError, smtplib.SMTPException) as e:
+                logger.Log('Sending mail failed (attempt ' + str(attempt + 1) + '): ' + str(e))
+            if attempt + 1 < attempts:
+                time.sleep(backoff * 2 ** attempt)
+
+        logger.Log(str(len(self.Pending())) + ' mail(s) left in the outbox.')
+        return False
+
+def outboxFromConfig(spool = SPOOL):
+    import config
+    return Outbox(spool, config.mail['server'], config.mail['port'],
+                  config.mail['username'], config.mail['password'], True)
+
+if __name__ == "__main__":
+    outbox = outboxFromConfig()
+    outbox.DeliverWithRetry(attempts = 1)
+    print('Not sent:', len(outbox.Pending()))
+    logger.Flush()
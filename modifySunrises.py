@@ -1,38 +1,35 @@
-def pad2(s):
-    return '0' + s if len(s) < 2 else s
+#######################################
+# Writes a table of sunrises for any year and location
+# USAGE:
+# python3 modifySunrises.py --year 2021 --delay 29 --output sunrises.txt
+#######################################
+
+import argparse
+import datetime
+import numpy as np
+from sunEphemeris import LOCATION, EVENTS, Location, yearTable, formatMinutes
+
+def writeTable(path, year, location = LOCATION, delay = 0, event = 'sunrise'):
+    """ Writes the times of the event plus delay minutes as lines 'Y-M-D H:MM:SS'.
+    The daylight saving time comes from the time zone, no manual shifting is needed. """
+
+    column = yearTable(location, year)[:, EVENTS.index(event)] + delay
+    first = datetime.date(year, 1, 1)
+    with open(path, 'w') as F:
+        for i, minutes in enumerate(column):
+            day = first + datetime.timedelta(days = i)
+            stamp = '-' if np.isnan(minutes) else formatMinutes(minutes)
+            F.write('%d-%d-%d %s\n' % (day.year, day.month, day.day, stamp))
 
-def add(stamp, hrs, mins, secs):
-    """ Returns modified timestamp with added hours, minutes and seconds """
-    
-    L = list(map(int, stamp.split(':')))
-    s = ((L[0] + hrs) * 60 + L[1] + mins) * 60 + L[2] + secs       
-    return str(s // 3600) + ':' + \
-        pad2(str((s % 3600) // 60)) + ':' + \
-        pad2(str(((s % 3600) % 60)))
-        
-def update(L, start_ind, end_ind, hrs, mins, secs):
-    """ Updates list L of sunrises from start_ind to end_ind (inclusive)
-    by adding hours, minutes and seconds to each entry """
-    
-    M = list(L)
-    for i in range(start_ind, end_ind + 1):
-        M[i] = add(M[i], hrs, mins, secs)
-        
-    return M
-    
 if __name__ == "__main__":
-    sun = open('sunrises.txt', 'r')
-    sunrises = [x for x in sun.readlines()]
-    suns = [x.split()[1] for x in sunrises]
-    
-    # Primjer: Dodaje 1:00:00 na indeksima [a, b]
-    a = 0
-    b = 365
-    M = update(suns, a, b, 3, 0, 0)
-    
-    F = open('sunrises_copy.txt', 'w')
-    for i in range(len(sunrises)):
-        F.write(sunrises[i].split()[0] + ' ' + M[i] +  '\n')
-        
-    sun.close()
-    F.close()
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--year', type = int, default = datetime.date.today().year)
+    ap.add_argument('--delay', type = float, default = 0, help = 'minutes added to every entry')
+    ap.add_argument('--event', choices = EVENTS, default = 'sunrise')
+    ap.add_argument('--lat', type = float, default = LOCATION.lat)
+    ap.add_argument('--lon', type = float, default = LOCATION.lon)
+    ap.add_argument('--tz', default = LOCATION.tz)
+    ap.add_argument('--output', default = 'sunrises.txt')
+    args = ap.parse_args()
+
+    writeTable(args.output, args.year, Location(args.lat, args.lon, args.tz), args.delay, args.event)
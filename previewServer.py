@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+import cv2
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PAGE = b'<html><body><img src="/stream"><form action="/stop" method="post"><button>Stop</button></form></body></html>'
+
+class PreviewHandler(BaseHTTPRequestHandler):
+    """ Serves the page, the MJPEG stream, a single picture and the stop endpoint """
+
+    def do_GET(self):
+        preview = self.server.preview
+        if self.path == '/':
+            self.reply(200, 'text/html', PAGE)
+        elif self.path == '/stream':
+            self.stream(preview)
+        elif self.path == '/frame.jpg':
+            seq, jpeg = preview.WaitJpeg(0, 5)
+            if jpeg is None:
+                self.reply(503, 'text/plain', b'No frame available')
+            else:
+                self.reply(200, 'image/jpeg', jpeg)
+        elif self.path == '/stop':
+            # Only a POST stops the rig, a GET may be a prefetch or a reload
+            self.reply(405, 'text/plain', b'Use POST')
+        else:
+            self.reply(404, 'text/plain', b'Not found')
+
+    def do_POST(self):
+        if self.path == '/stop':
+            self.server.preview.Stop()
+            self.reply(200, 'text/plain', b'Stop signal sent')
+        else:
+            self.reply(404, 'text/plain', b'Not found')
+
+    def reply(self, code, contentType, body):
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, preview):
+        self.send_response(200)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+        self.end_headers()
+
+        preview.AddClient(1)
+        seq = 0
+        try:
+            while not preview.closed:
+                seq, jpeg = preview.WaitJpeg(seq, 1)
+                if jpeg is None:
+                    continue
+                self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ' +
+                                 str(len(jpeg)).encode() + b'\r\n\r\n' + jpeg + b'\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            preview.AddClient(-1)
+
+    def log_message(self, format, *args):
+        pass
+
+class PreviewServer:
+    def __init__(self, port, onStop = None, host = '127.0.0.1', maxFps = 2, decimation = 5, scale = .5, quality = 70):
+        """ MJPEG preview of the camera loop on a local HTTP port.
+        The camera loop only hands over every decimation-th frame, at most maxFps
+        times per second and only while somebody is watching. Scaling, drawing and
+        encoding are done in a separate thread. """
+
+        self.onStop = onStop
+        self.interval = 1 / maxFps
+        self.decimation = decimation
+        self.scale = scale
+        self.quality = quality
+
+        self.frameCnt = 0
+        self.lastPublish = 0
+        self.clients = 0
+        self.closed = False
+
+        # Latest published frame and the latest encoded picture
+        self.pending = None
+        self.jpeg = None
+        self.seq = 0
+        self.cond = threading.Condition()
+
+        self.httpd = ThreadingHTTPServer((host, port), PreviewHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.preview = self
+
+        self.T_http = threading.Thread(target = self.httpd.serve_forever, daemon = True)
+        self.T_encode = threading.Thread(target = self.encodeLoop, daemon = True)
+
+    def Start(self):
+        self.T_http.start()
+        self.T_encode.start()
+
+    def Close(self):
+        """ Stops the encoder and the HTTP server """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.T_encode.join()
+
+    def Publish(self, frame, detectors = ()):
+        """ Called from the camera loop. Only stores a reference to the frame
+        when a preview frame is due, never copies or encodes it. """
+
+        self.frameCnt += 1
+        if self.clients == 0 or self.frameCnt % self.decimation:
+            return
+
+        now = time.time()
+        if now - self.lastPublish < self.interval:
+            return
+        self.lastPublish = now
+        self.Show(frame, [(d.roi, d.fraction) for d in detectors])
+
+    def Show(self, frame, marks = ()):
+        """ Hands the frame with the marks [(roi, fraction)] of the detectors to the
+        encoder, e.g. a frame the vision process sent at the preview rate """
+        with self.cond:
+            self.pending = (frame, marks)
+            self.cond.notify_all()
+
+    def Stop(self):
+        """ Equivalent of the 'q' key of the camera window """
+        if self.onStop is not None:
+            self.onStop()
+
+    def AddClient(self, n):
+        with self.cond:
+            self.clients += n
+
+    def WaitJpeg(self, seq, timeout):
+        """ Waits for a picture newer than seq and returns (seq, jpeg).
+        Returns (seq, None) on timeout """
+
+        with self.cond:
+            if self.jpeg is None or self.seq <= seq:
+                self.cond.wait_for(lambda: self.closed or (self.jpeg is not None and self.seq > seq), timeout)
+            if self.jpeg is None or self.seq <= seq:
+                return seq, None
+            return self.seq, self.jpeg
+
+    def encodeLoop(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.closed or self.pending is not None)
+                if self.closed:
+                    return
+                frame, marks = self.pending
+                self.pending = None
+
+            image = cv2.resize(frame, (0, 0), fx = self.scale, fy = self.scale)
+            for (t, b, l, r), fraction in marks:
+                (t, b, l, r) = [round(self.scale * x) for x in (t, b, l, r)]
+                cv2.rectangle(image, (l, t), (r - 1, b - 1), (150,150,30))
+                cv2.putText(image, '%.2f %%' % (100 * fraction), (l + 2, b - 5), 1, 1, (255, 255, 255))
+
+            ret, buf = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            if not ret:
+                continue
+
+            with self.cond:
+                self.jpeg = buf.tobytes()
+                self.seq += 1
+                self.cond.notify_all()
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+
+RIG_STATE = '/home/pi/Filakov/rig_state.json'
+
+class RigState:
+    def __init__(self, path = RIG_STATE):
+        """ Small JSON file with what the rig learns across runs,
+        e.g. the calibration of the camera. Every change is written at once. """
+
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, encoding = 'utf-8') as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+
+    def Get(self, key, default = None):
+        with self.lock:
+            return self.state.get(key, default)
+
+    def Set(self, key, value):
+        with self.lock:
+            self.state[key] = value
+            self.save()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding = 'utf-8') as f:
+            json.dump(self.state, f, indent = 1)
+        os.replace(tmp, self.path)
@@ -1,21 +1,96 @@
 # -*- coding: utf-8 -*-
 
 from controls import Controls
+from colorDetection import createDetectors, compositeView
+from colorTable import loadTable, loadSamples
+from previewServer import PreviewServer
+from frameGrabber import FrameGrabber
+from visionWorker import VisionWorker
+from frameRecorder import FrameRecorder, pruneRecordings, signalState, nameBits
+from signalBus import Signals
+from tracing import tracer, traced, JitterProbe
+from logWriter import logger
+from imageWriter import ImageWriter
+from cloudUpload import Uploader, DropboxBackend
+from rigState import RigState
 import cv2
 import datetime
 import numpy as np
 import os
+import signal
 import threading
 import time
-import subprocess
-from sendMail import send_mail
+from mailOutbox import outboxFromConfig
 import config
 
 DEBUG_OUTPUT = 1
-output_file = None
+
+# Camera loop without the OpenCV window (no X display needed)
+HEADLESS = 1
+# Port of the MJPEG preview on localhost (0 - no preview)
+PREVIEW_PORT = 8080
+# Detection runs on frames downscaled by DETECT_LEVELS pyramid levels, or with a
+# DETECT_SIZE (width, height) the camera itself streams at that resolution and
+# switches to its full resolution only for the stills. The detectors only read
+# their squares, so downscaling in software pays off only for the preview.
+DETECT_LEVELS = 0
+DETECT_SIZE = None
+# Capture and detection run in a separate process (visionWorker), so that they
+# never hold the GIL while a serial message waits. The camera window needs 0.
+VISION_PROCESS = 1
+# With MEASURE_JITTER a thread of the control process logs the lateness of its wakeups
+# (tracing.JitterProbe). It wakes up 200 times a second, so it is off in production.
+MEASURE_JITTER = 0
+# With RECORD_FRAMES the detection frames are recorded with the signals for replays
+# (frameRecorder.py, run(camera = ReplayCapture(...))). Only the recordings of
+# the last RECORD_RUNS runs are kept in RECORD_DIRECTORY.
+RECORD_FRAMES = 0
+RECORD_DIRECTORY = '/home/pi/Filakov/recordings/'
+RECORD_RUNS = 3
+# Labeled sample pixels (colorTable.loadSamples) extend the colors of the detectors
+# through a lookup table, which replaces the color boxes when the directory exists
+COLOR_SAMPLES = '/home/pi/Filakov/samples/'
+# Without any detector needed by the running phase the camera loop checks
+# for a phase needing one every IDLE_INTERVAL secs
+IDLE_INTERVAL = .25
+# A still is taken as soon as the scene is stable after the rig stopped
+# (frameGrabber.STABLE_FRAMES). If it is not stable within STILL_TIMEOUT secs,
+# the sharpest of STILL_BURST consecutive stills is taken.
+STILL_TIMEOUT = 3
+STILL_BURST = 3
+# Format of the pictures: 'png' (PNG_COMPRESSION 0-9), 'jpg' (JPEG_QUALITY) or 'webp' (lossless)
+IMAGE_FORMAT = 'png'
+PNG_COMPRESSION = 3
+JPEG_QUALITY = 95
+# The plant is centered on the red wire with a move of the horizontal motor:
+# corrections below CENTER_TOLERANCE cm are skipped, above MAX_CORRECTION cm the wire is searched again.
+# The pixels per cm are measured once per side with a CALIBRATION_STEP cm move and kept in the rig state.
+CENTER_TOLERANCE = .3
+MAX_CORRECTION = 10
+CALIBRATION_STEP = 2
+# Plants found by a complete pass are kept in the rig state. A plant nearer than
+# MATCH_DISTANCE cm to a known one gets its green height, approached from VERTICAL_MARGIN cm above.
+MATCH_DISTANCE = 5
+VERTICAL_MARGIN = 3
+# Known plants are approached at the travel speed of the horizontal motor
+# up to SLOWDOWN_DISTANCE cm before them, where the search speed takes over
+SLOWDOWN_DISTANCE = 10
+# Fixed pauses are divided by TIME_SCALE (set when running against the simulator)
+TIME_SCALE = 1
+
+image_writer = None
+uploader = None
+outbox = None
+rig = None
+# Lateness of the wakeups of the control process during the run
+jitter = JitterProbe()
+
 def debug_print(msg):
     if DEBUG_OUTPUT:
-        print('(' + str(datetime.datetime.now())[:-7:]+ ')', msg, flush = True, file = output_file)
+        logger.Log(msg)
+
+def pause(secs):
+    time.sleep(secs / TIME_SCALE)
 
 def extractColor(image, color):
     """ Extracts the given BGR color from image
@@ -53,156 +128,167 @@ def middleSquare(image, strideH, strideV, centerH, centerV):
     
     return nnz 
 
-def cameraLoop(cam, signals):
+def cameraLoop(grabber, signals, headless = HEADLESS, preview = None, recorder = None):
     """ Takes pictures while recognizing red, green and blue objects
-        until the user hits the 'q' key """
-    
-    # Color boundaries ([B_low, G_low, R_low], [B_high, G_high, R_high])
-    red = ([0, 0, 120], [60, 120, 255])
-    green = ([0, 50, 0], [30, 255, 140])
-    blue = ([95, 65, 70], [170, 110, 95])
-    
-    # Utils
-    # https://www.rapidtables.com/web/color/RGB_Color.html
-    # https://www.ginifab.com/feeds/pms/pms_color_in_image.php
+        until the finish signal. The stop signal is raised by the 'q' key
+        of the camera window or by the stop endpoint of the preview.
+        Only the detectors needed by the running phase (signals.Detecting) run,
+        without any the loop idles at a few frames per second.
+        In headless mode no window is shown and there is no delay between frames.
+        The frames the detectors ran on are appended to the recorder if given. """
+    
+    names = ('red', 'green', 'blue')
+    detectors = createDetectors(names, scale = grabber.Scale())
+    table = loadTable(names, samples = loadSamples(COLOR_SAMPLES)) if os.path.isdir(COLOR_SAMPLES) else None
+    seq = 0
+    frames = 0
+    idleFrames = 0
+    counts = dict.fromkeys(names, 0)
+    size = None
+    start, cpuStart, processStart = time.time(), time.thread_time(), time.process_time()
     
     # Read until video is completed
-    while(not signals['finish'] and cam.isOpened()):
-        # Capture frame-by-frame
-        ret, frame = cam.read()
-    
-        if ret != True:
+    while(not signals['finish'] and grabber.isOpened()):
+        active = signals.Active()
+        if active:
+            # Wait for the next frame from the grabber
+            seq, stamp, frame = grabber.WaitNewer(seq, 1)
+        elif signals.WaitActive(IDLE_INTERVAL):
+            continue
+        else:
+            # Idle mode, the newest frame is only shown
+            seq, stamp, frame = grabber.Latest()
+            if frame is None:
+                continue
+            idleFrames += 1
+    
+        if frame is None:
             #signals['stop'] = True
             debug_print('Camera loop skipped a frame.')
-            time.sleep(1)
             continue
         
         # (Optional) Resizing the image
         # frame = cv2.resize(frame, (0,0), fx=0.82, fy=0.82)
         
-        # Capturing red color
-        redMask = extractColor(frame, red)
-        cntRed = middleSquare(redMask, 15, 100000, 0.5, 0.5)
+        # Capturing the needed colors in the middle squares
+        running = [d for d in detectors if d.name in active]
+        if table is not None:
+            table.DetectAll(frame, running)
+        else:
+            for d in running:
+                d.Detect(frame)
+        for d in running:
+            counts[d.name] += 1
+            if d.Detected():
+                signals[d.name] = True
+        if running:
+            frames += 1
+            size = frame.shape
+            if recorder is not None:
+                recorder.Record(frame, seq, stamp, signalState(signals), nameBits(active),
+                                nameBits([d.name for d in running if d.Detected()]))
         
-        if cntRed > .01:
-            signals['red'] = True
-                   
-        # Capturing green color
-        medBlur = cv2.medianBlur(frame, 5)
-        greenMask = extractColor(medBlur, green)
-        cntGreen = middleSquare(greenMask, 100, 30, 0.5, 0.5)
+        # Only the running detectors hold the middle square of this frame
+        if preview is not None:
+            preview.Publish(frame, running)
         
-        if cntGreen > .03:
-            signals['green'] = True
-
-        # Capturing blue color
-        blueMask = extractColor(frame, blue)
-        cntBlueV = middleSquare(blueMask, 70, 70, 0.5, 0.4)
-        
-        if cntBlueV > .025:
-            signals['blue'] = True
+        if headless:
+            continue
          
         # Display the resulting frames
-        row1 = np.hstack([frame, redMask])
-        row2 = np.hstack([greenMask, blueMask])
-        cv2.imshow('Frame', np.vstack([row1, row2]))
+        cv2.imshow('Frame', compositeView(frame, running))
 
         # Press Q on keyboard to  exit
         if cv2.waitKey(25) & 0xFF == ord('q'):
             signals['stop'] = True
 
-    cam.release()               # When the loop is done, release the video capture object
-    cv2.destroyAllWindows()     # Close all the frames
+    if not headless:
+        cv2.destroyAllWindows() # Close all the frames
+
+    elapsed = max(time.time() - start, 1e-6)
+    debug_print('Detection: %d frames of %s, %.1f fps, camera loop CPU %.0f %%, process CPU %.0f %%' %
+                (frames, 'none' if size is None else '%dx%d' % (size[1], size[0]), frames / elapsed,
+                 100 * (time.thread_time() - cpuStart) / elapsed, 100 * (time.process_time() - processStart) / elapsed))
+    debug_print('Frames per detector: ' + ', '.join('%s %d' % (n, counts[n]) for n in names) + ', idle ' + str(idleFrames))
+    if recorder is not None:
+        recorder.Close()
+        for line in recorder.Summary():
+            debug_print(line)
     
+@traced('findRedObject')
 def findRedObject(S, sgn, signals, maxTime = 10 * 60):
     """ Searching for red object in horizontal direction '+' or '-' 
     Maximum duration of this function is maxTime seconds """
     
     debug_print('Finding red in direction ' + ('+' if sgn == 1 else '-') + '.')
-    signals['red'] = False
-
-    start = time.time()
-    now = time.time()
-    
-    S.Move(0, 'M', sgn * 1000)
-    
-    while now - start < maxTime and not any([signals['stop'], signals['red'], signals['metal']]):
-        time.sleep(.1)
-        now = time.time()
+    with signals.Detecting('red'):
+        signals['red'] = False
+        S.Move(0, 'M', sgn * 1000)
+        fired = signals.WaitAny(['stop', 'red', 'metal'], maxTime)
 
-    if now - start >= maxTime:
+    if fired is None:
         debug_print('Maximum time for finding red expired. Aborting operation.')
         signals['maxTime'] = True
         
     if any([signals['stop'], signals['red'], signals['metal'], signals['maxTime']]):
         S.Move(0, 'S')
+        signals.Acknowledge(fired)
             
     debug_print('Finding red done.')
         
+@traced('findGreenObject')
 def findGreenObject(S, signals):
     """ Searching for green object in vertical direction '-' """
 
     debug_print('Finding green.')
-    signals['green'] = False
     # Maximum duration of this function is maxTime seconds
     maxTime = 8 * 60
-    start = time.time()
-    now = time.time()
-           
-    S.Move(1, 'M', -1000)
-    
-    while now - start < maxTime and not any([signals['stop'], signals['green'], signals['metal']]):
-        time.sleep(.1)
-        now = time.time()
 
-    if now - start >= maxTime:
+    with signals.Detecting('green'):
+        signals['green'] = False
+        S.Move(1, 'M', -1000)
+        fired = signals.WaitAny(['stop', 'green', 'metal'], maxTime)
+
+    if fired is None:
         debug_print('Maximum time for finding green expired. Aborting operation.')
         signals['stop'] = True
         
     if any([signals['stop'], signals['green'], signals['metal']]):
         S.Move(1, 'S')
+        signals.Acknowledge(fired)
             
     debug_print('Finding green done.')
         
-def takePicture(cam, signals):
-    """ Takes a picture with the camera cam and stores it with the given filename """
-    
-    # Test picture as the camera sometimes gives a black picture on startup
-    ret, frame = cam.read()
-    time.sleep(.5)
-    
-    tries = 10
-    ret = False
-    while cam.isOpened and tries > 0 and not ret:        
-        # Calming the camera before taking a picture
-        time.sleep(2)
-        ret, frame = cam.read()
-        tries -= 1
-    
-    if ret:
-        cv2.imwrite(signals['path'] + 'img' + str(signals['pltCnt']) + '_' + str(signals['imgCnt']) + '.png', frame)
+@traced('takePicture')
+def takePicture(grabber, signals):
+    """ Takes a picture from the frame grabber and hands it to the image writer
+    to be stored with the given filename """
+    
+    # Waiting for the camera to calm down
+    seq, stamp, frame, info = grabber.WaitStable(time.time(), STILL_TIMEOUT / TIME_SCALE, STILL_BURST)
+    
+    if frame is not None:
+        image_writer.Submit(frame, signals['path'] + 'img' + str(signals['pltCnt']) + '_' + str(signals['imgCnt']))
         signals['imgCnt'] += 1
-        debug_print('The picture is saved.')
+        debug_print('The picture is taken in %.2f secs (%s after %d frames, sharpness %.0f, best of %d).' %
+                    (info['secs'], 'stable' if info['stable'] else 'not stable', info['frames'], info['sharpness'], info['stills']))
     else:
         debug_print('It was not possible to take a picture.')
 
-def takeThreePictures(C, camera, signals, sgn):
+@traced('takeThreePictures')
+def takeThreePictures(C, grabber, signals, sgn):
     """ Takes three pictures of the target: one from the front side and one from each flank """
     
-    takePicture(camera, signals)
+    takePicture(grabber, signals)
     
     pathHalfLength = 15
     angleRotation = 25
            
-    # Go in opposite direction
+    # Go in opposite direction, the camera rotates for the picture on the way
     centerPos = C.AskPosition(0)
-    maxTime = C.Move(0, 'M', -1 * sgn * pathHalfLength) + 5
-    start = time.time()
-    now = time.time()
-    
-    while now - start < maxTime and not any([signals['stop'], signals['metal']]):
-        time.sleep(.1)
-        now = time.time()
+    motion = C.Move(0, 'M', -1 * sgn * pathHalfLength)
+    rotation = C.Move(2, 'M', angleRotation)
+    signals.WaitAny(['stop', 'metal'], motion.Timeout(), motion.IsDone)
         
     if signals['stop']:
         debug_print('Operation aborted due to stop signal.')
@@ -210,26 +296,25 @@ def takeThreePictures(C, camera, signals, sgn):
         return
     elif signals['metal']:
         C.Move(0, 'S')
+        signals.Acknowledge('metal')
         debug_print('Metal encountered and skipped first side picture. Returning to the center.')
+        # The counter-rotation is relative, so the rotation has to finish first
+        rotation.Wait()
         # Try to take the picture from the other angle, first go back to the center
-        C.Move(0, 'M', sgn * abs((C.AskPosition(0) - centerPos)), wait = True)
+        C.MoveTogether([(0, 'M', sgn * abs((C.AskPosition(0) - centerPos))),
+                        (2, 'M', -angleRotation)], wait = True)
     else:
-        # Rotate for picture
-        C.Move(2, 'M', angleRotation, wait = True)
-        takePicture(camera, signals)
-        C.Move(2, 'M', -angleRotation, wait = True)
-        # Head back to the center
-        C.Move(0, 'M', sgn  * pathHalfLength, wait = True)
+        rotation.Wait()
+        takePicture(grabber, signals)
+        # Head back to the center while rotating back
+        C.MoveTogether([(0, 'M', sgn  * pathHalfLength),
+                        (2, 'M', -angleRotation)], wait = True)
 
     debug_print('We are in the center again. Moving to the other side.')
     resetSignals(signals)
-    maxTime = C.Move(0, 'M', sgn  * pathHalfLength) + 5
-    start = time.time()
-    now = time.time()
-    
-    while now - start < maxTime and not any([signals['stop'], signals['metal']]):
-        time.sleep(.1)
-        now = time.time()
+    motion = C.Move(0, 'M', sgn  * pathHalfLength)
+    rotation = C.Move(2, 'M', -angleRotation)
+    signals.WaitAny(['stop', 'metal'], motion.Timeout(), motion.IsDone)
 
     if signals['stop']:
         debug_print('Operation aborted due to stop signal.')
@@ -237,15 +322,18 @@ def takeThreePictures(C, camera, signals, sgn):
         return
     elif signals['metal']:
         C.Move(0, 'S')
+        signals.Acknowledge('metal')
         # Return to the center
         debug_print('Metal encountered and skipped second side picture. Returning to the center.')
-        C.Move(0, 'M', -1 * sgn * abs((C.AskPosition(0) - centerPos)), wait = True)
+        rotation.Wait()
+        C.MoveTogether([(0, 'M', -1 * sgn * abs((C.AskPosition(0) - centerPos))),
+                        (2, 'M', angleRotation)], wait = True)
     else:
-        C.Move(2, 'M', -angleRotation, wait = True)
-        takePicture(camera, signals)
-        C.Move(2, 'M', angleRotation, wait = True)
-        # Return to the center
-        C.Move(0, 'M', -1 * sgn * pathHalfLength, wait = True)
+        rotation.Wait()
+        takePicture(grabber, signals)
+        # Return to the center while rotating back
+        C.MoveTogether([(0, 'M', -1 * sgn * pathHalfLength),
+                        (2, 'M', angleRotation)], wait = True)
 
     resetSignals(signals)
     debug_print('Take three pictures procedure finished for plant #' + str(signals['pltCnt']) + '.')
@@ -257,38 +345,59 @@ def resetSignals(signals):
     for t in targets:
         signals[t] = False
 
-def plantIter(C, camera, direction, signals):
+# The span of a whole side belongs to no plant
+@traced('plantIter', plant = None)
+def plantIter(C, grabber, direction, signals):
     """ One iteration of plant imaging """
     
     debug_print('Starting iteration in direction ' + direction + '.')
-    time.sleep(2)
+    pause(2)
     resetSignals(signals)
     
     sgn = 1 if direction == '+' else -1
+    known = rig.Get('plants', {}).get(direction, [])
+    found = []
     
     while not signals['metal']:
-        T_red = threading.Thread(target = findRedObject, args = (C, sgn, signals,))
-        T_red.start()
-        T_red.join()
+        plantStart = time.time()
+        tracer.Set(plant = None)
+        # Driving straight to the next known plant, searching only if it is not there
+        target = nextPlant(known, C.AskSteps(0), sgn)
+        approached = target is not None and approachPlant(C, grabber, target, direction, signals)
+        # After the metal or the stop signal the search must not drive on towards the rail end
+        if not approached and not signals['metal'] and not signals['stop']:
+            if target is not None:
+                debug_print('No plant at ' + str(target[0]) + ' steps. Searching further.')
+            T_red = threading.Thread(target = findRedObject, args = (C, sgn, signals,))
+            T_red.start()
+            T_red.join()
         if signals['metal']:
             debug_print('Metal signal during first red search. Iteration finished.')
             C.Move(0, 'M', -1 * sgn * 5, wait = True)
             resetSignals(signals)
+            savePlantMap(direction, found)
             return
-        if signals['maxTime']:
+        if signals['maxTime'] or signals['stop']:
             signals['stop'] = True
             debug_print('Operation aborted due to stop signal during first red search.')
             return
-    
-        T_green = threading.Thread(target = findGreenObject, args = (C, signals,))
-        T_green.start()
-        T_green.join()
+
+        # The search for the red wire ending at the metal finds no plant,
+        # so the spans belong to the plant only from here on
+        tracer.Set(plant = signals['pltCnt'])
+        x = C.AskSteps(0)
+        match = next((p for p in known if abs(p[0] - x) < MATCH_DISTANCE * C.units[0]), None)
+        if match is None or not approachGreen(C, match[1], signals):
+            T_green = threading.Thread(target = findGreenObject, args = (C, signals,))
+            T_green.start()
+            T_green.join()
         if signals['metal']:
             debug_print('Metal signal during green search. Returning to vertical home position.')
             C.Move(1, 'H', wait = True)
             ret = safeMove(C, 0, 'M', sgn * 15, signals)
             resetSignals(signals)
             if ret == False:
+                savePlantMap(direction, found)
                 return
 
             continue
@@ -296,27 +405,33 @@ def plantIter(C, camera, direction, signals):
             debug_print('Operation aborted due to stop signal during green search.')
             return
 
+        y = C.AskSteps(1)
         C.Move(1, 'M', 15, wait = True)
-        # Searching for red again, as the plant is perhaps not centered now
-        centerPos = C.AskPosition(0)
-        T_red = threading.Thread(target = findRedObject, args = (C, -1 * sgn, signals, 20))
-        T_red.start()
-        T_red.join()
-        if signals['metal']:
-            debug_print('Metal signal during second red search. Returning to latest best position.')
-            C.Move(0, 'M', sgn * abs((C.AskPosition(0) - centerPos)), wait = True)
-        if signals['maxTime']:
-            debug_print('Stop signal during second red search. Returning to latest best position.')
-            C.Move(0, 'M', sgn * abs((C.AskPosition(0) - centerPos)), wait = True)
+        # The plant is perhaps not centered now, the red wire shows how far it is
+        if not centerPlant(C, grabber, direction, signals):
+            debug_print('Centering on the red wire failed. Searching for red again.')
+            centerPos = C.AskPosition(0)
+            T_red = threading.Thread(target = findRedObject, args = (C, -1 * sgn, signals, 20))
+            T_red.start()
+            T_red.join()
+            if signals['metal']:
+                debug_print('Metal signal during second red search. Returning to latest best position.')
+                C.Move(0, 'M', sgn * abs((C.AskPosition(0) - centerPos)), wait = True)
+            if signals['maxTime']:
+                debug_print('Stop signal during second red search. Returning to latest best position.')
+                C.Move(0, 'M', sgn * abs((C.AskPosition(0) - centerPos)), wait = True)
 
         resetSignals(signals)
+        found.append([C.AskSteps(0), y])
         
         # Go down before taking the pictures
         C.Move(1, 'M', -16, wait = True)
-        takeThreePictures(C, camera, signals, sgn)
+        takeThreePictures(C, grabber, signals, sgn)
         if signals['stop']:
             return
             
+        # Horizontal and vertical axis share one metal sensor input,
+        # so these moves stay sequential to know which one hit the metal
         debug_print('Moving up over the plants.')
         safeMove(C, 1, 'M', 70, signals)
         if signals['stop']:
@@ -325,9 +440,145 @@ def plantIter(C, camera, direction, signals):
         debug_print('Moving away from the plant and red wire.')
         ret = safeMove(C, 0, 'M', sgn * 15, signals)
         resetSignals(signals)
+        debug_print('Plant cycle time: ' + str(time.time() - plantStart) + ' secs')
         if ret == False:
+            savePlantMap(direction, found)
             return
 
+def locateRed(grabber):
+    """ Returns the offset in pixels of the red wire from the center of a stable frame """
+    seq, stamp, frame, info = grabber.WaitStable(time.time(), STILL_TIMEOUT / TIME_SCALE)
+    if frame is None:
+        return None
+    return createDetectors(('red',))[0].Locate(frame)
+
+@traced('calibratePixels')
+def calibratePixels(C, grabber, direction, signals):
+    """ Measures how many pixels the red wire shifts per cm of the horizontal motor
+    and stores it in the rig state for the side of the direction. The sign gives
+    the direction of the shift, which is mirrored between the sides because the
+    camera is turned by 180 degrees. Returns the pixels per cm or None if the
+    wire could not be followed. """
+
+    debug_print('Calibrating pixels per cm on side ' + direction + '.')
+    before = locateRed(grabber)
+    if before is None or not safeMove(C, 0, 'M', CALIBRATION_STEP, signals):
+        return None
+    after = locateRed(grabber)
+    C.Move(0, 'M', -CALIBRATION_STEP, wait = True)
+
+    if after is None or abs(after - before) < 1:
+        return None
+    pixelsPerCm = (after - before) / CALIBRATION_STEP
+    saveCalibration(direction, pixelsPerCm)
+    debug_print('Calibration: ' + '%.2f' % pixelsPerCm + ' pixels per cm.')
+    return pixelsPerCm
+
+def saveCalibration(direction, pixelsPerCm):
+    """ Stores the pixels per cm of the side, None forgets it """
+    calibration = rig.Get('calibration', {})
+    calibration[direction] = pixelsPerCm
+    rig.Set('calibration', calibration)
+
+@traced('centerPlant')
+def centerPlant(C, grabber, direction, signals):
+    """ Centers the red wire with a corrective move of the horizontal motor
+    and checks the offset after the move. If the offset grew, the calibration
+    of the side is wrong and is measured again at the next plant.
+    Returns whether the plant is centered. """
+
+    pixelsPerCm = rig.Get('calibration', {}).get(direction) or calibratePixels(C, grabber, direction, signals)
+    if not pixelsPerCm:
+        return False
+
+    offset = locateRed(grabber)
+    if offset is None:
+        return False
+
+    correction = -offset / pixelsPerCm
+    debug_print('Red wire is ' + str(round(offset)) + ' px from the center, correction ' + '%.2f' % correction + ' cm.')
+    if abs(correction) > MAX_CORRECTION:
+        return False
+    if abs(correction) < CENTER_TOLERANCE:
+        return True
+    if not safeMove(C, 0, 'M', correction, signals):
+        return False
+
+    residual = locateRed(grabber)
+    if residual is None:
+        return False
+    debug_print('Red wire is ' + str(round(residual)) + ' px from the center after the correction.')
+    if abs(residual) > abs(offset):
+        debug_print('Correction increased the offset, forgetting the calibration of side ' + direction + '.')
+        saveCalibration(direction, None)
+        return False
+    return abs(residual / pixelsPerCm) < CENTER_TOLERANCE or safeMove(C, 0, 'M', -residual / pixelsPerCm, signals)
+
+def nextPlant(known, x, sgn):
+    """ Returns the nearest known plant [x, y] ahead of the horizontal position x in direction sgn """
+    ahead = [p for p in known if sgn * (p[0] - x) > 0]
+    return min(ahead, key = lambda p: abs(p[0] - x)) if ahead else None
+
+@traced('approachPlant')
+def approachPlant(C, grabber, plant, direction, signals):
+    """ Drives to the known position of the plant, at the travel speed up to
+    SLOWDOWN_DISTANCE cm before it and the rest at the search speed, stopping
+    earlier if red (e.g. of a new plant) is seen on the way. At the position
+    the red wire is looked for in the whole frame and centered.
+    Returns whether the plant is found. """
+
+    distance = (plant[0] - C.AskSteps(0)) / C.units[0]
+    sgn = 1 if distance > 0 else -1
+    fired = None
+    with signals.Detecting('red'):
+        signals['red'] = False
+        if abs(distance) > SLOWDOWN_DISTANCE:
+            C.TravelSpeed(1)
+            motion = C.Move(0, 'M', distance - sgn * SLOWDOWN_DISTANCE)
+            fired = signals.WaitAny(['stop', 'red', 'metal'], motion.Timeout(), motion.IsDone)
+            # The speed is switched back only after the motor stopped
+            if fired is not None:
+                C.Move(0, 'S', wait = True)
+            C.TravelSpeed(0)
+
+        if fired is None:
+            motion = C.Move(0, 'M', (plant[0] - C.AskSteps(0)) / C.units[0])
+            fired = signals.WaitAny(['stop', 'red', 'metal'], motion.Timeout(), motion.IsDone)
+            if fired is not None:
+                C.Move(0, 'S')
+
+    if fired is not None:
+        signals.Acknowledge(fired)
+        return fired == 'red'
+
+    return centerPlant(C, grabber, direction, signals)
+
+@traced('approachGreen')
+def approachGreen(C, y, signals):
+    """ Drives the vertical motor down to just above the known green height,
+    stopping earlier if green is seen. Returns whether green is seen. """
+
+    step = (y - C.AskSteps(1)) / C.units[1] + VERTICAL_MARGIN
+    if step >= 0:
+        return False
+
+    with signals.Detecting('green'):
+        signals['green'] = False
+        motion = C.Move(1, 'M', step)
+        fired = signals.WaitAny(['stop', 'green', 'metal'], motion.Timeout(), motion.IsDone)
+    if fired is not None:
+        C.Move(1, 'S')
+        signals.Acknowledge(fired)
+    return fired == 'green'
+
+def savePlantMap(direction, found):
+    """ Replaces the known plants of the side with the plants of a complete pass """
+    plants = rig.Get('plants', {})
+    plants[direction] = found
+    rig.Set('plants', plants)
+    debug_print('Plant map of side ' + direction + ': ' + str(len(found)) + ' plants.')
+
+@traced('safeMove')
 def safeMove(C, motor, command, step, signals):
     """ Executes a motor command while monitoring the metal sensors.
     If metal is detected on the way, aborts the command and returns the motor back 5 cm's.
@@ -336,22 +587,18 @@ def safeMove(C, motor, command, step, signals):
     debug_print('Doing safe move for motor ' + str(motor) + ' (Command: ' + command + ', Step: ' + str(step)  + ').')
     # Clearing potential old metal signals
     signals['metal'] = False
-    time.sleep(1)
+    pause(1)
 
     success = True
-    start = time.time()
-    now = time.time()
 
-    maxTime = C.Move(motor, command, step) + 5
-
-    while now - start < maxTime and not signals['metal']:
-        time.sleep(.1)
-        now = time.time()
+    motion = C.Move(motor, command, step)
+    signals.WaitAny(['metal'], motion.Timeout(), motion.IsDone)
 
     if signals['metal']:
+        stopping = C.Move(motor, 'S')
+        signals.Acknowledge('metal')
         debug_print('Metal detected during safe move.')
-        C.Move(motor, 'S')
-        time.sleep(1)
+        stopping.Wait(1)
         success = False
 
         sgn = step / abs(step)
@@ -362,93 +609,204 @@ def safeMove(C, motor, command, step, signals):
     return success
 
 def metalCheck(C, signals):
-    """Checking the metal sensor pin """
+    """ Raises the metal signal as soon as the controls report the metal sensor """
     
-    while not signals['finish']:
-        isMetal = C.ReadValues()
-        if isMetal:
-            signals['metal'] = True
-            # Metal signal is ready to be processed
-        
-        time.sleep(0.25)
-        
-    debug_print('Metal check loop is done.')
+    def onMetal():
+        signals['metal'] = True
+    
+    C.Subscribe('Metal', onMetal)
+
+def motionCheck(C, signals):
+    """ Wakes up the threads waiting for signals when a motor reports reaching its target """
+    
+    def onDone(motor, position, *args):
+        signals.Notify()
+    
+    C.Subscribe('Done', onDone)
+
+def terminationCheck(C, signals):
+    """ Stops all motors and the run when the process is terminated (e.g. by
+    scheduleJobs after RUN_TIMEOUT). Otherwise the firmware would finish its
+    last command, e.g. a long move, with nobody handling the metal sensor. """
+
+    def onTerminate(signum, frame):
+        C.StopAll()
+        signals['stop'] = True
+        signals['finish'] = True
+        # debug_print could wait for the lock of the log queue held by the interrupted
+        # main thread, so the message goes straight to the standard error
+        os.write(2, b'Terminated by signal %d, all motors stopped.\n' % signum)
+        raise SystemExit(128 + signum)
+
+    # Signal handlers can be installed only by the main thread
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, onTerminate)
         
 def calibrateCamera(C, signals):
     """Searching the blue wire for camera calibration """
-    
-    resetSignals(signals)
-    debug_print('Calibrating camera')
-    time.sleep(2)
-    if signals['blue']:
-        return
-    
-    # Search on one side
-    C.CameraSpeed(0)
-    max_time = C.Move(2, 'M', 180) + 1
-    now = time.time()
-    while time.time() - now < max_time:
-        if any([signals['stop'], signals['blue']]):
+
+    with signals.Detecting('blue'):
+        resetSignals(signals)
+        debug_print('Calibrating camera')
+        pause(2)
+        if signals['blue']:
+            return
+
+        # Search on one side
+        C.CameraSpeed(0)
+        motion = C.Move(2, 'M', 180)
+        if signals.WaitAny(['stop', 'blue'], motion.Timeout(1), motion.IsDone):
             C.Move(2, 'S')
             C.CameraSpeed(1)
             return
-    
-    # Return to the starting point
-    C.CameraSpeed(1)
-    C.Move(2, 'M', -180, wait = True)
-    C.CameraSpeed(0)
-    
-    max_time = C.Move(2, 'M', -180) + 1
-    
-    # Search on the other side
-    now = time.time()
-    while time.time() - now < max_time:
-        if any([signals['stop'], signals['blue']]):
+
+        # Return to the starting point
+        C.CameraSpeed(1)
+        C.Move(2, 'M', -180, wait = True)
+        C.CameraSpeed(0)
+
+        motion = C.Move(2, 'M', -180)
+
+        # Search on the other side
+        if signals.WaitAny(['stop', 'blue'], motion.Timeout(1), motion.IsDone):
             C.Move(2, 'S')
             C.CameraSpeed(1)
             return
 
-    debug_print('Calibrating unsuccessful. Aborting operation.')
-    signals['stop'] = True
+        debug_print('Calibrating unsuccessful. Aborting operation.')
+        signals['stop'] = True
 
 def stopRoutine(C, signals):
     """ A routine to be called upon finishing.
     Return all motors to their home positions and turns off the lights. """
     
     debug_print('Stop routine called.')
-    for i in range(4):
+    # Camera and canvas motors are independent of the rails and return in parallel
+    debug_print('Returning motors 2 and 3 to home position.')
+    group = C.MoveTogether([(i, 'M', -1 * C.AskPosition(i)) for i in (2, 3)])
+    
+    for i in range(2):
         debug_print('Returning motor ' + str(i) + ' to home position.')
         homePos = C.AskPosition(i)
         safeMove(C, i, 'M', -1 * homePos, signals)
         homePos = C.AskPosition(i)
-        
+    
+    group.Wait()
     C.Lights(0)
     
+def abortRun(C, signals, T_cam, grabber, preview):
+    """ Returns the motors home after the stop signal and finishes all threads.
+    The pictures taken so far are written and uploaded. """
+    
+    stopRoutine(C, signals)
+    writeSummary(signals)
+    signals['finish'] = True
+    T_cam.join()
+    grabber.Stop()
+    closePreview(preview)
+    image_writer.Close()
+    if uploader is not None:
+        uploader.Close()
+    logger.Close()
+
+def writeSummary(signals):
+    """ Writes the time breakdown, the signal latencies and the timer jitter
+    (with MEASURE_JITTER) to the log and closes the trace """
+    
+    jitter.Stop()
+    for line in tracer.Summary() + signals.Summary() + jitter.Summary():
+        debug_print(line)
+    tracer.Close()
+    
+def startPreview(signals):
+    """ Starts the MJPEG preview on PREVIEW_PORT.
+    Its stop endpoint raises the stop signal like the 'q' key of the camera window """
+    
+    if not PREVIEW_PORT:
+        return None
+    
+    def stop():
+        signals['stop'] = True
+    
+    try:
+        preview = PreviewServer(PREVIEW_PORT, onStop = stop)
+    except OSError as e:
+        debug_print('Preview is not started: ' + str(e))
+        return None
+    
+    preview.Start()
+    debug_print('Preview is available on port ' + str(PREVIEW_PORT) + '.')
+    return preview
+
+def startVision(camera, signals, preview, record = None):
+    """ Starts the capture and the detection, in the vision process with VISION_PROCESS.
+    Returns the grabber of the stills and the (not started) thread of the camera loop,
+    or (None, None) if the camera is not opened. The detection frames are recorded
+    to the directory record if given. """
+    
+    if VISION_PROCESS:
+        grabber = VisionWorker(camera, levels = DETECT_LEVELS, detectSize = DETECT_SIZE, samples = COLOR_SAMPLES, record = record)
+        if not grabber.Start():
+            return None, None
+        return grabber, threading.Thread(target = grabber.Serve, args = (signals, preview, ))
+    
+    cam = cv2.VideoCapture(camera) if isinstance(camera, int) else camera
+    pause(1)
+    if not cam.isOpened():
+        return None, None
+    
+    grabber = FrameGrabber(cam, DETECT_LEVELS, DETECT_SIZE)
+    grabber.Start()
+    recorder = FrameRecorder(record) if record else None
+    return grabber, threading.Thread(target = cameraLoop, args = (grabber, signals, HEADLESS, preview, recorder, ))
+
+def closePreview(preview):
+    if preview is not None:
+        preview.Close()
+    
 def uploadCloudFolder(folder):
+    """ Uploads the files of the folder which were not uploaded during the run """
     debug_print('Uploading to cloud folder started.')
-    subprocess.call(['/home/pi/Dropbox-Uploader/dropbox_uploader.sh -q upload ' + folder + ' .'], shell = True)
+    logger.Flush()
+    uploader.Sync()
+    uploader.Close()
+    pending = uploader.Pending()
+    if pending:
+        debug_print('Not uploaded: ' + ', '.join(pending))
     debug_print('Uploading to cloud folder completed.')
     
 def sendDoneMail(log):
+    """ Puts the report in the outbox and tries to send it once before the process
+    exits, so the delivery is not cut off in the middle. A failed delivery never
+    stops the run, the mail stays in the outbox for scheduleJobs.flushOutbox. """
     sbj = "iGrower: Izvještaj"
     txt = "(" + str(datetime.datetime.now())[:-7:] + ") Snimanje Filakov je završeno."
 
-    send_mail(config.mail['username'], config.mail['recipients'], sbj, txt, [log],
-              config.mail['server'], config.mail['port'],
-              config.mail['username'], config.mail['password'], True)
+    global outbox
+    try:
+        if outbox is None:
+            outbox = outboxFromConfig()
+        outbox.Enqueue(config.mail['username'], config.mail['recipients'], sbj, txt, [log])
+        outbox.DeliverWithRetry(attempts = 1)
+    except Exception as e:
+        debug_print('The report was not put in the outbox: ' + str(e))
 
 ############################ Main program ############################
-def run():
-    signals = { 'green'  : False,
-                'red'    : False,
-                'blue'   : False,
-                'stop'   : False,
-                'metal'  : False,
-                'maxTime': False,
-                'finish' : False,
-                'path'   : '/home/pi/Filakov/',
-                'pltCnt': 1,
-                'imgCnt' : 1 }
+def run(port = "/dev/ttyACM0", camera = 0, path = '/home/pi/Filakov/', report = True):
+    """ Images all plants. camera is the index of the video capture device
+    or an object with the interface of cv2.VideoCapture. Without report
+    the pictures are not uploaded and the mail is not sent. """
+
+    signals = Signals({ 'green'  : False,
+                        'red'    : False,
+                        'blue'   : False,
+                        'stop'   : False,
+                        'metal'  : False,
+                        'maxTime': False,
+                        'finish' : False,
+                        'path'   : path,
+                        'pltCnt': 1,
+                        'imgCnt' : 1 })
     
     start = time.time()
     
@@ -462,33 +820,46 @@ def run():
         debug_print('Folder for pictures was not created. Aborting program...')
         return
 
-    global output_file
-    output_file = open(signals['path'] + 'log.txt', 'w', encoding='utf-8')
+    logger.Open(signals['path'] + 'log.txt')
+    # Pictures are uploaded as soon as they are written
+    global image_writer, uploader, rig
+    rig = RigState(path + 'rig_state.json')
+    uploader = Uploader(signals['path'], DropboxBackend()) if report else None
+    image_writer = ImageWriter(IMAGE_FORMAT, PNG_COMPRESSION, JPEG_QUALITY,
+                               onWritten = uploader.Enqueue if uploader is not None else None)
+    tracer.Open(signals['path'] + 'trace.jsonl')
 
-    C = Controls("/dev/ttyACM0", output_file)
+    C = Controls(port)
     if not C.started:
         debug_print("Controls of the motors are not started. Aborting program...")
-        output_file.close()
+        logger.Close()
         return
     
-    cam = cv2.VideoCapture(0)
-    time.sleep(1)
-    if not cam.isOpened():
+    record = None
+    if RECORD_FRAMES:
+        pruneRecordings(RECORD_DIRECTORY, RECORD_RUNS - 1)
+        record = RECORD_DIRECTORY + directory
+    
+    preview = startPreview(signals)
+    grabber, T_cam = startVision(camera, signals, preview, record)
+    if grabber is None:
         debug_print("Camera is not opened. Aborting program...")
-        output_file.close()
+        closePreview(preview)
+        logger.Close()
         return
-
     
     # Run the process
-    T_metal = threading.Thread(target = metalCheck, args = (C, signals, ))
-    T_cam = threading.Thread(target = cameraLoop, args = (cam, signals, ))
-    T_metal.start()
+    metalCheck(C, signals)
+    motionCheck(C, signals)
+    terminationCheck(C, signals)
     T_cam.start()
+    if MEASURE_JITTER:
+        jitter.Start()
 
-    # Canvas down
-    C.Move(3, 'M', 250, wait = True)
-    
+    # Canvas down while the camera rotates
     C.Lights(1)
+    C.MoveTogether([(3, 'M', 250), (2, 'M', 180)], wait = True)
+    
     # Camera calibration
 #    C.Move(2, 'M', 180, wait = True)
 #    calibrateCamera(C, signals)
@@ -496,62 +867,59 @@ def run():
 #        stopRoutine(C, signals)
 #        return
 
-    C.Move(2, 'M', 180, wait = True)
 #    debug_print('Camera calibrated successfully.')
 
     # First iteration of plant imaging
-    plantIter(C, cam, '-', signals)
+    plantIter(C, grabber, '-', signals)
+    tracer.Set(plant = None)
     if signals['stop']:
-        stopRoutine(C, signals)
-        signals['finish'] = True
-        T_cam.join()
-        T_metal.join()
-        output_file.close()
+        abortRun(C, signals, T_cam, grabber, preview)
         return
 
     # Second iteration of plant imaging
     debug_print('Preparing plant imaging on the other side.')
     C.Move(2, 'M', -180, wait = True)
-    plantIter(C, cam, '+', signals)
+    plantIter(C, grabber, '+', signals)
+    tracer.Set(plant = None)
     if signals['stop']:
-        stopRoutine(C, signals)
-        signals['finish'] = True
-        T_cam.join()
-        T_metal.join()
-        output_file.close()
+        abortRun(C, signals, T_cam, grabber, preview)
         return
 
     # Finishing routine
-    debug_print('Vertical motor returning to home position.')
-    C.Move(1, 'H', wait = True)
+    debug_print('Vertical motor returning to home position, canvas up.')
+    C.MoveTogether([(1, 'H', 0), (3, 'M', -250)], wait = True)
     debug_print('Job done: ' + str(time.time() - start) + ' secs')
+    writeSummary(signals)
 
     signals['finish'] = True
     T_cam.join()
-    T_metal.join()
+    grabber.Stop()
+    closePreview(preview)
     C.Lights(0)
-    # Canvas up
-    C.Move(3, 'M', -250, wait = True)
     C.Close()
     
-    uploadCloudFolder(signals['path'])
-    output_file.close()
-    sendDoneMail(signals['path'] + 'log.txt')
+    # All pictures are written before the upload
+    image_writer.Close()
+    if report:
+        uploadCloudFolder(signals['path'])
+    logger.Close()
+    if report:
+        sendDoneMail(signals['path'] + 'log.txt')
 
 ############################ End #####################################
 
 ############################ Temp program ############################
-def temp_run():
-    temp_signals = { 'green'  : False,
-                    'red'    : False,
-                    'blue'   : False,
-                    'stop'   : False,
-                    'metal'  : False,
-                    'maxTime': False,
-                    'finish' : False,
-                    'path'   : '/home/pi/Filakov/',
-                    'pltCnt': 1,
-                    'imgCnt' : 1 }
+def temp_run(path = '/home/pi/Filakov/'):
+    temp_signals = Signals({ 'green'  : False,
+                             'red'    : False,
+                             'blue'   : False,
+                             'stop'   : False,
+                             'metal'  : False,
+                             'maxTime': False,
+                             'finish' : False,
+                             'path'   : path,
+                             'pltCnt': 1,
+                             'imgCnt' : 1 })
 
     C = Controls("/dev/ttyACM0")
     if not C.started:
@@ -559,15 +927,15 @@ def temp_run():
         return
     
     time.sleep(3)
-    cam = cv2.VideoCapture(0)
-    time.sleep(1)
-    if not cam.isOpened():
+    preview = startPreview(temp_signals)
+    grabber, T_cam = startVision(0, temp_signals, preview)
+    if grabber is None:
         debug_print("Camera is not opened. Aborting program...")
+        closePreview(preview)
         return
     
-    T_metal = threading.Thread(target = metalCheck, args = (C, temp_signals, ))
-    T_cam = threading.Thread(target = cameraLoop, args = (cam, temp_signals, ))
-    T_metal.start()
+    metalCheck(C, temp_signals)
+    motionCheck(C, temp_signals)
     T_cam.start()
 
 #    calibrateCamera(C, temp_signals)
@@ -578,14 +946,14 @@ def temp_run():
 
     safeMove(C, 2, 'M', -90, temp_signals)
 
-    while True:
-        time.sleep(.5)
-        if temp_signals['stop']:
-            temp_signals['finish'] = True
-            break
+    # All detectors run for the preview until the stop signal
+    with temp_signals.Detecting('red', 'green', 'blue'):
+        temp_signals.WaitAny(['stop'])
+    temp_signals['finish'] = True
 
     T_cam.join()
-    T_metal.join()
+    grabber.Stop()
+    closePreview(preview)
 #    C.Lights(0)
     C.Close()
     
@@ -5,57 +5,135 @@
 # nohup python3 /home/pi/iGrower/igrower/scheduleJobs.py > /home/pi/Filakov/output.txt &
 #######################################
 
-import schedule
-import time
+import collections
 import datetime
-import runSystem
-
-def timedelta2seconds(td):
-    """ Converts a datetime.timedelta object in format %H:%M:%S to seconds
-    """
-    L = list(map(int, str(td).split(':')))
-    return (L[0] * 60 + L[1]) * 60 + L[2]
-    
-def todayDecimal():
-    """ Returns the current day of the year as a decimal number.
-    Return value is in range [0, 365].
-    """
-    now = datetime.datetime.now()
-    return int(now.strftime("%j")) - 1
-
-def sunrise_job():
-    """ Function called at a fixed time in the morning.
-    Waits until today's sunrise and runs the system afterwards.    
-    """
-
-    s1 = '5:00:00'
-    sun = open('/home/pi/iGrower/igrower/sunrise_times.txt', 'r')
-    sunrises = [x.split()[1] for x in sun.readlines()]
-    sun.close()
-    s2 = sunrises[todayDecimal()]
-    
-    FMT = '%H:%M:%S'
-    print("Now:", datetime.datetime.now(), "\nWaiting for sunrise...", s2, flush=True)
-    td = datetime.datetime.strptime(s2, FMT) - datetime.datetime.strptime(s1, FMT)
-    secs = timedelta2seconds(td)
-    time.sleep(secs)
-
-    print("It's sunrise. Work started...", datetime.datetime.now(), flush=True)
-    runSystem.run()
-    print("Job ended...\n", datetime.datetime.now(), flush=True)
+import heapq
+import json
+import os
+import subprocess
+import sys
+import time
+from sunEphemeris import LOCATION, sunEvent
+
+# Every run is a fresh process, the scheduler never imports cv2 or runSystem
+RUNNER = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runSystem.py')]
+RUN_TIMEOUT = 3 * 3600
+STOP_GRACE = 60
+STATE_FILE = '/home/pi/Filakov/schedule_state.json'
+
+# A job whose deadline passed less than CATCH_UP ago (e.g. during a reboot) still runs
+CATCH_UP = datetime.timedelta(hours = 2)
+# Longest sleep, so the deadlines follow corrections of the clock
+MAX_SLEEP = 600
+
+# event - 'sunrise', 'noon' or 'sunset', delay - minutes after the event
+Job = collections.namedtuple('Job', 'name event delay enabled')
+JOBS = [Job('sunrise', 'sunrise', 29, True),
+        Job('midday', 'noon', 0, False),
+        Job('sunset', 'sunset', -90, False)]
+
+def deadline(job, day):
+    """ Returns the start of the job on the date, None if the event does not happen """
+    t = sunEvent(day, job.event, LOCATION)
+    return None if t is None else t + datetime.timedelta(minutes = job.delay)
+
+def nextDeadline(job, after):
+    """ Returns the first start of the job later than after """
+    day = after.date()
+    for i in range(366):
+        t = deadline(job, day + datetime.timedelta(days = i))
+        if t is not None and t > after:
+            return t
+    return None
+
+def loadState():
+    try:
+        with open(STATE_FILE) as f:
+            return { name: datetime.datetime.fromisoformat(t) for name, t in json.load(f).items() }
+    except (OSError, ValueError):
+        return {}
+
+def saveState(state):
+    tmp = STATE_FILE + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({ name: t.isoformat() for name, t in state.items() }, f)
+    os.replace(tmp, STATE_FILE)
+
+def initialHeap(jobs, state, now):
+    """ Returns the heap of (deadline, job) with the missed recent deadlines due now """
+    heap = []
+    for job in jobs:
+        if not job.enabled:
+            continue
+        t = nextDeadline(job, now - CATCH_UP)
+        if t is not None and t <= now and state.get(job.name, datetime.datetime.min) >= t:
+            # Already done before the restart
+            t = nextDeadline(job, now)
+        if t is not None:
+            heapq.heappush(heap, (t, job.name, job))
+    return heap
+
+def runJob(job):
+    """ Runs the imaging in a new process, stopping it after RUN_TIMEOUT secs """
+
+    print("Work started (%s)..." % job.name, datetime.datetime.now(), flush=True)
+    proc = subprocess.Popen(RUNNER)
+    try:
+        code = proc.wait(timeout = RUN_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        print("The run exceeded %d secs, stopping it..." % RUN_TIMEOUT, flush=True)
+        proc.terminate()
+        try:
+            code = proc.wait(timeout = STOP_GRACE)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            code = proc.wait()
+    print("Job ended with code %d..." % code, datetime.datetime.now(), flush=True)
+
+def flushOutbox():
+    """ Sends the mails which the runs left in the outbox """
+    try:
+        from mailOutbox import outboxFromConfig
+        outboxFromConfig().DeliverWithRetry(attempts = 3)
+    except Exception as e:
+        print("Sending the outbox failed:", e, flush=True)
+
+def loop(jobs = JOBS):
+    state = loadState()
+    heap = initialHeap(jobs, state, datetime.datetime.now())
+
+    while heap:
+        t, name, job = heap[0]
+        print("Next job: %s at %s" % (name, t), flush=True)
+        while True:
+            secs = (t - datetime.datetime.now()).total_seconds()
+            if secs <= 0:
+                break
+            time.sleep(min(secs, MAX_SLEEP))
+
+        heapq.heappop(heap)
+        if datetime.datetime.now() - t > CATCH_UP:
+            # The previous run took the time of this one
+            print("Skipping %s of %s..." % (name, t), flush=True)
+        else:
+            runJob(job)
+            state[name] = t
+            try:
+                saveState(state)
+            except OSError as e:
+                print("Saving the state failed:", e, flush=True)
+            flushOutbox()
+
+        t = nextDeadline(job, max(t, datetime.datetime.now()))
+        if t is not None:
+            heapq.heappush(heap, (t, name, job))
 
 ################################ MAIN PROGRAM ################################
 if __name__ == "__main__":
     print("Getting ready to start jobs... (%s)" % datetime.datetime.now(), flush=True)
-    schedule.every().day.at('05:00').do(sunrise_job)
-
-    flag = True
-    while flag:
-        try:
-            schedule.run_pending()
-            time.sleep(60)
-        except Exception as e:
-            print(str(e), flush=True)
-            print("Jobs shut down...(%s)" % datetime.datetime.now(), flush=True)
-            flag = False
+    try:
+        loop()
+    except Exception as e:
+        print(str(e), flush=True)
+    print("Jobs shut down...(%s)" % datetime.datetime.now(), flush=True)
 ##############################################################################
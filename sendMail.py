@@ -2,6 +2,7 @@
 # Hotmail: (smtp.live.com, 25)
 # Gmail: (smtp.gmail.com, 587) - Activation of less secure apps needed (https://myaccount.google.com/lesssecureapps)
 
+import gzip
 import smtplib
 import os.path
 from email.mime.multipart import MIMEMultipart
@@ -10,8 +11,8 @@ from email.mime.text import MIMEText
 from email.utils import COMMASPACE, formatdate
 from email import encoders
 
-def send_mail(send_from, send_to, subject, message, files=[], server="localhost", port=587, username='', password='', use_tls=True):
-    """ Compose and send email with provided info and attachments.
+def compose_mail(send_from, send_to, subject, message, files=[], compress_over=None):
+    """ Compose email with provided info and attachments.
 
     Arguments:
         send_from (str): Sender address
@@ -19,11 +20,7 @@ def send_mail(send_from, send_to, subject, message, files=[], server="localhost"
         subject (str): Message title
         message (str): Message body
         files (list[str]): List of file paths to be attached to email
-        server (str): Mail server host name
-        port (int): Port number
-        username (str): Server auth username
-        password (str): Server auth password
-        use_tls (bool): use TLS mode """
+        compress_over (int): Attachments larger than this many bytes are gzipped (None - never) """
 
     msg = MIMEMultipart()
     msg['From'] = send_from
@@ -34,16 +31,47 @@ def send_mail(send_from, send_to, subject, message, files=[], server="localhost"
     msg.attach(MIMEText(message))
 
     for path in files:
-        part = MIMEBase('application', "octet-stream")
+        name = os.path.basename(path)
         with open(path, 'rb') as file:
-            part.set_payload(file.read())
+            data = file.read()
+        if compress_over is not None and len(data) > compress_over:
+            data = gzip.compress(data)
+            name += '.gz'
+
+        part = MIMEBase('application', "octet-stream")
+        part.set_payload(data)
         encoders.encode_base64(part)
-        part.add_header('Content-Disposition', 'attachment; filename="{}"'.format(os.path.basename(path)))
+        part.add_header('Content-Disposition', 'attachment; filename="{}"'.format(name))
         msg.attach(part)
 
-    smtp = smtplib.SMTP(server, port)
+    return msg
+
+def open_session(server="localhost", port=587, username='', password='', use_tls=True):
+    """ Connect and log in to the mail server, the session can send several messages """
+
+    smtp = smtplib.SMTP(server, port, timeout=30)
     if use_tls:
         smtp.starttls()
-    smtp.login(username, password)
+    if username:
+        smtp.login(username, password)
+    return smtp
+
+def send_mail(send_from, send_to, subject, message, files=[], server="localhost", port=587, username='', password='', use_tls=True):
+    """ Compose and send email with provided info and attachments.
+
+    Arguments:
+        send_from (str): Sender address
+        send_to (list[str]): Recipient address
+        subject (str): Message title
+        message (str): Message body
+        files (list[str]): List of file paths to be attached to email
+        server (str): Mail server host name
+        port (int): Port number
+        username (str): Server auth username
+        password (str): Server auth password
+        use_tls (bool): use TLS mode """
+
+    msg = compose_mail(send_from, send_to, subject, message, files)
+    smtp = open_session(server, port, username, password, use_tls)
     smtp.sendmail(send_from, send_to, msg.as_string())
     smtp.quit()
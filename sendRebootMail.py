@@ -1,10 +1,12 @@
-from sendMail import send_mail
+from mailOutbox import outboxFromConfig
 import config
 import datetime
 
 sbj = "iGrower: Ponovno pokrenuto računalo"
 txt = "(" + str(datetime.datetime.now())[:-7:] + ") RPi-Filakov je ponovno pokrenut."
 
-send_mail(config.mail['username'], config.mail['recipients'], sbj, txt, [],
-          config.mail['server'], config.mail['port'],
-          config.mail['username'], config.mail['password'], True)
\ No newline at end of file
+# The network may not be up yet at boot, the delivery is retried with backoff.
+# Messages left in the outbox by earlier runs are sent in the same session.
+outbox = outboxFromConfig()
+outbox.Enqueue(config.mail['username'], config.mail['recipients'], sbj, txt)
+outbox.DeliverWithRetry(attempts = 8, backoff = 15)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets in ms
+LATENCY_BUCKETS = [.1, .2, .5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf')]
+
+class Signals:
+    def __init__(self, values):
+        """ Thread-safe replacement of the signals dictionary.
+        Reading and assigning work as with a dictionary, but every assignment
+        wakes up the threads waiting in WaitAny. The time a signal is raised is
+        kept, so the latency until it is handled can be recorded with Acknowledge. """
+
+        self.cond = threading.Condition()
+        self.values = dict(values)
+        self.raised = {}
+        self.latencies = {}
+        self.active = {}
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        with self.cond:
+            if value is True and self.values.get(key) is not True:
+                self.raised[key] = time.perf_counter()
+            self.values[key] = value
+            self.cond.notify_all()
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def Notify(self):
+        """ Wakes up the waiting threads, e.g. when the condition given to WaitAny changed """
+        with self.cond:
+            self.cond.notify_all()
+
+    def WaitAny(self, names, timeout = None, until = None):
+        """ Waits until one of the signals is raised, the function until returns True
+        or timeout secs pass. Returns the name of the first raised signal or None """
+
+        def ready():
+            return any(self.values[n] for n in names) or (until is not None and until())
+
+        with self.cond:
+            self.cond.wait_for(ready, timeout)
+            for n in names:
+                if self.values[n]:
+                    return n
+        return None
+
+    @contextlib.contextmanager
+    def Detecting(self, *names):
+        """ Marks the detectors as needed during the with-block of a phase """
+        with self.cond:
+            for n in names:
+                self.active[n] = self.active.get(n, 0) + 1
+            self.cond.notify_all()
+        try:
+            yield
+        finally:
+            with self.cond:
+                for n in names:
+                    self.active[n] -= 1
+                    if not self.active[n]:
+                        del self.active[n]
+                # The camera loop stops the detectors the phase needed right away
+                self.cond.notify_all()
+
+    def Active(self):
+        """ Returns the names of the detectors needed by the running phases """
+        with self.cond:
+            return set(self.active)
+
+    def WaitActive(self, timeout = None):
+        """ Waits until a phase needs a detector. Returns whether one is needed """
+        with self.cond:
+            return bool(self.cond.wait_for(lambda: self.active, timeout))
+
+    def Acknowledge(self, name):
+        """ Records the time from raising the signal until now in its latency histogram """
+
+        with self.cond:
+            raised = self.raised.pop(name, None)
+        if raised is None:
+            return None
+
+        latency = 1000 * (time.perf_counter() - raised)
+        hist = self.latencies.setdefault(name, { 'counts': [0] * len(LATENCY_BUCKETS),
+                                                 'sum': 0,
+                                                 'max': 0 })
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                hist['counts'][i] += 1
+                break
+        hist['sum'] += latency
+        hist['max'] = max(hist['max'], latency)
+        return latency
+
+    def Summary(self):
+        """ Returns the latency histograms as a list of lines """
+
+        lines = []
+        for name, hist in sorted(self.latencies.items()):
+            n = sum(hist['counts'])
+            lines.append('Signal %s handled %d times, mean %.2f ms, max %.2f ms' % (name, n, hist['sum'] / n, hist['max']))
+            for bound, count in zip(LATENCY_BUCKETS, hist['counts']):
+                if count:
+                    lines.append('    <= %s ms: %d' % (bound, count))
+        return lines
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+#######################################
+# Sunrise, solar noon and sunset for any location and date
+# USAGE (checking against the old table):
+# python3 sunEphemeris.py --check sunrise_times.txt --delay 29
+#######################################
+
+import argparse
+import collections
+import datetime
+import functools
+import numpy as np
+from zoneinfo import ZoneInfo
+
+Location = collections.namedtuple('Location', 'lat lon tz')
+
+# Fitted to sunrise_times.txt, which was computed for this location and
+# shifted by about half an hour (the delay of the sunrise job in scheduleJobs.JOBS)
+LOCATION = Location(45.8, 18.4, 'Europe/Zagreb')
+
+# Centre of the sun 50' below the horizon: refraction and the solar radius
+ZENITH = 90.833
+EVENTS = ('sunrise', 'noon', 'sunset')
+
+def solarMinutes(lat, lon, days, yearLength, zenith = ZENITH):
+    """ Returns the sunrise, the solar noon and the sunset in minutes after
+    midnight UTC for the array of days of the year (1 = January 1st), using the
+    NOAA approximation (about a minute of error). Events which do not happen
+    on a day (polar day or night) are NaN. """
+
+    gamma = 2 * np.pi / yearLength * (np.asarray(days, dtype = np.float64) - 1)
+    eqtime = 229.18 * (0.000075 + 0.001868 * np.cos(gamma) - 0.032077 * np.sin(gamma)
+                       - 0.014615 * np.cos(2 * gamma) - 0.040849 * np.sin(2 * gamma))
+    decl = (0.006918 - 0.399912 * np.cos(gamma) + 0.070257 * np.sin(gamma)
+            - 0.006758 * np.cos(2 * gamma) + 0.000907 * np.sin(2 * gamma)
+            - 0.002697 * np.cos(3 * gamma) + 0.00148 * np.sin(3 * gamma))
+
+    phi = np.radians(lat)
+    cosHa = np.cos(np.radians(zenith)) / (np.cos(phi) * np.cos(decl)) - np.tan(phi) * np.tan(decl)
+    cosHa[np.abs(cosHa) > 1] = np.nan
+    ha = np.degrees(np.arccos(cosHa))
+
+    noon = 720 - 4 * lon - eqtime
+    return noon - 4 * ha, noon, noon + 4 * ha
+
+def utcOffsets(tz, year):
+    """ Returns the offset of the local time from UTC in minutes for every day of the year """
+    zone = ZoneInfo(tz)
+    first = datetime.date(year, 1, 1).toordinal()
+    length = datetime.date(year + 1, 1, 1).toordinal() - first
+
+    # Taken at noon, the daylight saving time changes during the night
+    return np.array([datetime.datetime.combine(datetime.date.fromordinal(first + i), datetime.time(12), zone)
+                     .utcoffset().total_seconds() / 60 for i in range(length)])
+
+@functools.lru_cache(maxsize = 8)
+def yearTable(location, year):
+    """ Returns the local times of the events for every day of the year as a
+    read-only float32 array of shape (days, 3) in minutes after midnight.
+    Results are cached per location and year. """
+
+    offsets = utcOffsets(location.tz, year)
+    days = np.arange(1, len(offsets) + 1)
+    events = solarMinutes(location.lat, location.lon, days, len(offsets))
+
+    table = np.stack(events, axis = 1) + offsets[:, None]
+    table = table.astype(np.float32)
+    table.flags.writeable = False
+    return table
+
+def sunEvent(day, event = 'sunrise', location = LOCATION):
+    """ Returns the local time of the event on the date as a naive datetime,
+    or None if the sun does not rise or set on that day """
+
+    minutes = yearTable(location, day.year)[day.timetuple().tm_yday - 1, EVENTS.index(event)]
+    if np.isnan(minutes):
+        return None
+    return datetime.datetime.combine(day, datetime.time()) + datetime.timedelta(minutes = float(minutes))
+
+def formatMinutes(minutes):
+    secs = int(round(minutes * 60))
+    return '%d:%02d:%02d' % (secs // 3600, secs % 3600 // 60, secs % 60)
+
+def readTable(path):
+    """ Reads a table of lines 'Y-M-D H:MM:SS', returns the dates and the times in minutes """
+    dates, minutes = [], []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                d, t = line.split()
+                h, m, s = map(int, t.split(':'))
+                dates.append(datetime.date(*map(int, d.split('-'))))
+                minutes.append(h * 60 + m + s / 60)
+    return dates, np.array(minutes)
+
+def compareTable(path, location = LOCATION, delay = 0, event = 'sunrise'):
+    """ Returns the dates of the table and the differences between the table
+    and the computed times (plus delay minutes) in minutes """
+
+    dates, minutes = readTable(path)
+    computed = np.array([yearTable(location, d.year)[d.timetuple().tm_yday - 1, EVENTS.index(event)] for d in dates])
+    return dates, minutes - (computed + delay)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--check', default = 'sunrise_times.txt', help = 'table of sunrises to compare')
+    ap.add_argument('--delay', type = float, default = 0, help = 'minutes between the sunrise and the table')
+    ap.add_argument('--lat', type = float, default = LOCATION.lat)
+    ap.add_argument('--lon', type = float, default = LOCATION.lon)
+    ap.add_argument('--tz', default = LOCATION.tz)
+    args = ap.parse_args()
+
+    dates, diff = compareTable(args.check, Location(args.lat, args.lon, args.tz), args.delay)
+    print('Days: %d  mean difference %.1f min  largest %.1f min' % (len(dates), diff.mean(), np.abs(diff).max()))
+    for d, x in zip(dates, diff):
+        # An hour off means the table changes the daylight saving time on another day
+        if abs(x) > 5:
+            print('   ', d, '%+.1f min' % x)
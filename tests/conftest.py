@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+import importlib.util
+import os
+import sys
+import types
+
+# The modules of the rig are at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config.py with the mail account exists only on the rig, runSystem imports it
+if importlib.util.find_spec('config') is None:
+    config = types.ModuleType('config')
+    config.mail = { 'server'    : 'localhost',
+                    'port'      : 587,
+                    'username'  : 'rig@localhost',
+                    'password'  : '',
+                    'recipients': ['owner@localhost'] }
+    sys.modules['config'] = config
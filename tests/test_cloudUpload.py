@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import os
+from cloudUpload import LocalBackend, Uploader, MANIFEST
+
+class CountingBackend(LocalBackend):
+    """ LocalBackend recording the remote names of the uploads """
+
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.uploaded = []
+
+    def Upload(self, path, remote):
+        self.uploaded.append(remote)
+        return super().Upload(path, remote)
+
+def writeFile(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def upload(folder, backend):
+    uploader = Uploader(str(folder), backend)
+    uploader.Sync()
+    uploader.Close()
+    return uploader
+
+def test_manifest_skips_unchanged_and_resends_changed(tmp_path):
+    folder, cloud = tmp_path / 'run', tmp_path / 'cloud'
+    folder.mkdir()
+    writeFile(folder / 'img1_1.png', b'first')
+    writeFile(folder / 'img1_2.png', b'second')
+
+    first = CountingBackend(str(cloud))
+    assert upload(folder, first).Pending() == []
+    assert sorted(first.uploaded) == ['run/img1_1.png', 'run/img1_2.png']
+    assert os.path.exists(folder / MANIFEST)
+
+    # A new uploader (e.g. after a restart) reads the manifest
+    writeFile(folder / 'img1_2.png', b'second, changed')
+    second = CountingBackend(str(cloud))
+    assert upload(folder, second).Pending() == []
+    assert second.uploaded == ['run/img1_2.png']
+    assert (cloud / 'run' / 'img1_2.png').read_bytes() == b'second, changed'
+
+    third = CountingBackend(str(cloud))
+    upload(folder, third)
+    assert third.uploaded == []
+
+def test_failed_upload_is_pending_and_retried(tmp_path):
+    folder = tmp_path / 'run'
+    folder.mkdir()
+    writeFile(folder / 'log.txt', b'log')
+
+    class FailingBackend:
+        def Upload(self, path, remote):
+            return False
+
+    failed = Uploader(str(folder), FailingBackend(), retries = 1)
+    failed.Sync()
+    failed.Close()
+    assert failed.Pending() == ['log.txt']
+
+    backend = CountingBackend(str(tmp_path / 'cloud'))
+    assert upload(folder, backend).Pending() == []
+    assert backend.uploaded == ['run/log.txt']
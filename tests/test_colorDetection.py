@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import cv2
+import numpy as np
+import pytest
+from colorDetection import DETECTORS, createDetectors
+from runSystem import extractColor, middleSquare
+
+def syntheticFrame(rows, cols, seed):
+    """ Random frame with a patch in the bounds of every detector """
+    rng = np.random.default_rng(seed)
+    frame = rng.integers(0, 256, (rows, cols, 3), dtype = np.uint8)
+    for lower, upper in (d['bounds'] for d in DETECTORS.values()):
+        h, w = rng.integers(1, rows + 1), rng.integers(1, cols + 1)
+        top, left = rng.integers(0, rows - h + 1), rng.integers(0, cols - w + 1)
+        frame[top : top + h, left : left + w] = rng.integers(lower, np.array(upper) + 1, (h, w, 3))
+    return frame
+
+def reference(frame, d):
+    image = cv2.medianBlur(frame, d.blur) if d.blur else frame
+    return middleSquare(extractColor(image, (d.lower, d.upper)), *d.square)
+
+# Full size, smaller and odd sizes, and frames smaller than the strides of the squares
+@pytest.mark.parametrize('rows, cols', [(480, 640), (240, 320), (121, 163), (40, 50), (9, 13)])
+def test_detect_equals_extractColor_middleSquare(rows, cols):
+    detectors = createDetectors(definitions = DETECTORS)
+    assert any(d.blur for d in detectors)
+    for seed in range(3):
+        frame = syntheticFrame(rows, cols, seed)
+        for d in detectors:
+            assert d.Detect(frame) == reference(frame, d), d.name
+
+def test_detectors_reallocate_on_size_change():
+    detectors = createDetectors(definitions = DETECTORS)
+    for rows, cols in [(480, 640), (40, 50), (480, 640)]:
+        frame = syntheticFrame(rows, cols, rows)
+        for d in detectors:
+            assert d.Detect(frame) == reference(frame, d), d.name
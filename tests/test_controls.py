@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+import time
+import pytest
+import controls
+
+class FakeSerial:
+    """ Serial port fed by the test: readline returns the fed chunks and times out
+    like pyserial, the written commands are kept, 'M<n>H' is answered with the
+    position of the motor """
+
+    def __init__(self, port, timeout = None):
+        self.timeout = timeout
+        self.chunks = queue.Queue()
+        self.written = []
+        self.writes = threading.Condition()
+        self.positions = [0, 0, 0, 0]
+
+    def Feed(self, data):
+        self.chunks.put(data.encode())
+
+    def readline(self):
+        try:
+            return self.chunks.get(timeout = self.timeout)
+        except queue.Empty:
+            return b''
+
+    def write(self, data):
+        command = data.decode().split('\0')[0]
+        with self.writes:
+            self.written.append((time.perf_counter(), command))
+            self.writes.notify_all()
+        if len(command) == 3 and command[0] == 'M' and command[2] == 'H':
+            self.Feed('Home$%d\n' % self.positions[int(command[1])])
+
+    def WaitWritten(self, command, timeout = 1):
+        """ Returns the time the command was written or None """
+        with self.writes:
+            self.writes.wait_for(lambda: any(c == command for t, c in self.written), timeout)
+            return next((t for t, c in self.written if c == command), None)
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def rig(monkeypatch):
+    # Controls waits 2 secs for the board to reset after opening the port
+    with monkeypatch.context() as m:
+        m.setattr(controls.serial, 'Serial', FakeSerial)
+        m.setattr(controls.time, 'sleep', lambda secs: None)
+        C = controls.Controls('/dev/fake')
+    yield C, C.ser
+    C.Close()
+
+def test_metal_reaches_subscriber_without_arguments(rig):
+    C, port = rig
+    seen = threading.Event()
+    C.Subscribe('Metal', seen.set)
+    port.Feed('Metal$\n')
+    assert seen.wait(1)
+    assert C.ReadValues()
+    assert not C.ReadValues()
+
+def test_reader_survives_metal_and_failing_subscriber(rig):
+    C, port = rig
+
+    def fail():
+        raise RuntimeError('subscriber failed')
+
+    C.Subscribe('Metal', fail)
+    port.Feed('Metal$\n')
+    port.positions[0] = 1234
+    assert C.AskSteps(0) == 1234
+    assert C.T_read.is_alive()
+
+def test_home_reply_split_by_timeout(rig):
+    C, port = rig
+    port.Feed('Home$-5')
+    port.Feed('00\n')
+    assert C.homeReplies.get(timeout = 1) == '-500'
+
+def test_done_completes_motion_after_metal(rig):
+    C, port = rig
+    motion = C.Move(0, 'M', 10)
+    port.Feed('Metal$\n')
+    port.Feed('Done$0$25000$1\n')
+    assert motion.Wait(1)
+    assert motion.position == 25000
+    assert C.acknowledges
+
+def test_done_completes_only_reported_commands(rig):
+    C, port = rig
+    first = C.Move(1, 'M', 5)
+    second = C.Move(1, 'M', 5)
+    port.Feed('Done$1$1857$1\n')
+    assert first.Wait(1)
+    assert not second.Wait(.1)
+    port.Feed('Done$1$3715$2\n')
+    assert second.Wait(1)
+
+def test_metal_to_stop_latency(rig):
+    C, port = rig
+    C.Subscribe('Metal', lambda: C.Move(0, 'S'))
+    latencies = []
+    for i in range(20):
+        port.written.clear()
+        start = time.perf_counter()
+        port.Feed('Metal$\n')
+        stamp = port.WaitWritten('M0S')
+        assert stamp is not None
+        latencies.append(stamp - start)
+    latencies.sort()
+    print('metal-to-stop latency: median %.3f ms, max %.3f ms' % (1000 * latencies[10], 1000 * latencies[-1]))
+    assert latencies[10] < .01
+
+def test_travel_speed_switches_horizontal_speed(rig):
+    C, port = rig
+    C.TravelSpeed(1)
+    assert port.WaitWritten('T1') is not None
+    assert C.speeds[0] == C.travelSpeed
+    fast = C.Move(0, 'M', 100).estimate
+    C.TravelSpeed(0)
+    assert port.WaitWritten('T0') is not None
+    assert C.speeds[0] == C.searchSpeed
+    assert C.Move(0, 'M', 100).estimate > fast
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import time
+import cv2
+import numpy as np
+from frameGrabber import FrameGrabber
+
+class FakeCapture:
+    """ Video capture switching to the asked size after queued frames of the
+    previous size, or never if it refuses the full size """
+
+    def __init__(self, full = (640, 480), refuses = False, queued = 2):
+        self.full = full
+        self.size = full
+        self.target = list(full)
+        self.refuses = refuses
+        self.queued = queued
+        self.pending = 0
+        self.opened = True
+
+    def get(self, prop):
+        return self.size[0] if prop == cv2.CAP_PROP_FRAME_WIDTH else self.size[1]
+
+    def set(self, prop, value):
+        axis = 0 if prop == cv2.CAP_PROP_FRAME_WIDTH else 1
+        if self.refuses and value == self.full[axis]:
+            return False
+        self.target[axis] = value
+        self.pending = self.queued
+        return True
+
+    def read(self):
+        time.sleep(.002)
+        if self.pending:
+            self.pending -= 1
+        else:
+            self.size = tuple(self.target)
+        return True, np.zeros((self.size[1], self.size[0], 3), dtype = np.uint8)
+
+    def isOpened(self):
+        return self.opened
+
+    def release(self):
+        self.opened = False
+
+def test_still_at_full_resolution_after_queued_frames():
+    grabber = FrameGrabber(FakeCapture(), detectSize = (320, 240))
+    grabber.Start()
+    try:
+        seq, stamp, frame = grabber.WaitAfter(time.time(), 2)
+        assert frame.shape == (480, 640, 3)
+        assert grabber.stillFallbacks == 0
+        # After the frames queued at full resolution the detection size is back
+        shapes = []
+        for i in range(5):
+            seq, stamp, frame = grabber.WaitNewer(seq, 1)
+            shapes.append(frame.shape)
+        assert shapes[-1] == (240, 320, 3)
+    finally:
+        grabber.Stop()
+
+def test_refused_full_size_falls_back_to_detection_frame():
+    grabber = FrameGrabber(FakeCapture(refuses = True), detectSize = (320, 240))
+    grabber.Start()
+    try:
+        # The frames queued at the initial full size are read first
+        seq = 0
+        for i in range(5):
+            seq, stamp, frame = grabber.WaitNewer(seq, 1)
+        start = time.time()
+        seq, stamp, frame = grabber.WaitAfter(start, 2)
+        assert frame is not None and frame.shape == (240, 320, 3)
+        assert time.time() - start < 1
+        assert grabber.stillFallbacks == 1
+        # The detection stream goes on
+        seq, stamp, frame = grabber.WaitNewer(grabber.Latest()[0], 1)
+        assert frame is not None
+    finally:
+        grabber.Stop()
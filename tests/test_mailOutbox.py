@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import email
+import gzip
+import os
+import socket
+import socketserver
+import threading
+import pytest
+from mailOutbox import Outbox, COMPRESS_OVER
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """ One SMTP session of the stand-in server """
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        server = self.server
+        server.sessions += 1
+        self.reply('220 localhost stand-in')
+        recipients = []
+        while True:
+            line = self.rfile.readline().decode().rstrip('\r\n')
+            if not line:
+                return
+            command = line.split(' ')[0].upper()
+            if command in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif command == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                address = line.split(':', 1)[1].strip().strip('<>')
+                if address in server.refused:
+                    self.reply('550 No such user')
+                else:
+                    recipients.append(address)
+                    self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    chunk = self.rfile.readline()
+                    if chunk in (b'.\r\n', b''):
+                        break
+                    data.append(chunk[1:] if chunk.startswith(b'..') else chunk)
+                server.messages.append((server.sessions, recipients, b''.join(data)))
+                self.reply('250 OK')
+            elif command == 'RSET':
+                recipients = []
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+@pytest.fixture
+def smtpServer():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPHandler)
+    server.daemon_threads = True
+    server.sessions = 0
+    server.messages = []
+    server.refused = set()
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def outboxFor(spool, port):
+    return Outbox(str(spool), '127.0.0.1', port, '', '', False)
+
+def closedPort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def test_batch_is_sent_in_one_session(tmp_path, smtpServer):
+    outbox = outboxFor(tmp_path, smtpServer.server_address[1])
+    for i in range(3):
+        outbox.Enqueue('rig@localhost', ['owner@localhost'], 'Report %d' % i, 'Done.')
+    assert outbox.Deliver() == 3
+    assert smtpServer.sessions == 1
+    assert [m[0] for m in smtpServer.messages] == [1, 1, 1]
+    assert outbox.Pending() == []
+
+def test_rejected_message_is_moved_aside(tmp_path, smtpServer):
+    smtpServer.refused.add('nobody@localhost')
+    outbox = outboxFor(tmp_path, smtpServer.server_address[1])
+    rejected = outbox.Enqueue('rig@localhost', ['nobody@localhost'], 'Rejected', 'Done.')
+    outbox.Enqueue('rig@localhost', ['owner@localhost'], 'Accepted', 'Done.')
+
+    assert outbox.Deliver() == 1
+    assert os.path.exists(rejected + '.rejected')
+    assert outbox.Pending() == []
+    assert len(smtpServer.messages) == 1
+
+def test_messages_stay_spooled_after_connection_failure(tmp_path):
+    outbox = outboxFor(tmp_path, closedPort())
+    path = outbox.Enqueue('rig@localhost', ['owner@localhost'], 'Report', 'Done.')
+    with pytest.raises(OSError):
+        outbox.Deliver()
+    assert not outbox.DeliverWithRetry(attempts = 2, backoff = 0)
+    assert outbox.Pending() == [path]
+
+def test_large_attachment_is_gzipped(tmp_path, smtpServer):
+    log = tmp_path / 'log.txt'
+    text = b'(2024-05-01 06:00:00) Plant cycle time: 24.9 secs\n' * (COMPRESS_OVER // 40)
+    log.write_bytes(text)
+    small = tmp_path / 'small.txt'
+    small.write_bytes(b'short')
+
+    spool = tmp_path / 'spool'
+    outbox = outboxFor(spool, smtpServer.server_address[1])
+    outbox.Enqueue('rig@localhost', ['owner@localhost'], 'Report', 'Done.', [str(log), str(small)])
+    assert outbox.DeliverWithRetry(attempts = 1)
+
+    msg = email.message_from_bytes(smtpServer.messages[0][2])
+    attachments = { part.get_filename(): part.get_payload(decode = True) for part in msg.walk() if part.get_filename() }
+    assert gzip.decompress(attachments['log.txt.gz']) == text
+    assert attachments['small.txt'] == b'short'
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import numpy as np
+import runSystem
+from rigState import RigState
+from previewServer import PreviewServer
+from signalBus import Signals
+
+class FakeGrabber:
+    """ Frame grabber returning the same red frame with a new sequence number """
+
+    def __init__(self):
+        self.seq = 0
+        self.frame = np.zeros((240, 320, 3), dtype = np.uint8)
+        self.frame[:, :, 2] = 255
+
+    def isOpened(self):
+        return True
+
+    def Scale(self):
+        return 1
+
+    def Latest(self):
+        return self.seq, time.time(), self.frame
+
+    def WaitNewer(self, seq, timeout):
+        time.sleep(.005)
+        self.seq += 1
+        return self.seq, time.time(), self.frame
+
+def test_preview_with_inactive_detectors(monkeypatch):
+    monkeypatch.setattr(runSystem, 'COLOR_SAMPLES', '/nonexistent/')
+    signals = Signals({ 'red': False, 'green': False, 'blue': False, 'stop': False, 'finish': False })
+    preview = PreviewServer(0, decimation = 1, maxFps = 1000)
+    preview.Start()
+    preview.AddClient(1)
+
+    loop = threading.Thread(target = runSystem.cameraLoop, args = (FakeGrabber(), signals),
+                            kwargs = { 'headless': True, 'preview': preview })
+    loop.start()
+    try:
+        # Only the red detector runs, the green and blue ones are never prepared
+        with signals.Detecting('red'):
+            assert signals.WaitAny(['red'], 5)
+            seq, jpeg = preview.WaitJpeg(0, 5)
+            assert jpeg is not None
+        assert loop.is_alive()
+    finally:
+        signals['finish'] = True
+        loop.join(5)
+        preview.Close()
+    assert not loop.is_alive()
+
+class FakeRail:
+    """ Horizontal motor with the red wire at wire cm, seen by a camera which is
+    turned by 180 degrees (mirror -1) on one side """
+
+    def __init__(self, wire, mirror):
+        self.x = 0
+        self.wire = wire
+        self.mirror = mirror
+
+    def Offset(self):
+        return self.mirror * (self.wire - self.x) * 20
+
+    def Move(self, motor, command, step = 0, wait = False):
+        self.x += step
+
+def centerOnRail(monkeypatch, tmp_path):
+    monkeypatch.setattr(runSystem, 'rig', RigState(str(tmp_path / 'rig_state.json')))
+    monkeypatch.setattr(runSystem, 'locateRed', lambda rail: rail.Offset())
+
+    def move(C, motor, command, step, signals):
+        C.Move(motor, command, step)
+        return True
+
+    monkeypatch.setattr(runSystem, 'safeMove', move)
+
+def test_center_plant_per_side(monkeypatch, tmp_path):
+    centerOnRail(monkeypatch, tmp_path)
+    for direction, mirror in (('-', 1), ('+', -1)):
+        for wire in (3, -4):
+            rail = FakeRail(wire, mirror)
+            assert runSystem.centerPlant(rail, rail, direction, None)
+            assert abs(rail.x - wire) < runSystem.CENTER_TOLERANCE
+    calibration = runSystem.rig.Get('calibration')
+    assert calibration == { '-': -20, '+': 20 }
+
+def test_center_plant_forgets_wrong_calibration(monkeypatch, tmp_path):
+    centerOnRail(monkeypatch, tmp_path)
+    runSystem.saveCalibration('+', -20)
+    rail = FakeRail(3, -1)
+    assert not runSystem.centerPlant(rail, rail, '+', None)
+    assert runSystem.rig.Get('calibration')['+'] is None
+    assert runSystem.centerPlant(rail, rail, '+', None)
+    assert abs(rail.x - 3) < runSystem.CENTER_TOLERANCE
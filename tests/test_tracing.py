@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+import time
+import pytest
+from tracing import JitterProbe
+
+def test_jitter_histogram_is_bounded():
+    probe = JitterProbe(interval = .001, buckets = 50)
+    probe.Start()
+    time.sleep(.2)
+    probe.Stop()
+    assert len(probe.counts) == 51
+    assert probe.Count() > 50
+    assert 0 <= probe.Percentile(.5) <= probe.Percentile(.99) <= probe.maxLate
+    assert len(probe.Summary()) == 1
+
+def test_jitter_percentiles_of_buckets():
+    probe = JitterProbe(bucket = .001, buckets = 10)
+    probe.counts[0] = 90
+    probe.counts[3] = 9
+    probe.counts[-1] = 1
+    probe.maxLate = .05
+    assert probe.Percentile(.5) == pytest.approx(.001)
+    assert probe.Percentile(.95) == pytest.approx(.004)
+    # The quantile in the overflow bucket is the maximum
+    assert probe.Percentile(.999) == .05
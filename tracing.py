@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import functools
+import json
+import threading
+import time
+
+class Tracer:
+    def __init__(self):
+        """ Lightweight span instrumentation.
+        Every span is written as a JSON line to the open trace file and its
+        duration is added to the totals per plant and phase. """
+
+        self.file = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.context = {}
+        self.totals = {}
+
+    def Open(self, path):
+        """ Starts a new trace written to path """
+        with self.lock:
+            self.file = open(path, 'w', encoding = 'utf-8')
+            self.context = {}
+            self.totals = {}
+
+    def Close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def Set(self, **context):
+        """ Sets attributes added to all spans opened from now on, e.g. the current plant """
+        self.context.update(context)
+
+    @contextlib.contextmanager
+    def Span(self, name, **attrs):
+        """ Measures the duration of the with-block. The span gets the context at
+        its start, attrs override it (e.g. plant = None keeps a span out of the
+        time per plant). """
+
+        record = dict(self.context)
+        record.update(attrs)
+        stack = self.local.__dict__.setdefault('stack', [])
+        parent = stack[-1] if stack else None
+        nested = name in stack
+        stack.append(name)
+
+        start = time.time()
+        perf = time.perf_counter()
+        try:
+            yield
+        finally:
+            dur = time.perf_counter() - perf
+            stack.pop()
+
+            record.update({ 'name'  : name,
+                            'start' : start,
+                            'dur'   : dur,
+                            'parent': parent,
+                            'thread': threading.current_thread().name })
+
+            with self.lock:
+                # Recursive spans are already included in the outer one
+                if not nested:
+                    key = (record.get('plant'), name)
+                    total = self.totals.setdefault(key, [0, 0])
+                    total[0] += 1
+                    total[1] += dur
+                if self.file is not None:
+                    self.file.write(json.dumps(record) + '\n')
+
+    def Traced(self, name = None, **attrs):
+        """ Decorator wrapping every call of the function in a span with attrs """
+
+        def decorator(function):
+            spanName = name or function.__name__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.Span(spanName, **attrs):
+                    return function(*args, **kwargs)
+            return wrapper
+
+        return decorator
+
+    def Summary(self):
+        """ Returns the time breakdown per phase and per plant as a list of lines.
+        Times of the phases are inclusive, so nested phases overlap. """
+
+        with self.lock:
+            totals = dict(self.totals)
+
+        phases = {}
+        plants = {}
+        for (plant, name), (count, secs) in totals.items():
+            phase = phases.setdefault(name, [0, 0])
+            phase[0] += count
+            phase[1] += secs
+            plants.setdefault(plant, []).append((name, secs))
+
+        lines = ['Time per phase:']
+        for name, (count, secs) in sorted(phases.items(), key = lambda p: -p[1][1]):
+            lines.append('    %-24s %9.1f secs  (%d calls)' % (name, secs, count))
+
+        lines.append('Time per plant:')
+        for plant in sorted(plants, key = lambda p: -1 if p is None else p):
+            parts = ', '.join('%s %.1f' % (name, secs) for name, secs in sorted(plants[plant], key = lambda p: -p[1]))
+            lines.append('    %s: %s' % ('between plants' if plant is None else 'plant #' + str(plant), parts))
+
+        return lines
+
+class JitterProbe:
+    def __init__(self, interval = .005, bucket = .0001, buckets = 500):
+        """ Thread waking up every interval secs and recording how late it wakes up.
+        The lateness is the time the threads of the process wait for the GIL
+        and the CPU, e.g. before a serial message is handled.
+        It is counted in a histogram of buckets of bucket secs, the last
+        bucket counts all wakeups later than that, so the memory does not grow. """
+
+        self.interval = interval
+        self.bucket = bucket
+        self.counts = [0] * (buckets + 1)
+        self.maxLate = 0
+        self.running = False
+        self.thread = None
+
+    def Start(self):
+        self.counts = [0] * len(self.counts)
+        self.maxLate = 0
+        self.running = True
+        self.thread = threading.Thread(target = self.probeLoop, name = 'jitter', daemon = True)
+        self.thread.start()
+
+    def Stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def probeLoop(self):
+        last = len(self.counts) - 1
+        wake = time.perf_counter() + self.interval
+        while self.running:
+            time.sleep(max(wake - time.perf_counter(), 0))
+            now = time.perf_counter()
+            late = now - wake
+            self.counts[min(int(late / self.bucket), last)] += 1
+            self.maxLate = max(self.maxLate, late)
+            # After a long delay the probe does not catch up with the missed wakeups
+            wake = max(wake + self.interval, now)
+
+    def Count(self):
+        return sum(self.counts)
+
+    def Percentile(self, q):
+        """ Returns the upper bound of the bucket of the q-quantile of the lateness in secs,
+        the maximum if it falls into the last bucket """
+
+        rank = q * self.Count()
+        seen = 0
+        for i, n in enumerate(self.counts[:-1]):
+            seen += n
+            if seen > rank:
+                return min((i + 1) * self.bucket, self.maxLate)
+        return self.maxLate
+
+    def Summary(self):
+        """ Returns the percentiles of the lateness as a list of lines """
+
+        n = self.Count()
+        if not n:
+            return []
+        pick = lambda q: 1000 * self.Percentile(q)
+        return ['Timer jitter over %d wakeups: median %.2f ms, 99 %% %.2f ms, 99.9 %% %.2f ms, max %.2f ms' %
+                (n, pick(.5), pick(.99), pick(.999), 1000 * self.maxLate)]
+
+tracer = Tracer()
+traced = tracer.Traced
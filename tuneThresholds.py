@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+#######################################
+# Tunes the color bounds and the thresholds of the detectors on labeled frames:
+# <directory>/<class>/present/*.png - the marker of the class is in its middle square
+# <directory>/<class>/absent/*.png  - it is not
+# The best configuration is written to colorDetection.TUNED_DETECTORS.
+# USAGE:
+# python3 tuneThresholds.py /home/pi/Filakov/labeled --workers 4
+#######################################
+
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import itertools
+import json
+import os
+import cv2
+import numpy as np
+from colorDetection import DETECTORS, TUNED_DETECTORS, ColorDetector, listImages, loadDefinitions
+
+# Histograms have 2^BITS bins per channel, so the bounds are tuned in steps of 256 / 2^BITS
+BITS = 5
+HISTOGRAM_CACHE = '/home/pi/Filakov/histograms/'
+# Every bound is searched up to SPAN steps around the current one
+SPAN = 3
+# Candidate thresholds (fractions of the middle square)
+CUTOFFS = np.geomspace(.001, .5, 64)
+# Candidate boxes evaluated per task of the process pool
+CHUNK = 4096
+
+def loadLabeled(directory, names):
+    """ Returns {name: [(path, present)]} of the labeled frames of the classes """
+    labeled = {}
+    for name in names:
+        for label in ('present', 'absent'):
+            folder = os.path.join(directory, name, label)
+            if os.path.isdir(folder):
+                labeled.setdefault(name, []).extend((path, label == 'present') for path in listImages(folder))
+    return labeled
+
+def cachePath(cache, path, definition, bits):
+    """ Returns the cache file of the histogram, named by the hash of the image
+    file state and of everything the histogram depends on """
+
+    st = os.stat(path)
+    key = json.dumps([os.path.abspath(path), st.st_mtime_ns, st.st_size,
+                      definition['square'], definition['blur'], bits, 'channels'])
+    return os.path.join(cache, hashlib.sha1(key.encode()).hexdigest()[:20] + '.npz')
+
+def squareHistogram(job):
+    """ Returns (histogram, area) of the BGR colors in the middle square of the
+    detector, read from the cache or computed and cached. None if the image is unreadable.
+    Like ColorDetector.Detect, a pixel counts with its nonzero channels, so the
+    histogram holds 3 * the fraction Detect gives for the colors of a bin. """
+
+    name, path, definition, bits, cache = job
+    cached = cachePath(cache, path, definition, bits)
+    try:
+        with np.load(cached) as f:
+            return f['hist'], int(f['area'])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    frame = cv2.imread(path)
+    if frame is None:
+        return None
+    detector = ColorDetector(name, **definition)
+    roi = detector.Square(frame)
+    pixels = roi.reshape(-1, 3)
+    q = pixels.astype(np.int32) >> (8 - bits)
+    hist = np.bincount((q[:, 0] << (2 * bits)) + (q[:, 1] << bits) + q[:, 2],
+                       weights = np.count_nonzero(pixels, axis = 1), minlength = 1 << (3 * bits))
+    hist = hist.astype(np.int32).reshape((1 << bits,) * 3)
+
+    try:
+        os.makedirs(cache, exist_ok = True)
+        tmp = cached + '.tmp.npz'
+        np.savez(tmp, hist = hist, area = detector.area)
+        os.replace(tmp, cached)
+    except OSError:
+        pass
+    return hist, detector.area
+
+def summedVolume(hist):
+    """ Returns the table S with S[i, j, k] = sum of hist[:i, :j, :k], flattened """
+    n = hist.shape[0]
+    table = np.zeros((n + 1,) * 3, dtype = np.int32)
+    table[1:, 1:, 1:] = hist.cumsum(0).cumsum(1).cumsum(2)
+    return table.reshape(-1)
+
+def candidateBoxes(bounds, bits, span):
+    """ Returns the (K, 6) candidate boxes in bins (B, G, R lows, B, G, R highs)
+    within span bins of the bounds """
+
+    n = 1 << bits
+    lows = [range(max(lo // (256 // n) - span, 0), min(lo // (256 // n) + span, n - 1) + 1) for lo in bounds[0]]
+    highs = [range(max(hi // (256 // n) - span, 0), min(hi // (256 // n) + span, n - 1) + 1) for hi in bounds[1]]
+    boxes = np.array(list(itertools.product(*lows, *highs)), dtype = np.int32)
+    return boxes[np.all(boxes[:, :3] <= boxes[:, 3:], axis = 1)]
+
+def boxFractions(tables, areas, boxes, n):
+    """ Returns the (N, K) fractions of the middle squares inside the boxes as
+    ColorDetector.Detect counts them, eight lookups in the summed volume tables per image and box """
+
+    size = n + 1
+    lo, hi = boxes[:, :3], boxes[:, 3:] + 1
+    counts = np.zeros((tables.shape[0], boxes.shape[0]), dtype = np.int64)
+    for corner in itertools.product((0, 1), repeat = 3):
+        idx = [hi[:, c] if corner[c] else lo[:, c] for c in range(3)]
+        sign = 1 if sum(corner) % 2 == 1 else -1
+        counts += sign * tables[:, (idx[0] * size + idx[1]) * size + idx[2]]
+    # (1 / 3) because the histograms count the pixels in all 3 channels
+    return (1 / 3) * counts / areas[:, None]
+
+# Data of the labeled images in the processes of the pool
+poolData = {}
+
+def initPool(tables, areas, labels, n, beta):
+    poolData.update(tables = tables, areas = areas, labels = labels, n = n, beta = beta)
+
+def scoreBoxes(boxes):
+    """ Returns the best (score, width, box, cutoff index, precision, recall) of the boxes.
+    score is the F-beta score of the best cutoff, width the number of cutoffs reaching
+    it, so of equal scores the box separating the labels with the widest margin wins. """
+
+    fractions = boxFractions(poolData['tables'], poolData['areas'], boxes, poolData['n'])
+    labels = poolData['labels']
+    beta2 = poolData['beta'] ** 2
+    present = labels.sum()
+
+    scores = np.empty((len(CUTOFFS), len(boxes)))
+    precisions = np.empty_like(scores)
+    recalls = np.empty_like(scores)
+    for i, cutoff in enumerate(CUTOFFS):
+        detected = fractions > cutoff
+        tp = (detected & labels[:, None]).sum(0)
+        fp = detected.sum(0) - tp
+        precisions[i] = tp / np.maximum(tp + fp, 1)
+        recalls[i] = tp / max(present, 1)
+        scores[i] = (1 + beta2) * precisions[i] * recalls[i] / np.maximum(beta2 * precisions[i] + recalls[i], 1e-12)
+
+    best = scores.max(0)
+    tied = scores >= best - 1e-12
+    width = tied.sum(0)
+    # The cutoff in the middle of the cutoffs reaching the best score
+    middle = (np.cumsum(tied, 0) >= (width + 1) // 2).argmax(0)
+
+    k = max(range(len(boxes)), key = lambda k: (best[k], width[k]))
+    c = middle[k]
+    return best[k], int(width[k]), boxes[k], int(c), precisions[c, k], recalls[c, k]
+
+def evaluate(tables, areas, labels, box, cutoff, n):
+    """ Returns (precision, recall) of the box in bins with the cutoff """
+    detected = boxFractions(tables, areas, np.array([box]), n)[:, 0] > cutoff
+    tp = int((detected & labels).sum())
+    return tp / max(int(detected.sum()), 1), tp / max(int(labels.sum()), 1)
+
+def tuneClass(name, images, definition, args, pool):
+    """ Returns the tuned configuration of the class and the one of its current definition """
+
+    jobs = [(name, path, definition, args.bits, args.cache) for path, present in images]
+    results = list(pool.map(squareHistogram, jobs, chunksize = 8))
+    kept = [(r, present) for r, (path, present) in zip(results, images) if r is not None]
+    if not any(p for r, p in kept) or all(p for r, p in kept):
+        print('%s: both present and absent frames are needed' % name)
+        return None, None
+
+    n = 1 << args.bits
+    step = 256 // n
+    tables = np.stack([summedVolume(h) for (h, area), p in kept])
+    areas = np.array([area for (h, area), p in kept], dtype = np.float64)
+    labels = np.array([p for r, p in kept])
+
+    boxes = candidateBoxes(definition['bounds'], args.bits, args.span)
+    chunks = [boxes[i : i + CHUNK] for i in range(0, len(boxes), CHUNK)]
+    with concurrent.futures.ProcessPoolExecutor(args.workers, initializer = initPool,
+                                                initargs = (tables, areas, labels, n, args.beta)) as scorers:
+        best = max(scorers.map(scoreBoxes, chunks), key = lambda r: (r[0], r[1]))
+    score, width, box, c, precision, recall = best
+
+    current = [b // step for b in definition['bounds'][0]] + [b // step for b in definition['bounds'][1]]
+    currentPrecision, currentRecall = evaluate(tables, areas, labels, current, definition['threshold'], n)
+
+    tuned = { 'bounds'   : [[int(b) * step for b in box[:3]], [int(b) * step + step - 1 for b in box[3:]]],
+              'threshold': round(float(CUTOFFS[c]), 5),
+              'precision': round(float(precision), 4),
+              'recall'   : round(float(recall), 4),
+              'present'  : int(labels.sum()),
+              'absent'   : int((~labels).sum()),
+              'boxes'    : len(boxes),
+              'tuned'    : str(datetime.datetime.now())[:19] }
+    return tuned, (currentPrecision, currentRecall)
+
+def writeConfig(path, tuned):
+    """ Merges the tuned classes into the configuration file """
+    try:
+        with open(path, encoding = 'utf-8') as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        config = {}
+    config.update(tuned)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding = 'utf-8') as f:
+        json.dump(config, f, indent = 1)
+    os.replace(tmp, path)
+
+def run():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('directory', help = 'directory with the labeled frames')
+    ap.add_argument('--classes', nargs = '+', default = list(DETECTORS))
+    ap.add_argument('--workers', type = int, default = os.cpu_count())
+    ap.add_argument('--bits', type = int, default = BITS)
+    ap.add_argument('--span', type = int, default = SPAN, help = 'steps searched around every current bound')
+    ap.add_argument('--beta', type = float, default = 1, help = 'weight of the recall in the F-beta score')
+    ap.add_argument('--cache', default = HISTOGRAM_CACHE)
+    ap.add_argument('--output', default = TUNED_DETECTORS)
+    args = ap.parse_args()
+
+    definitions = loadDefinitions(args.output)
+    labeled = loadLabeled(args.directory, args.classes)
+    if not labeled:
+        print('No labeled frames found in', args.directory)
+        return
+
+    tuned = {}
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+        for name, images in labeled.items():
+            config, current = tuneClass(name, images, definitions[name], args, pool)
+            if config is None:
+                continue
+            tuned[name] = config
+            print('%-6s %s -> %s, threshold %.4f -> %.4f' % (name, list(definitions[name]['bounds']), config['bounds'],
+                                                            definitions[name]['threshold'], config['threshold']))
+            print('       precision %.3f -> %.3f, recall %.3f -> %.3f (%d present, %d absent, %d boxes)' %
+                  (current[0], config['precision'], current[1], config['recall'], config['present'], config['absent'], config['boxes']))
+
+    if tuned:
+        writeConfig(args.output, tuned)
+        print('Configuration written to', args.output)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+from colorDetection import createDetectors
+from colorTable import loadTable, loadSamples
+from frameGrabber import FrameGrabber
+from frameRecorder import FrameRecorder, signalState, nameBits
+from logWriter import logger
+
+# Frames handed over at the same time (stills and preview frames being copied)
+SLOTS = 4
+STARTUP_TIMEOUT = 30
+STOP_TIMEOUT = 10
+# Niceness of the vision process, so that the control process gets the CPU first
+NICENESS = 5
+
+class FrameRing:
+    def __init__(self, shm, shape, slots, owner):
+        """ Slots of frames in a shared memory block. A slot belongs to one process
+        at a time: the worker copies a frame into a free slot and hands it over with
+        a message, the control process copies it out and releases the slot with
+        a message, so the pipe orders all accesses to the slot. Smaller frames
+        (the detection stream) fill the top left corner of a slot. """
+
+        self.shm = shm
+        self.shape = tuple(shape)
+        self.owner = owner
+        self.frames = np.ndarray((slots,) + self.shape, dtype = np.uint8, buffer = shm.buf)
+        self.free = list(range(slots))
+        self.lock = threading.Lock()
+
+    @classmethod
+    def Create(cls, shape, slots = SLOTS):
+        shm = shared_memory.SharedMemory(create = True, size = slots * int(np.prod(shape)))
+        return cls(shm, shape, slots, True)
+
+    @classmethod
+    def Attach(cls, name, shape, slots = SLOTS):
+        return cls(shared_memory.SharedMemory(name = name), shape, slots, False)
+
+    def Name(self):
+        return self.shm.name
+
+    def Put(self, frame):
+        """ Copies the frame into a free slot. Returns the slot or None if all are taken """
+        with self.lock:
+            if not self.free or self.frames is None:
+                return None
+            slot = self.free.pop()
+            rows, cols = frame.shape[:2]
+            self.frames[slot, :rows, :cols] = frame
+            return slot
+
+    def Get(self, slot, shape):
+        """ Returns a copy of the frame of the given shape in the slot """
+        rows, cols = shape[:2]
+        return self.frames[slot, :rows, :cols].copy()
+
+    def Release(self, slot):
+        with self.lock:
+            self.free.append(slot)
+
+    def Close(self):
+        """ Unmaps the block, the creator also removes it """
+        with self.lock:
+            # The block cannot be closed while an array still exports its buffer
+            self.frames = None
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+def workerMain(conn, camera, names, levels, detectSize, samples, record):
+    """ Body of the vision process: grabs the frames, runs the detectors the
+    control process asked for and answers the requests for frames.
+    Messages to the control process:
+      ('ready', ring name, still shape, scale) or ('failed', reason) at startup
+      ('result', seq, stamp, {name: fraction}, [detected names]) per frame with a detection
+      ('still' or 'frame', key, slot, shape, seq, stamp, extra) with a frame in the ring,
+      extra is the info of WaitStable or the marks [(roi, fraction)] for the preview
+      ('log', message) and ('stats', ...) before exiting
+    Messages from the control process:
+      ('active', names), ('signals', state), ('still', key, t, timeout),
+      ('stable', key, t, timeout, burst), ('frame', key), ('release', slot), ('stop',)
+    The frames the detectors ran on are recorded to the directory record if given. """
+
+    sendLock = threading.Lock()
+    try:
+        os.nice(NICENESS)
+    except OSError:
+        pass
+
+    def send(*msg):
+        with sendLock:
+            try:
+                conn.send(msg)
+            except (OSError, ValueError):
+                pass
+
+    if isinstance(camera, int):
+        cam = cv2.VideoCapture(camera)
+        time.sleep(1)
+    else:
+        cam = camera
+    if not cam.isOpened():
+        send('failed', 'Camera is not opened.')
+        return
+
+    grabber = FrameGrabber(cam, levels, detectSize)
+    grabber.Start()
+    seq, stamp, still = grabber.WaitAfter(time.time(), STARTUP_TIMEOUT)
+    if still is None:
+        grabber.Stop()
+        send('failed', 'No frames from the camera.')
+        return
+
+    ring = FrameRing.Create(still.shape)
+    detectors = createDetectors(names, scale = grabber.Scale())
+    table = loadTable(names, samples = loadSamples(samples)) if samples and os.path.isdir(samples) else None
+    send('ready', ring.Name(), still.shape, grabber.Scale())
+
+    def serveStill(kind, key, t, timeout, burst = None):
+        info = None
+        if kind == 'stable':
+            seq, stamp, frame, info = grabber.WaitStable(t, timeout, burst)
+        else:
+            seq, stamp, frame = grabber.WaitAfter(t, timeout)
+        slot = None if frame is None else ring.Put(frame)
+        send('still', key, slot, None if slot is None else frame.shape, seq, stamp, info)
+
+    recorder = FrameRecorder(record) if record else None
+    state = 0
+    active = set()
+    running = []
+    seq = 0
+    frames = 0
+    counts = dict.fromkeys(names, 0)
+    size = None
+    start, cpuStart = time.time(), time.process_time()
+    try:
+        while grabber.isOpened():
+            # Without any detector needed the worker sleeps until the next message
+            if conn.poll(0 if active else 1):
+                msg = conn.recv()
+                if msg[0] == 'stop':
+                    break
+                elif msg[0] == 'active':
+                    active = set(msg[1])
+                elif msg[0] == 'signals':
+                    state = msg[1]
+                elif msg[0] == 'release':
+                    ring.Release(msg[1])
+                elif msg[0] in ('still', 'stable'):
+                    threading.Thread(target = serveStill, args = msg, daemon = True).start()
+                elif msg[0] == 'frame':
+                    latestSeq, latestStamp, latest = grabber.Latest()
+                    slot = None if latest is None else ring.Put(latest)
+                    send('frame', msg[1], slot, None if slot is None else latest.shape, latestSeq, latestStamp,
+                         [(d.roi, d.fraction) for d in running])
+                continue
+
+            if not active:
+                continue
+
+            seq, stamp, frame = grabber.WaitNewer(seq, 1)
+            if frame is None:
+                send('log', 'Camera loop skipped a frame.')
+                continue
+
+            running = [d for d in detectors if d.name in active]
+            if table is not None:
+                table.DetectAll(frame, running)
+            else:
+                for d in running:
+                    d.Detect(frame)
+            for d in running:
+                counts[d.name] += 1
+            frames += 1
+            size = frame.shape
+            # The control process wakes up only for the frames raising a signal
+            detected = [d.name for d in running if d.Detected()]
+            if detected:
+                send('result', seq, stamp, { d.name: d.fraction for d in running }, detected)
+            if recorder is not None:
+                recorder.Record(frame, seq, stamp, state, nameBits(active), nameBits(detected))
+    except (EOFError, OSError):
+        # The control process is gone
+        pass
+    finally:
+        grabber.Stop()
+        ring.Close()
+        if recorder is not None:
+            recorder.Close()
+            for line in recorder.Summary():
+                send('log', line)
+        send('stats', frames, size, counts, time.process_time() - cpuStart, time.time() - start, grabber.failures, grabber.stillFallbacks)
+        conn.close()
+
+class VisionWorker:
+    def __init__(self, camera, names = ('red', 'green', 'blue'), levels = 0, detectSize = None, samples = None, record = None):
+        """ Capture and detection in a separate process, so that the numpy and
+        OpenCV work never holds the GIL of the control process, where the serial
+        messages (metal, motion) are handled.
+        camera - index of the video capture device or a picklable object with the
+        interface of cv2.VideoCapture, which is opened in the vision process
+        samples - directory of labeled color samples (colorTable.loadSamples)
+        record - directory the detection frames are recorded to (frameRecorder)
+        The stills come through a FrameRing in shared memory, the results and the
+        fractions through a pipe read by a receiver thread. Stills are read with
+        WaitAfter and Scale as from a FrameGrabber. Serve runs as the camera loop. """
+
+        ctx = multiprocessing.get_context('spawn')
+        self.conn, self.child = ctx.Pipe()
+        self.process = ctx.Process(target = workerMain, name = 'vision', daemon = True,
+                                   args = (self.child, camera, tuple(names), levels, detectSize, samples, record))
+        self.names = tuple(names)
+        self.record = record
+        self.sendLock = threading.Lock()
+        self.cond = threading.Condition()
+        self.replies = {}
+        # Keys of the requests still waiting, a reply arriving after the timeout is dropped
+        self.pending = set()
+        self.keys = itertools.count(1)
+        self.ring = None
+        self.scale = 1
+        self.running = False
+        self.stopping = False
+        self.signals = None
+        self.preview = None
+        self.fractions = {}
+        self.T_recv = threading.Thread(target = self.receiveLoop, name = 'vision-receiver', daemon = True)
+
+    def Start(self, timeout = STARTUP_TIMEOUT):
+        """ Starts the vision process and waits for its first frame.
+        Returns whether the camera delivers """
+
+        try:
+            self.process.start()
+        except Exception as e:
+            logger.Log('Vision process is not started: ' + str(e))
+            return False
+        self.child.close()
+
+        try:
+            while self.conn.poll(timeout):
+                msg = self.conn.recv()
+                if msg[0] == 'log':
+                    logger.Log(msg[1])
+                    continue
+                if msg[0] == 'ready':
+                    name, shape, self.scale = msg[1:]
+                    self.ring = FrameRing.Attach(name, shape)
+                    self.running = True
+                    self.T_recv.start()
+                    return True
+                logger.Log('Vision process failed: ' + msg[1])
+                break
+        except (EOFError, OSError):
+            logger.Log('Vision process ended during its startup.')
+
+        self.Stop()
+        return False
+
+    def send(self, *msg):
+        with self.sendLock:
+            self.conn.send(msg)
+
+    def Serve(self, signals, preview = None):
+        """ Camera loop of the control process: tells the vision process the
+        detectors of the running phases (signals.Detecting) and lets the receiver
+        raise their signals and publish the preview. Stops the vision process
+        at the finish signal. """
+
+        self.preview = preview
+        self.signals = signals
+        sent = None
+        sentState = None
+        requested = 0
+        try:
+            while self.running and not signals['finish']:
+                active = signals.Active()
+                if active != sent:
+                    self.send('active', sorted(active))
+                    sent = active
+                # The recording keeps the signals with every frame
+                state = signalState(signals) if self.record is not None else None
+                if state != sentState:
+                    self.send('signals', state)
+                    sentState = state
+
+                wait = 1
+                if preview is not None and preview.clients:
+                    wait = preview.interval
+                    if time.time() - requested >= wait:
+                        self.send('frame', 0)
+                        requested = time.time()
+                # Entering and leaving a phase notifies the waiting threads
+                signals.WaitAny(['finish'], wait, lambda: signals.Active() != sent or not self.running or
+                                (self.record is not None and signalState(signals) != sentState))
+        except OSError:
+            pass
+        self.shutdown()
+
+    def receiveLoop(self):
+        try:
+            while True:
+                msg = self.conn.recv()
+                self.handle(msg)
+                if msg[0] == 'stats':
+                    break
+        except (EOFError, OSError):
+            if not self.stopping:
+                logger.Log('Vision process ended unexpectedly.')
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.signals is not None:
+            self.signals.Notify()
+
+    def handle(self, msg):
+        kind = msg[0]
+        if kind == 'result':
+            seq, stamp, self.fractions, detected = msg[1:]
+            if self.signals is not None:
+                for name in detected:
+                    self.signals[name] = True
+        elif kind in ('still', 'frame'):
+            key, slot, shape, seq, stamp, extra = msg[1:]
+            frame = None
+            if slot is not None:
+                frame = self.ring.Get(slot, shape)
+                self.send('release', slot)
+            if kind == 'frame':
+                if frame is not None and self.preview is not None:
+                    self.preview.Show(frame, extra)
+            else:
+                with self.cond:
+                    if key in self.pending:
+                        self.replies[key] = (seq, stamp, frame, extra)
+                        self.cond.notify_all()
+        elif kind == 'log':
+            logger.Log(msg[1])
+        elif kind == 'stats':
+            self.logStats(*msg[1:])
+
+    def logStats(self, frames, size, counts, cpu, elapsed, failures, fallbacks):
+        elapsed = max(elapsed, 1e-6)
+        logger.Log('Detection: %d frames of %s, %.1f fps, vision process CPU %.0f %%' %
+                   (frames, 'none' if size is None else '%dx%d' % (size[1], size[0]), frames / elapsed, 100 * cpu / elapsed))
+        logger.Log('Frames per detector: ' + ', '.join('%s %d' % (n, counts[n]) for n in self.names) +
+                   (', failed reads %d' % failures if failures else '') +
+                   (', stills of the detection size %d' % fallbacks if fallbacks else ''))
+
+    def shutdown(self):
+        """ Asks the vision process to stop and waits for its last messages """
+
+        with self.cond:
+            if self.stopping:
+                return
+            self.stopping = True
+        try:
+            self.send('stop')
+        except OSError:
+            pass
+        if self.T_recv.is_alive():
+            self.T_recv.join(STOP_TIMEOUT)
+
+    def Stop(self):
+        """ Stops the vision process (if Serve did not) and releases the shared memory """
+
+        self.shutdown()
+        if self.process.pid is not None:
+            self.process.join(STOP_TIMEOUT)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+        if self.ring is not None:
+            # The block of a killed vision process is left to the control process
+            self.ring.owner = self.process.exitcode != 0
+            self.ring.Close()
+            self.ring = None
+        self.conn.close()
+
+    def isOpened(self):
+        return self.running
+
+    def Scale(self):
+        """ Returns the size of the detection frames relative to the stills """
+        return self.scale
+
+    def request(self, msg, timeout):
+        """ Sends the request of a still and waits for the reply (seq, stamp, frame, extra) """
+
+        key = next(self.keys)
+        with self.cond:
+            if not self.running:
+                return 0, 0, None, None
+            self.pending.add(key)
+        try:
+            self.send(msg[0], key, *msg[1:])
+        except OSError:
+            with self.cond:
+                self.pending.discard(key)
+            return 0, 0, None, None
+        with self.cond:
+            # The vision process answers after its own timeout as well
+            self.cond.wait_for(lambda: key in self.replies or not self.running, timeout)
+            self.pending.discard(key)
+            return self.replies.pop(key, (0, 0, None, None))
+
+    def WaitAfter(self, t, timeout = None):
+        """ Waits for the first full resolution still captured after the time t.
+        Returns (seq, stamp, frame), frame is None on timeout or when stopped.
+        The frame is a copy owned by the caller. """
+
+        return self.request(('still', t, timeout), None if timeout is None else timeout + 1)[:3]
+
+    def WaitStable(self, t, timeout = None, burst = 1):
+        """ FrameGrabber.WaitStable in the vision process. Returns (seq, stamp, frame, info) """
+
+        # The stable scene and each still of the burst are awaited up to timeout secs
+        return self.request(('stable', t, timeout, burst), None if timeout is None else (burst + 1) * timeout + 1)